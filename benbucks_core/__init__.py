@@ -1,24 +1,85 @@
-from beanie import init_beanie
-from motor.motor_asyncio import AsyncIOMotorClient
+from importlib import import_module
 
 from ._utils import format_money
-from .lottery import Lottery
-from .pool import Pool
-from .trivia import TriviaQuestion
-from .user import User
+
+# Avoids importing typing, which is slow to import
+TYPE_CHECKING = False
+
+if TYPE_CHECKING:
+    from ._batch import batch
+    from ._db import (
+        close_db,
+        get_client,
+        init_db,
+        init_memory_db,
+        merge_duplicate_pools,
+        migrate_money,
+    )
+    from .lottery import Lottery
+    from .pool import Pool
+    from .snapshot import BalanceSnapshot
+    from .transaction import Transaction
+    from .trivia import TriviaQuestion, TriviaRound
+    from .user import User
+    from .workers import ProcessRouter, Router, ShardWorker
 
 __all__ = [
+    "BalanceSnapshot",
+    "batch",
+    "close_db",
     "format_money",
+    "get_client",
     "init_db",
+    "init_memory_db",
+    "merge_duplicate_pools",
+    "migrate_money",
     "Lottery",
     "Pool",
+    "ProcessRouter",
+    "Router",
+    "ShardWorker",
+    "Transaction",
     "TriviaQuestion",
+    "TriviaRound",
     "User",
 ]
 
+# Models and database helpers import Beanie, Motor and pydantic, so
+# they're only imported when first used
+_LAZY_MODULES = {
+    "BalanceSnapshot": ".snapshot",
+    "batch": "._batch",
+    "close_db": "._db",
+    "get_client": "._db",
+    "init_db": "._db",
+    "init_memory_db": "._db",
+    "merge_duplicate_pools": "._db",
+    "migrate_money": "._db",
+    "Lottery": ".lottery",
+    "Pool": ".pool",
+    "ProcessRouter": ".workers",
+    "Router": ".workers",
+    "ShardWorker": ".workers",
+    "Transaction": ".transaction",
+    "TriviaQuestion": ".trivia",
+    "TriviaRound": ".trivia",
+    "User": ".user",
+}
 
-async def init_db(client: AsyncIOMotorClient, env: str = "prod"):
-    await init_beanie(
-        document_models=[Lottery, Pool, TriviaQuestion, User],
-        database=client[env],
-    )
+
+def __getattr__(name: str) -> object:
+    try:
+        module = _LAZY_MODULES[name]
+    except KeyError:
+        raise AttributeError(
+            f"module {__name__!r} has no attribute {name!r}"
+        ) from None
+
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted({*globals(), *__all__})
@@ -0,0 +1,153 @@
+from collections.abc import Iterable
+from typing import Optional
+
+from beanie import Document, PydanticObjectId
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClientSession
+from pymongo import ReturnDocument, UpdateOne
+
+from ._batch import BULK_TOKEN_FIELD, current_batch
+from ._utils import check_cents
+
+
+async def inc_balance(
+    document: Document,
+    amount: int,
+    session: Optional[AsyncIOMotorClientSession] = None,
+) -> int:
+    """Atomically change a document's balance by a given amount.
+
+    The balance check and update happen in a single conditional
+    ``$inc`` on the server, so concurrent changes to the same document
+    are never lost. Documents that haven't been inserted yet are checked
+    locally and inserted with their current balance first, so it's
+    recorded as their opening balance. Inside a batch, without a
+    session, the change is checked locally and queued.
+
+    Args:
+        document (Document): The document with a ``balance`` field.
+        amount (int): The amount to change the balance by, in cents.
+        session (AsyncIOMotorClientSession, optional): The session to
+            run the update in. Defaults to None.
+
+    Raises:
+        TypeError: If the amount isn't an integer number of cents.
+        ValueError: If the balance would be made negative.
+
+    Returns:
+        int: The new balance, in cents.
+    """
+    check_cents(amount)
+
+    if document.id is None:
+        if document.balance + amount < 0:
+            raise ValueError("Balance cannot be negative")
+
+        await document.insert(session=session)
+
+    if session is None and (pending := current_batch()) is not None:
+        if document.balance + amount < 0:
+            raise ValueError("Balance cannot be negative")
+
+        document.balance += amount
+        pending.inc(type(document), document.id, "balance", amount, document)
+
+        return document.balance
+
+    result = await document.get_motor_collection().find_one_and_update(
+        {"_id": document.id, "balance": {"$gte": -amount}},
+        {"$inc": {"balance": amount}},
+        projection={"balance": True},
+        return_document=ReturnDocument.AFTER,
+        session=session,
+    )
+
+    if result is None:
+        raise ValueError("Balance cannot be negative")
+
+    document.balance = result["balance"]
+
+    return document.balance
+
+
+async def bulk_inc_balances(
+    document_cls: type[Document],
+    changes: Iterable[tuple[PydanticObjectId, int]],
+    session: Optional[AsyncIOMotorClientSession] = None,
+) -> list[PydanticObjectId]:
+    """Change many documents' balances with a single bulk write.
+
+    Changes for the same document are combined first. Each combined
+    change is a conditional ``$inc`` like in ``inc_balance``, and the
+    write is unordered so one rejected change doesn't stop the rest.
+    Each applied change also stamps the document with a per-call token,
+    which is only read back when some changes were rejected. Inside a
+    batch, without a session, the changes are queued and checked when
+    the batch is written, when the IDs of rejected changes are added to
+    its rejected_ids.
+
+    Args:
+        document_cls (type[Document]): The model with a ``balance``
+            field.
+        changes (Iterable[tuple[PydanticObjectId, int]]): Pairs of
+            document IDs and the amounts to change their balances by,
+            in cents.
+        session (AsyncIOMotorClientSession, optional): The session to
+            run the updates in. Defaults to None.
+
+    Raises:
+        TypeError: If an amount isn't an integer number of cents.
+
+    Returns:
+        list[PydanticObjectId]: The IDs of documents whose balances
+            weren't changed, because they don't exist or because the
+            change would have made their balance negative.
+    """
+    totals: dict[PydanticObjectId, int] = {}
+
+    for document_id, amount in changes:
+        check_cents(amount)
+        totals[document_id] = totals.get(document_id, 0) + amount
+
+    if not totals:
+        return []
+
+    if session is None and (pending := current_batch()) is not None:
+        for document_id, amount in totals.items():
+            pending.inc(document_cls, document_id, "balance", amount)
+
+        return []
+
+    token = ObjectId()
+    collection = document_cls.get_motor_collection()
+
+    result = await collection.bulk_write(
+        [
+            UpdateOne(
+                {"_id": document_id, "balance": {"$gte": -amount}},
+                {
+                    "$inc": {"balance": amount},
+                    "$set": {BULK_TOKEN_FIELD: token},
+                },
+            )
+            for document_id, amount in totals.items()
+        ],
+        ordered=False,
+        session=session,
+    )
+
+    if result.matched_count == len(totals):
+        return []
+
+    applied = {
+        document["_id"]
+        async for document in collection.find(
+            {"_id": {"$in": list(totals)}, BULK_TOKEN_FIELD: token},
+            projection={"_id": True},
+            session=session,
+        )
+    }
+
+    return [
+        document_id for document_id in totals if document_id not in applied
+    ]
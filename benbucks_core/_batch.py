@@ -0,0 +1,309 @@
+import asyncio
+from collections import Counter, defaultdict
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import asynccontextmanager, contextmanager, suppress
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+from beanie import Document, PydanticObjectId
+from beanie.odm.utils.encoder import Encoder
+from bson import ObjectId
+from pymongo import UpdateOne
+
+BULK_TOKEN_FIELD = "bulk_token"
+
+_current: ContextVar[Optional["Batch"]] = ContextVar("batch", default=None)
+
+
+class Batch:
+    """Updates waiting to be written, combined per document.
+
+    Increments to the same field are added together and later values
+    replace earlier ones, so each document gets at most one update per
+    flush. Ledger transactions wait for the balance changes they record
+    and are only inserted if those are written.
+
+    Attributes:
+        rejected (bool): Whether any update has been rejected.
+        rejected_ids (set[PydanticObjectId]): The IDs of documents whose
+            updates have been rejected.
+    """
+
+    def __init__(self):
+        self.rejected = False
+        self.rejected_ids: set[PydanticObjectId] = set()
+        self._incs = _updates(Counter)
+        self._sets = _updates(dict)
+        self._applied: list[tuple[Document, str, int]] = []
+        self._ledger: list[Document] = []
+
+    def inc(
+        self,
+        document_cls: type[Document],
+        document_id: PydanticObjectId,
+        field: str,
+        amount: int,
+        document: Optional[Document] = None,
+    ) -> None:
+        """Queue an increment to a field, undoing it on the document in
+        memory, if given, when it's rejected."""
+        self._incs[document_cls][document_id][field] += amount
+
+        if document is not None:
+            self._applied.append((document, field, amount))
+
+    def record(self, transactions: list[Document]) -> None:
+        """Queue ledger transactions, to be inserted once the balance
+        changes they record are written."""
+        self._ledger.extend(transactions)
+
+    def set(
+        self,
+        document_cls: type[Document],
+        document_id: PydanticObjectId,
+        field: str,
+        value: Any,
+    ) -> None:
+        """Queue a new value for a field."""
+        self._sets[document_cls][document_id][field] = value
+
+    async def flush(self) -> None:
+        """Write every pending update, with one unordered bulk write per
+        collection.
+
+        Negative balance increments are only applied if they wouldn't
+        make the balance negative. Like in bulk_inc_balances, each
+        update stamps its document with a token, which is only read back
+        when some updates were rejected. Rejected increments are undone
+        on the documents in memory, and ledger transactions are only
+        inserted for the documents that were updated, stamped with the
+        time they were written.
+
+        Raises:
+            ValueError: If a document was missing or a balance would
+                have been made negative. Every other update is still
+                written.
+        """
+        # Imported here, as the ledger queues its transactions with the
+        # current batch
+        from .transaction import Transaction
+
+        incs, self._incs = self._incs, _updates(Counter)
+        sets, self._sets = self._sets, _updates(dict)
+        applied, self._applied = self._applied, []
+        ledger, self._ledger = self._ledger, []
+        token = ObjectId()
+        rejected: set[PydanticObjectId] = set()
+
+        for document_cls in incs.keys() | sets.keys():
+            document_ids = incs[document_cls].keys() | sets[document_cls]
+            requests = {
+                document_id: request
+                for document_id in document_ids
+                if (
+                    request := _update_request(
+                        document_id,
+                        incs[document_cls][document_id],
+                        sets[document_cls][document_id],
+                        token,
+                    )
+                )
+            }
+
+            if not requests:
+                continue
+
+            collection = document_cls.get_motor_collection()
+            invalidate = getattr(document_cls, "_invalidate_ids", None)
+
+            try:
+                result = await collection.bulk_write(
+                    list(requests.values()), ordered=False
+                )
+            finally:
+                if invalidate is not None:
+                    invalidate(document_ids)
+
+            if result.matched_count < len(requests):
+                written = {
+                    document["_id"]
+                    async for document in collection.find(
+                        {
+                            "_id": {"$in": list(requests)},
+                            BULK_TOKEN_FIELD: token,
+                        },
+                        projection={"_id": True},
+                    )
+                }
+                rejected.update(requests.keys() - written)
+
+        for document, field, amount in applied:
+            if document.id in rejected:
+                setattr(document, field, getattr(document, field) - amount)
+
+        if ledger := [
+            transaction
+            for transaction in ledger
+            if transaction.source not in rejected
+            and transaction.destination not in rejected
+        ]:
+            now = datetime.now(timezone.utc)
+
+            for transaction in ledger:
+                transaction.timestamp = now
+
+            await Transaction.insert_many(ledger)
+
+        if rejected:
+            self.rejected = True
+            self.rejected_ids |= rejected
+            raise ValueError("Some batched updates were rejected")
+
+
+def _updates(
+    factory: Callable[[], dict[str, Any]]
+) -> defaultdict[type[Document], defaultdict[PydanticObjectId, Any]]:
+    return defaultdict(lambda: defaultdict(factory))
+
+
+def _update_request(
+    document_id: PydanticObjectId,
+    increments: dict[str, int],
+    values: dict[str, Any],
+    token: ObjectId,
+) -> Optional[UpdateOne]:
+    """Build the update for a document, guarding its balance if it's
+    being decreased."""
+    query: dict[str, Any] = {"_id": document_id}
+    update: dict[str, Any] = {}
+
+    if increments := {
+        field: amount for field, amount in increments.items() if amount
+    }:
+        update["$inc"] = increments
+
+        if increments.get("balance", 0) < 0:
+            query["balance"] = {"$gte": -increments["balance"]}
+
+    if not (increments or values):
+        return None
+
+    update["$set"] = {**values, BULK_TOKEN_FIELD: token}
+
+    return UpdateOne(query, update)
+
+
+def current_batch() -> Optional[Batch]:
+    """Get the batch the current task is writing to, if any."""
+    return _current.get()
+
+
+@contextmanager
+def outside_batch() -> Iterator[None]:
+    """Write straight away within the block, even inside a batch."""
+    token = _current.set(None)
+
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@asynccontextmanager
+async def batch(max_delay: Optional[float] = None) -> AsyncIterator[Batch]:
+    """Buffer balance changes and field updates, writing them when the
+    block exits.
+
+    Within the block, balance changes and updates like name changes are
+    applied to the documents in memory and queued instead of written.
+    Repeated changes to a document are combined, then written as $inc
+    and $set updates with one bulk write per collection. Balances are
+    checked against the documents in memory when changed, and again on
+    the server when written. The ledger only records the changes that
+    were written, and rejected changes are undone in memory.
+
+    Writes inside the block don't use transactions, so a batch trades
+    atomicity for throughput. Transfers between documents, like pool
+    contributions and ticket purchases, would have their legs checked
+    separately, so they write the pending updates and then run straight
+    away, in a transaction where supported. Nested batches share the
+    outermost one.
+
+    Args:
+        max_delay (float, optional): The longest time, in seconds,
+            updates can wait before being written in the background.
+            Defaults to only writing when the block exits.
+
+    Raises:
+        ValueError: If a queued update was rejected when written.
+
+    Yields:
+        Batch: The pending updates.
+    """
+    if (pending := _current.get()) is not None:
+        yield pending
+        return
+
+    pending = Batch()
+    token = _current.set(pending)
+    task = None
+
+    if max_delay is not None:
+        task = asyncio.create_task(_flush_periodically(pending, max_delay))
+
+    try:
+        yield pending
+    finally:
+        _current.reset(token)
+
+        try:
+            if task is not None:
+                task.cancel()
+
+                with suppress(asyncio.CancelledError):
+                    await task
+        finally:
+            await pending.flush()
+
+    if pending.rejected:
+        raise ValueError("Some batched updates were rejected")
+
+
+async def _flush_periodically(pending: Batch, delay: float) -> None:
+    while True:
+        await asyncio.sleep(delay)
+
+        with suppress(ValueError):
+            await pending.flush()
+
+
+async def save_fields(document: Document, **fields: Any) -> None:
+    """Set fields on a document and write only those fields, or queue
+    them if a batch is active.
+
+    Other fields, like a balance changed elsewhere since the document
+    was read, are left as stored. Documents that haven't been inserted
+    yet are inserted whole.
+
+    Args:
+        document (Document): The document to update.
+        **fields: The new values of the fields.
+    """
+    for field, value in fields.items():
+        setattr(document, field, value)
+
+    if document.id is None:
+        await document.insert()
+        return
+
+    values = Encoder().encode(fields)
+
+    if (pending := _current.get()) is None:
+        await document.get_motor_collection().update_one(
+            {"_id": document.id}, {"$set": values}
+        )
+        return
+
+    for field, value in values.items():
+        pending.set(type(document), document.id, field, value)
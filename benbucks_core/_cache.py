@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any, NamedTuple, Optional
+
+
+class CacheInfo(NamedTuple):
+    """Statistics for a cache."""
+
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class TTLCache:
+    """A least-recently-used cache whose entries expire after a time.
+
+    Attributes:
+        maxsize (int): The maximum number of entries to keep.
+        ttl (float): How many seconds entries stay valid for.
+        hits (int): The number of lookups that found an entry.
+        misses (int): The number of lookups that didn't.
+        version (int): A counter bumped by every invalidation.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get an entry, if it exists and hasn't expired."""
+        entry = self._entries.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, version: int) -> None:
+        """Store an entry read while the cache was at a given version.
+
+        The entry is dropped if anything was invalidated since then, as
+        the value may have been read before that write.
+        """
+        if version != self.version:
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        """Remove an entry."""
+        self.version += 1
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove every entry."""
+        self.version += 1
+        self._entries.clear()
+
+    def info(self) -> CacheInfo:
+        """Get statistics for the cache."""
+        return CacheInfo(
+            self.hits, self.misses, self.maxsize, len(self._entries)
+        )
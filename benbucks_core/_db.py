@@ -0,0 +1,328 @@
+import asyncio
+from typing import Any, Optional
+
+from beanie import init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo.errors import DuplicateKeyError
+
+from ._utils import to_cents
+from .instrumentation import command_listener
+from .lottery import Lottery
+from .pool import Pool
+from .snapshot import BalanceSnapshot
+from .transaction import Transaction
+from .trivia import TriviaQuestion
+from .user import User
+
+DEFAULT_URI = "mongodb://localhost:27017"
+CLIENT_OPTIONS = {
+    "maxPoolSize": 100,
+    "minPoolSize": 10,
+    "connectTimeoutMS": 5000,
+    "serverSelectionTimeoutMS": 5000,
+    "socketTimeoutMS": 30000,
+    "retryWrites": True,
+    "retryReads": True,
+    "w": "majority",
+    "readConcernLevel": "majority",
+}
+DOCUMENT_MODELS = [
+    BalanceSnapshot,
+    Lottery,
+    Pool,
+    Transaction,
+    TriviaQuestion,
+    User,
+]
+# The amounts stored before they were integer cents. Amounts nested in
+# lists, like pool increases, are never changed with $inc, so they're
+# converted when loaded instead.
+MONEY_FIELDS = {
+    Lottery: ("prize", "ticket_price", "prize_increase"),
+    Pool: ("balance",),
+    TriviaQuestion: ("first_prize",),
+    User: ("balance",),
+}
+
+_clients: dict[str, AsyncIOMotorClient] = {}
+_bound: Optional[tuple[AsyncIOMotorClient, str]] = None
+
+
+def get_client(uri: str = DEFAULT_URI, **options: Any) -> AsyncIOMotorClient:
+    """Get a shared client for a MongoDB deployment, creating it with
+    tuned pool, timeout and concern settings the first time.
+
+    One client, and so one connection pool, is shared by every database
+    on the deployment. The client counts commands for instrumentation.
+
+    Args:
+        uri (str, optional): The connection string. Defaults to
+            DEFAULT_URI.
+        **options: Options overriding CLIENT_OPTIONS, only used when the
+            client is created.
+
+    Returns:
+        AsyncIOMotorClient: The client.
+    """
+    if uri not in _clients:
+        _clients[uri] = AsyncIOMotorClient(
+            uri,
+            event_listeners=[command_listener],
+            **{**CLIENT_OPTIONS, **options},
+        )
+
+    return _clients[uri]
+
+
+async def init_db(
+    client: Optional[AsyncIOMotorClient] = None,
+    env: str = "prod",
+    warm_up_connections: int = 0,
+) -> AsyncIOMotorClient:
+    """Initialize the database.
+
+    Calling this again with the same client and environment does
+    nothing. Models are bound to one database for the whole process,
+    so concurrent requests can't use different environments. Run a
+    process for each environment instead. Initializing another one
+    raises an error until close_db is called.
+
+    Transfers like pool contributions and ticket purchases only run in
+    transactions on a replica set or sharded cluster. A standalone
+    server, like the one at DEFAULT_URI in development, runs them
+    without one, so deploy a replica set, even a single-member one, in
+    production.
+
+    Pools sharing a code, which older versions could create, stop the
+    unique index on codes from being built, so they must be merged
+    with merge_duplicate_pools first.
+
+    Balances and prizes are changed with $inc, which would mix cents
+    into amounts older versions stored as floats in whole units, so the
+    database isn't initialized until they're converted with
+    migrate_money.
+
+    Args:
+        client (AsyncIOMotorClient, optional): The client to use, which
+            can be any client with Motor's API. Defaults to the shared
+            client for DEFAULT_URI.
+        env (str, optional): The name of the database. Defaults to
+            "prod".
+        warm_up_connections (int, optional): The number of connections
+            to open before returning, so the first requests don't wait
+            for them. Defaults to 0.
+
+    Raises:
+        RuntimeError: If another database is already initialized,
+            amounts are still stored as floats, or pools share a code.
+
+    Returns:
+        AsyncIOMotorClient: The client.
+    """
+    global _bound
+
+    if client is None:
+        client = get_client()
+
+    if _bound is not None and (_bound[0] is not client or _bound[1] != env):
+        raise RuntimeError(
+            "Another database is already initialized, call close_db first"
+        )
+
+    if _bound is None:
+        if await _has_float_money(client[env]):
+            raise RuntimeError(
+                "Some amounts are stored as floats, run migrate_money first"
+            )
+
+        Pool.clear_cache()
+
+        try:
+            await init_beanie(
+                document_models=DOCUMENT_MODELS, database=client[env]
+            )
+        except DuplicateKeyError as error:
+            raise RuntimeError(
+                "Some pools share a code, run merge_duplicate_pools first"
+            ) from error
+
+        _bound = (client, env)
+
+    if warm_up_connections:
+        await _warm_up(client, warm_up_connections)
+
+    return client
+
+
+async def _has_float_money(database: AsyncIOMotorDatabase) -> bool:
+    """Check whether any document still stores an amount as a float."""
+    for model, fields in MONEY_FIELDS.items():
+        if await database[model.__name__].find_one(
+            _float_money_query(fields), projection={"_id": True}
+        ):
+            return True
+
+    return False
+
+
+def _float_money_query(fields: tuple[str, ...]) -> dict:
+    return {"$or": [{field: {"$type": "double"}} for field in fields]}
+
+
+async def _warm_up(client: AsyncIOMotorClient, connections: int) -> None:
+    """Open connections ahead of time by pinging concurrently.
+
+    Args:
+        client (AsyncIOMotorClient): The client to warm up.
+        connections (int): The number of connections to open.
+    """
+    await asyncio.gather(
+        *(client.admin.command("ping") for _ in range(connections))
+    )
+
+
+def close_db() -> None:
+    """Close every shared client and forget the initialized database,
+    so another one can be initialized.
+
+    Await Transaction.flush first, so buffered ledger transactions are
+    inserted before the clients close.
+    """
+    global _bound
+
+    for client in _clients.values():
+        client.close()
+
+    _clients.clear()
+    _bound = None
+
+
+async def init_memory_db(env: str = "prod") -> AsyncIOMotorClient:
+    """Initialize a new in-memory database, as a stand-in for tests.
+
+    The database is mongomock, which runs in the same process with the
+    same API, so tests don't need a MongoDB server. It isn't built for
+    speed: it has no indexes, so most operations scan their whole
+    collection and get slower as it grows, and a large simulation runs
+    faster against a local mongod. Transactions aren't supported, so
+    writes that would share a transaction are applied one by one.
+
+    Requires mongomock-motor, which is installed with the memory extra.
+    Like init_db, call close_db before initializing another database.
+
+    Args:
+        env (str, optional): The name of the database. Defaults to
+            "prod".
+
+    Raises:
+        ImportError: If mongomock-motor isn't installed.
+        RuntimeError: If another database is already initialized.
+
+    Returns:
+        AsyncIOMotorClient: The in-memory client.
+    """
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError as error:
+        raise ImportError(
+            "The in-memory database requires mongomock-motor, "
+            "install benbucks-core[memory]"
+        ) from error
+
+    client = AsyncMongoMockClient()
+    await init_db(client, env)
+
+    return client
+
+
+async def migrate_money(database: AsyncIOMotorDatabase) -> int:
+    """Convert amounts still stored as floats in whole units to cents.
+
+    This works on the raw collections, so it can run before init_db,
+    which won't initialize a database with float amounts. Each amount
+    is only replaced if it hasn't changed since it was read.
+
+    Args:
+        database (AsyncIOMotorDatabase): The database to migrate.
+
+    Returns:
+        int: The number of documents migrated.
+    """
+    migrated = 0
+
+    for model, fields in MONEY_FIELDS.items():
+        collection = database[model.__name__]
+        cursor = collection.find(
+            _float_money_query(fields), projection=dict.fromkeys(fields, True)
+        )
+
+        async for document in cursor:
+            floats = {
+                field: document[field]
+                for field in fields
+                if isinstance(document.get(field), float)
+            }
+            result = await collection.update_one(
+                {"_id": document["_id"], **floats},
+                {
+                    "$set": {
+                        field: to_cents(amount)
+                        for field, amount in floats.items()
+                    }
+                },
+            )
+            migrated += result.modified_count
+
+    return migrated
+
+
+async def merge_duplicate_pools(database: AsyncIOMotorDatabase) -> int:
+    """Merge pools sharing a code into the oldest of them.
+
+    The oldest pool gets the sum of their balances and the ledger is
+    pointed at it. Snapshots of the merged pools are deleted, to be
+    taken again from the ledger. This deletes documents, so it's only
+    run when called. It works on the raw collections, so it can run
+    before init_db, which won't initialize a database with pools
+    sharing a code.
+
+    Args:
+        database (AsyncIOMotorDatabase): The database to migrate.
+
+    Returns:
+        int: The number of duplicate pools removed.
+    """
+    pools = database[Pool.__name__]
+    ledger = database[Transaction.__name__]
+    snapshots = database[BalanceSnapshot.__name__]
+    removed = 0
+
+    async for group in pools.aggregate(
+        [
+            {"$sort": {"_id": 1}},
+            {
+                "$group": {
+                    "_id": "$code",
+                    "ids": {"$push": "$_id"},
+                    "balance": {"$sum": "$balance"},
+                }
+            },
+            {"$match": {"ids.1": {"$exists": True}}},
+        ]
+    ):
+        kept, *duplicates = group["ids"]
+
+        await pools.update_one(
+            {"_id": kept}, {"$set": {"balance": group["balance"]}}
+        )
+
+        for field in ("source", "destination"):
+            await ledger.update_many(
+                {field: {"$in": duplicates}}, {"$set": {field: kept}}
+            )
+
+        await snapshots.delete_many({"account": {"$in": group["ids"]}})
+        await pools.delete_many({"_id": {"$in": duplicates}})
+        removed += len(duplicates)
+
+    return removed
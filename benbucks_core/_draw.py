@@ -0,0 +1,135 @@
+import hashlib
+import hmac
+from collections.abc import Sequence
+
+
+class FenwickTree:
+    """A Fenwick tree over integer weights, for weighted sampling.
+
+    Finding the item a ticket number falls on and changing a weight
+    both take O(log n) time.
+    """
+
+    def __init__(self, weights: Sequence[int]):
+        self._size = len(weights)
+        self._tree = [0, *weights]
+        self.total = sum(weights)
+
+        for index in range(1, self._size + 1):
+            parent = index + (index & -index)
+
+            if parent <= self._size:
+                self._tree[parent] += self._tree[index]
+
+    def add(self, index: int, amount: int) -> None:
+        """Change the weight of an item by a given amount."""
+        self.total += amount
+        index += 1
+
+        while index <= self._size:
+            self._tree[index] += amount
+            index += index & -index
+
+    def find(self, ticket: int) -> int:
+        """Find the item a ticket number between 0 and the total weight
+        falls on."""
+        index = 0
+        step = 1 << self._size.bit_length()
+
+        while step:
+            next_index = index + step
+
+            if next_index <= self._size and self._tree[next_index] <= ticket:
+                index = next_index
+                ticket -= self._tree[index]
+
+            step >>= 1
+
+        return index
+
+
+class SeededRandom:
+    """Uniform random integers derived from a seed with HMAC-SHA256.
+
+    The same seed always gives the same numbers, so a draw made with a
+    seed from ``secrets`` can be replayed to audit it.
+    """
+
+    def __init__(self, seed: bytes):
+        self._seed = seed
+        self._counter = 0
+
+    def _bytes(self, count: int) -> bytes:
+        output = b""
+
+        while len(output) < count:
+            output += hmac.digest(
+                self._seed, self._counter.to_bytes(8, "big"), hashlib.sha256
+            )
+            self._counter += 1
+
+        return output[:count]
+
+    def randbelow(self, limit: int) -> int:
+        """Get a random integer from 0 up to but not including a
+        limit."""
+        bits = limit.bit_length()
+        size = (bits + 7) // 8
+
+        while True:
+            value = int.from_bytes(self._bytes(size), "big") >> (
+                size * 8 - bits
+            )
+
+            if value < limit:
+                return value
+
+
+def draw(
+    weights: Sequence[int], count: int, replace: bool, seed: bytes
+) -> list[int]:
+    """Draw items with probability proportional to their weights.
+
+    Args:
+        weights (Sequence[int]): The weight of each item.
+        count (int): The number of items to draw.
+        replace (bool): Whether an item can be drawn more than once.
+        seed (bytes): The seed for the random numbers.
+
+    Returns:
+        list[int]: The indexes of the drawn items, in draw order. There
+            are fewer than count if the items run out.
+    """
+    tree = FenwickTree(weights)
+    random = SeededRandom(seed)
+    drawn = []
+
+    while len(drawn) < count and tree.total:
+        index = tree.find(random.randbelow(tree.total))
+        drawn.append(index)
+
+        if not replace:
+            tree.add(index, -weights[index])
+
+    return drawn
+
+
+def split_prize(prize: int, shares: Sequence[int]) -> list[int]:
+    """Split a prize into parts proportional to shares.
+
+    Any cents left over from rounding down go to the first part.
+
+    Args:
+        prize (int): The prize, in cents.
+        shares (Sequence[int]): The relative share of each part.
+
+    Returns:
+        list[int]: The parts, in cents.
+    """
+    total = sum(shares)
+    parts = [prize * share // total for share in shares]
+
+    if parts:
+        parts[0] += prize - sum(parts)
+
+    return parts
@@ -0,0 +1,84 @@
+from collections.abc import Awaitable, Callable
+from contextlib import suppress
+from typing import Optional, TypeVar
+from weakref import finalize
+
+from beanie import Document
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorClientSession
+
+from ._batch import current_batch, outside_batch
+
+T = TypeVar("T")
+
+_transaction_support: dict[int, bool] = {}
+
+
+async def run_in_transaction(
+    document_cls: type[Document],
+    callback: Callable[[Optional[AsyncIOMotorClientSession]], Awaitable[T]],
+) -> T:
+    """Run a callback's writes in a single MongoDB transaction.
+
+    The transaction is committed when the callback returns and aborted
+    if it raises. Like in Motor's with_transaction, the whole callback
+    is retried when a write or the commit fails with a transient error,
+    such as a write conflict with a concurrent transaction, and the
+    commit is retried when its result is unknown. So the callback must
+    be safe to run more than once, only changing documents in memory to
+    values read back from the server.
+
+    MongoDB only supports transactions on replica sets and sharded
+    clusters, so on a standalone server or a client without session
+    support, like mongomock, the callback gets None and its writes run
+    without a transaction. Changes to several documents are only
+    atomic on a replica set, which can have a single member.
+
+    Inside a batch, its pending updates are written first, then the
+    callback's writes are made straight away instead of being queued,
+    so a debit rejected when the batch is written can't leave its
+    credit applied.
+
+    Args:
+        document_cls (type[Document]): A model whose client should run
+            the transaction.
+        callback (Callable[[AsyncIOMotorClientSession], Awaitable]):
+            The function making the writes, given the session to pass
+            to each of them, or None if sessions aren't supported.
+
+    Returns:
+        The callback's result.
+    """
+    if (pending := current_batch()) is not None:
+        # Rejected updates are raised when the batch exits
+        with suppress(ValueError):
+            await pending.flush()
+
+        with outside_batch():
+            return await run_in_transaction(document_cls, callback)
+
+    client = document_cls.get_motor_collection().database.client
+
+    if not await _supports_transactions(client):
+        return await callback(None)
+
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
+
+
+async def _supports_transactions(client: AsyncIOMotorClient) -> bool:
+    """Check once per client whether it's connected to a replica set or
+    a sharded cluster."""
+    key = id(client)
+
+    if key not in _transaction_support:
+        try:
+            hello = await client.admin.command("hello")
+        except NotImplementedError:
+            hello = {}
+
+        _transaction_support[key] = (
+            "setName" in hello or hello.get("msg") == "isdbgrid"
+        )
+        finalize(client, _transaction_support.pop, key, None)
+
+    return _transaction_support[key]
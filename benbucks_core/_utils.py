@@ -1,6 +1,52 @@
+from collections.abc import Callable, Iterator
+
 CURRENCY_SYMBOL = "\u20bf"
+CENTS_PER_UNIT = 100
+
+
+class Money(int):
+    """An amount of currency, stored as a whole number of cents.
+
+    Documents written before amounts were stored in cents hold floats
+    in whole units, so floats are converted to cents when validated.
+    """
+
+    @classmethod
+    def __get_validators__(cls) -> Iterator[Callable[[object], int]]:
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value: object) -> int:
+        """Validate an amount of cents, converting legacy floats."""
+        if isinstance(value, float):
+            return to_cents(value)
+
+        check_cents(value)
+
+        return value
+
+
+def check_cents(amount: object) -> None:
+    """Check that an amount is a whole number of cents.
+
+    Amounts are added to stored balances with $inc, which would store a
+    float as is, so callers still passing whole units are rejected.
+
+    Raises:
+        TypeError: If the amount isn't an integer.
+    """
+    if isinstance(amount, bool) or not isinstance(amount, int):
+        raise TypeError("Amount must be an integer number of cents")
+
+
+def to_cents(amount: float) -> int:
+    """Convert an amount in whole units to cents."""
+    return round(amount * CENTS_PER_UNIT)
+
 
+def format_money(amount: int) -> str:
+    """Format an amount of cents as a string."""
+    units, cents = divmod(abs(amount), CENTS_PER_UNIT)
+    sign = "-" if amount < 0 else ""
 
-def format_money(amount: float) -> str:
-    """Format a currency amount as a string."""
-    return f"{CURRENCY_SYMBOL}{round(amount, 2):.2f}"
+    return f"{CURRENCY_SYMBOL}{sign}{units}.{cents:02d}"
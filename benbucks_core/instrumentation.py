@@ -0,0 +1,158 @@
+import functools
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from contextvars import ContextVar
+from typing import Any, NamedTuple, Optional, ParamSpec, TypeVar
+
+import bson
+from beanie import Document
+from beanie.odm.utils.encoder import Encoder
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+_hook: Optional[Callable[["Operation"], None]] = None
+_slow_threshold: Optional[float] = None
+_enabled = False
+_counters: ContextVar[tuple[list[int], ...]] = ContextVar(
+    "counters", default=()
+)
+
+
+class Operation(NamedTuple):
+    """Measurements from a single call to an instrumented method.
+
+    Attributes:
+        name (str): The qualified name of the method, such as
+            "User.change_balance".
+        duration (float): How long the call took, in seconds.
+        db_calls (int): The number of database commands sent during the
+            call, including by nested operations. Only counted when
+            command_listener is registered with the client.
+        document_size (int): The BSON size of the document the method
+            was called on, in bytes, or 0 for class methods.
+        slow (bool): Whether the call took at least the slow threshold.
+        failed (bool): Whether the call raised an exception.
+    """
+
+    name: str
+    duration: float
+    db_calls: int
+    document_size: int
+    slow: bool
+    failed: bool
+
+
+class _CommandCounter(monitoring.CommandListener):
+    """Counts commands sent for each running operation."""
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        for counter in _counters.get():
+            counter[0] += 1
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        pass
+
+
+command_listener = _CommandCounter()
+"""The listener counting database calls, which must be passed to the
+client with ``event_listeners=[command_listener]``."""
+
+
+def configure(
+    hook: Optional[Callable[[Operation], None]] = None,
+    slow_threshold: Optional[float] = None,
+) -> None:
+    """Configure instrumentation for model operations.
+
+    Instrumentation is disabled when neither a hook nor a slow threshold
+    is given, which is the default, and instrumented methods then only
+    pay for a single check.
+
+    Args:
+        hook (Callable[[Operation], None], optional): Called with the
+            measurements of every operation, such as to record them in
+            a metrics registry. Defaults to None.
+        slow_threshold (float, optional): The duration, in seconds, at
+            or above which an operation is logged as slow. Defaults to
+            None.
+    """
+    global _hook, _slow_threshold, _enabled
+
+    _hook = hook
+    _slow_threshold = slow_threshold
+    _enabled = hook is not None or slow_threshold is not None
+
+
+def instrumented(
+    method: Callable[P, Awaitable[T]]
+) -> Callable[P, Awaitable[T]]:
+    """Measure each call to an async method when instrumentation is
+    enabled.
+
+    Args:
+        method (Callable): The method to instrument.
+
+    Returns:
+        Callable: The instrumented method.
+    """
+    name = method.__qualname__
+
+    @functools.wraps(method)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+        if not _enabled:
+            return await method(*args, **kwargs)
+
+        counter = [0]
+        token = _counters.set((*_counters.get(), counter))
+        failed = True
+        start = time.perf_counter()
+
+        try:
+            result = await method(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            duration = time.perf_counter() - start
+            _counters.reset(token)
+            _report(name, duration, counter[0], args, failed)
+
+    return wrapper
+
+
+def _report(
+    name: str,
+    duration: float,
+    db_calls: int,
+    args: tuple[Any, ...],
+    failed: bool,
+) -> None:
+    slow = _slow_threshold is not None and duration >= _slow_threshold
+
+    if slow:
+        logger.warning(
+            "Slow operation %s took %.3fs with %d database calls",
+            name,
+            duration,
+            db_calls,
+        )
+
+    if _hook is None:
+        return
+
+    document_size = 0
+
+    if args and isinstance(args[0], Document):
+        document_size = len(bson.encode(Encoder().encode(args[0])))
+
+    try:
+        _hook(Operation(name, duration, db_calls, document_size, slow, failed))
+    except Exception:
+        logger.exception("Instrumentation hook failed for %s", name)
@@ -1,8 +1,18 @@
 import secrets
-from typing import Optional
+from collections import Counter
+from collections.abc import Iterable, Sequence
+from typing import Any, Optional
 
-from beanie import Document
+from beanie import Document, PydanticObjectId
+from beanie.operators import In
+from motor.motor_asyncio import AsyncIOMotorClientSession
+from pydantic import validator
+from pymongo import ReturnDocument
 
+from ._draw import draw, split_prize
+from ._session import run_in_transaction
+from ._utils import Money, check_cents
+from .instrumentation import instrumented
 from .pool import Pool
 from .user import User
 
@@ -12,50 +22,163 @@ class Lottery(Document):
 
     Attributes:
         name (str): The name of the lottery.
-        prize (float): The prize for the lottery.
-        ticket_price (float): The price of each ticket.
-        prize_increase (float, optional): The amount the prize
-            increases by each time a ticket is bought. Defaults to 0.
-        pool_increases (list, optional): A list containing tuples, each
-            containing a Pool and the amount it increases by each time a
-            ticket is bought. Defaults to an empty set.
-        tickets (list[User], optional): The users who have bought
-            tickets. Defaults to an empty list.
-        winner (User, optional): The winner of the lottery. Defaults to
-            None.
+        prize (int): The prize for the lottery, in cents.
+        ticket_price (int): The price of each ticket, in cents.
+        prize_increase (int, optional): The amount the prize increases
+            by each time a ticket is bought, in cents. Defaults to 0.
+        pool_increases (list[tuple[str, int]], optional): A list
+            containing tuples, each containing a pool code and the
+            amount the pool increases by each time a ticket is bought,
+            in cents. Pools are converted to their codes. Defaults to an
+            empty list.
+        tickets (dict[str, int], optional): The number of tickets
+            bought by each user, keyed by user ID. Defaults to an empty
+            dict.
+        ticket_count (int, optional): The total number of tickets
+            bought. Defaults to the sum of the ticket counts.
+        winner (User, optional): The first place winner of the
+            lottery. Defaults to None.
+        winners (list[User], optional): The winners of the lottery, in
+            place order. Defaults to an empty list.
+        draw_seed (str, optional): The hex seed the winners were drawn
+            with, for auditing. Defaults to None.
         completed (bool, optional): Whether the lottery has been
             completed. Defaults to False.
     """
 
     name: str
-    prize: float
-    ticket_price: float
-    prize_increase: float = 0
-    pool_increases: list[tuple[Pool, float]] = []
-    tickets: list[User] = []
+    prize: Money
+    ticket_price: Money
+    prize_increase: Money = 0
+    pool_increases: list[tuple[str, Money]] = []
+    tickets: dict[str, int] = {}
+    ticket_count: int = 0
     winner: Optional[User] = None
+    winners: list[User] = []
+    draw_seed: Optional[str] = None
     completed: bool = False
 
-    async def change_prize(self, amount: float) -> float:
+    class Settings:
+        indexes = ["completed"]
+
+    @validator("tickets", pre=True)
+    def _count_legacy_tickets(cls, value: Any) -> Any:
+        """Convert a legacy list of embedded users to ticket counts."""
+        if not isinstance(value, list):
+            return value
+
+        return dict(
+            Counter(
+                str(user.id if isinstance(user, User) else user["_id"])
+                for user in value
+            )
+        )
+
+    @validator("pool_increases", pre=True)
+    def _reference_pools(cls, value: Any) -> Any:
+        """Convert pools, or legacy embedded pools, to their codes."""
+        if not isinstance(value, list):
+            return value
+
+        references = []
+
+        for pool, increase in value:
+            if isinstance(pool, Pool):
+                pool = pool.code
+            elif isinstance(pool, dict):
+                pool = pool["code"]
+
+            references.append((pool, increase))
+
+        return references
+
+    @validator("ticket_count", always=True)
+    def _total_tickets(cls, value: int, values: dict[str, Any]) -> int:
+        """Fill in the total number of tickets if it is missing."""
+        return value or sum(values.get("tickets", {}).values())
+
+    @classmethod
+    async def migrate_tickets(cls) -> int:
+        """Rewrite lotteries still storing tickets as embedded users.
+
+        Returns:
+            int: The number of lotteries migrated.
+        """
+        migrated = 0
+
+        async for lottery in cls.find({"tickets": {"$type": "array"}}):
+            await lottery.save()
+            migrated += 1
+
+        return migrated
+
+    @classmethod
+    async def migrate_pool_increases(cls) -> int:
+        """Rewrite lotteries still storing pool increases as embedded
+        pools.
+
+        Returns:
+            int: The number of lotteries migrated.
+        """
+        migrated = 0
+
+        async for lottery in cls.find(
+            {"pool_increases": {"$elemMatch": {"0": {"$type": "object"}}}}
+        ):
+            await lottery.save()
+            migrated += 1
+
+        return migrated
+
+    @instrumented
+    async def change_prize(self, amount: int) -> int:
         """Change the prize by a given amount.
 
+        The change is applied with an atomic conditional $inc, so
+        concurrent ticket purchases and prize changes are never lost.
+
         Args:
-            amount (float): The amount to change the prize by.
+            amount (int): The amount to change the prize by, in cents.
 
         Raises:
-            ValueError: If the prize would be made negative.
+            TypeError: If the amount isn't an integer number of cents.
+            ValueError: If the prize would be made negative or the
+                lottery has been completed.
 
         Returns:
-            float: The new prize.
+            int: The new prize, in cents.
         """
+        check_cents(amount)
+
+        if self.completed:
+            raise ValueError("Lottery is already completed")
+
         if self.prize + amount < 0:
             raise ValueError("Prize cannot be negative")
 
-        self.prize += amount
-        await self.save()
+        if self.id is None:
+            self.prize += amount
+            await self.insert()
+
+            return self.prize
+
+        result = await self.get_motor_collection().find_one_and_update(
+            {"_id": self.id, "completed": False, "prize": {"$gte": -amount}},
+            {"$inc": {"prize": amount}},
+            projection={"prize": True},
+            return_document=ReturnDocument.AFTER,
+        )
+
+        if result is None:
+            raise ValueError(
+                "Prize cannot be negative or lottery is already completed"
+            )
+
+        self.prize = result["prize"]
 
         return self.prize
 
+    @instrumented
     async def buy_ticket(self, user: User) -> None:
         """Buy a ticket for the lottery.
 
@@ -63,40 +186,437 @@ class Lottery(Document):
             user (User): The user buying the ticket.
 
         Raises:
-            ValueError: If the user doesn't have enough money.
+            ValueError: If the user doesn't have enough money or the
+                lottery has been completed.
+        """
+        await self.buy_tickets(user, 1)
+
+    @instrumented
+    async def buy_tickets(self, user: User, quantity: int) -> None:
+        """Buy several tickets for the lottery at once.
+
+        The user is debited once, the tickets and prize increase are
+        applied with a single atomic $inc, so concurrent purchases are
+        never lost, and every pool increase is applied with a single
+        bulk write. Every write happens in a single transaction, which
+        is retried if it conflicts with another, and without one the
+        user is refunded if the lottery turns out to have been
+        completed.
+
+        Args:
+            user (User): The user buying the tickets.
+            quantity (int): The number of tickets to buy.
+
+        Raises:
+            ValueError: If the quantity isn't positive, the user doesn't
+                have enough money, the lottery has been completed, or a
+                pool was deleted.
         """
-        if user.balance < self.ticket_price:
+        if quantity < 1:
+            raise ValueError("Quantity must be positive")
+
+        if self.completed:
+            raise ValueError("Lottery is already completed")
+
+        cost = self.ticket_price * quantity
+
+        if user.balance < cost:
             raise ValueError("Not enough money")
 
-        await user.change_balance(-self.ticket_price)
-        self.tickets.append(user)
+        await self._insert_first(user)
 
-        self.prize += self.prize_increase
+        async def buy(session: Optional[AsyncIOMotorClientSession]) -> None:
+            await user.change_balance(-cost, session, "Lottery ticket")
 
-        for pool, increase in self.pool_increases:
-            pool.balance += increase
-            await pool.save()
+            try:
+                await self._add_tickets({str(user.id): quantity}, session)
+            except ValueError:
+                await user.change_balance(cost, session, "Ticket refund")
+                raise
 
-        await self.save()
+            if self.pool_increases:
+                await self._increase_pools(quantity, session)
 
-    async def complete(self) -> Optional[User]:
-        """Complete the lottery.
+        await run_in_transaction(Lottery, buy)
+
+    @instrumented
+    async def bulk_buy_tickets(
+        self, purchases: Iterable[tuple[PydanticObjectId, int]]
+    ) -> list[PydanticObjectId]:
+        """Buy tickets for many users at once.
+
+        Purchases by the same user are combined. Every buyer is debited
+        with a single bulk write, then the tickets bought by users who
+        could pay are applied with a single atomic $inc, like in
+        buy_tickets. Every write happens in a single transaction, which
+        is retried if it conflicts with another, and without one the
+        buyers are refunded if the lottery turns out to have been
+        completed.
+
+        Args:
+            purchases (Iterable[tuple[PydanticObjectId, int]]): Pairs of
+                user IDs and the number of tickets they're buying.
+
+        Raises:
+            ValueError: If a quantity isn't positive, the lottery has
+                been completed, or a pool was deleted.
 
         Returns:
-            User: The winner of the lottery, if any tickets were bought.
+            list[PydanticObjectId]: The IDs of users who didn't buy any
+                tickets, because they don't exist or don't have enough
+                money.
+        """
+        quantities: dict[PydanticObjectId, int] = {}
+
+        for user_id, quantity in purchases:
+            if quantity < 1:
+                raise ValueError("Quantity must be positive")
+
+            quantities[user_id] = quantities.get(user_id, 0) + quantity
+
+        if self.completed:
+            raise ValueError("Lottery is already completed")
+
+        if not quantities:
+            return []
+
+        await self._insert_first()
+
+        async def buy(
+            session: Optional[AsyncIOMotorClientSession],
+        ) -> list[PydanticObjectId]:
+            failed = await User.bulk_change_balances(
+                [
+                    (user_id, -self.ticket_price * quantity)
+                    for user_id, quantity in quantities.items()
+                ],
+                "Lottery ticket",
+                session,
+            )
+
+            rejected = set(failed)
+            bought = {
+                str(user_id): quantity
+                for user_id, quantity in quantities.items()
+                if user_id not in rejected
+            }
+
+            if bought:
+                try:
+                    await self._add_tickets(bought, session)
+                except ValueError:
+                    await User.bulk_change_balances(
+                        [
+                            (user_id, self.ticket_price * quantities[user_id])
+                            for user_id in quantities
+                            if user_id not in rejected
+                        ],
+                        "Ticket refund",
+                        session,
+                    )
+                    raise
+
+                if self.pool_increases:
+                    await self._increase_pools(sum(bought.values()), session)
+
+            return failed
+
+        return await run_in_transaction(Lottery, buy)
+
+    @instrumented
+    async def add_paid_tickets(
+        self, purchases: Iterable[tuple[PydanticObjectId, int]]
+    ) -> None:
+        """Add tickets that have already been paid for, such as by a
+        ShardWorker debiting each buyer through the worker owning them.
+
+        Purchases by the same user are combined, then applied with a
+        single atomic $inc like in buy_tickets, along with the pool
+        increases, in a single transaction. If the lottery has been
+        completed no tickets are added, so the buyers must be refunded.
+
+        Args:
+            purchases (Iterable[tuple[PydanticObjectId, int]]): Pairs of
+                user IDs and the number of tickets they paid for.
+
+        Raises:
+            TypeError: If a quantity isn't an integer.
+            ValueError: If a quantity isn't positive, the lottery has
+                been completed, or a pool was deleted.
+        """
+        quantities: dict[str, int] = {}
+
+        for user_id, quantity in purchases:
+            if quantity < 1:
+                raise ValueError("Quantity must be positive")
+
+            quantities[str(user_id)] = (
+                quantities.get(str(user_id), 0) + quantity
+            )
+
+        if self.completed:
+            raise ValueError("Lottery is already completed")
+
+        if not quantities:
+            return
+
+        await self._insert_first()
+
+        async def add(session: Optional[AsyncIOMotorClientSession]) -> None:
+            await self._add_tickets(quantities, session)
+
+            if self.pool_increases:
+                await self._increase_pools(sum(quantities.values()), session)
+
+        await run_in_transaction(Lottery, add)
+
+    async def _insert_first(self, *documents: Document) -> None:
+        """Insert the lottery and other documents if they haven't been,
+        before a transaction that could be retried, as an aborted one
+        would leave them with IDs but not stored."""
+        for document in (self, *documents):
+            if document.id is None:
+                await document.insert()
+
+    async def _increase_pools(
+        self, quantity: int, session: Optional[AsyncIOMotorClientSession]
+    ) -> None:
+        """Apply the pool increases for a number of tickets.
+
+        Raises:
+            ValueError: If a pool was deleted.
         """
-        if self.tickets:
-            self.winner = secrets.choice(self.tickets)
-            await self.winner.change_balance(self.prize)
-        else:
-            self.winner = None
+        pool_ids = await Pool.ids_by_code(
+            code for code, _ in self.pool_increases
+        )
+        changes = [
+            (pool_ids[code], increase * quantity)
+            for code, increase in self.pool_increases
+        ]
 
+        if await Pool.bulk_change_balances(changes, "Lottery ticket", session):
+            Pool.clear_cache()
+            raise ValueError("Pool not found")
+
+    async def _add_tickets(
+        self,
+        quantities: dict[str, int],
+        session: Optional[AsyncIOMotorClientSession],
+    ) -> None:
+        """Atomically add users' tickets and increase the prize.
+
+        Raises:
+            TypeError: If a quantity isn't an integer.
+            ValueError: If the lottery has been completed.
+        """
+        for quantity in quantities.values():
+            if isinstance(quantity, bool) or not isinstance(quantity, int):
+                raise TypeError("Quantity must be an integer")
+
+        fields = {
+            f"tickets.{user_id}": quantity
+            for user_id, quantity in quantities.items()
+        }
+        total = sum(quantities.values())
+        result = await self.get_motor_collection().find_one_and_update(
+            {"_id": self.id, "completed": False},
+            {
+                "$inc": {
+                    **fields,
+                    "ticket_count": total,
+                    "prize": self.prize_increase * total,
+                }
+            },
+            projection={
+                **dict.fromkeys(fields, True),
+                "ticket_count": True,
+                "prize": True,
+            },
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+
+        if result is None:
+            self.completed = True
+            raise ValueError("Lottery is already completed")
+
+        for user_id in quantities:
+            self.tickets[user_id] = result["tickets"][user_id]
+
+        self.ticket_count = result["ticket_count"]
+        self.prize = result["prize"]
+
+    async def _close(
+        self, session: Optional[AsyncIOMotorClientSession]
+    ) -> None:
+        """Atomically mark the lottery as completed, reloading its
+        tickets and prize so no purchase made before closing is missed.
+
+        Raises:
+            ValueError: If the lottery has already been completed.
+        """
+        result = await self.get_motor_collection().find_one_and_update(
+            {"_id": self.id, "completed": False},
+            {"$set": {"completed": True}},
+            projection={
+                "tickets": True,
+                "ticket_count": True,
+                "prize": True,
+            },
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+
+        if result is None:
+            raise ValueError("Lottery is already completed")
+
+        self.tickets = result["tickets"]
+        self.ticket_count = result["ticket_count"]
+        self.prize = result["prize"]
         self.completed = True
 
-        await self.save()
+    @instrumented
+    async def complete(
+        self,
+        winners: int = 1,
+        replace: bool = False,
+        splits: Optional[Sequence[int]] = None,
+    ) -> Optional[User]:
+        """Complete the lottery.
+
+        The lottery is closed to new tickets first, then winners are
+        drawn with chances proportional to their tickets, using a seed
+        from secrets that's stored so the draw can be audited with
+        replay_draw. Closing, drawing and paying out the prize happen in
+        a single transaction, which is retried with a new seed if it
+        conflicts with another.
+
+        Args:
+            winners (int, optional): The number of winners to draw.
+                Defaults to 1.
+            replace (bool, optional): Whether a user can win more than
+                one place. Defaults to False.
+            splits (Sequence[int], optional): The relative share of the
+                prize for each place, such as (50, 30, 20). If fewer
+                winners are drawn, the prize is split between their
+                places. Defaults to equal shares.
+
+        Tickets held by users who have since been deleted can't win.
+
+        Raises:
+            ValueError: If the number of splits doesn't match the number
+                of winners, the lottery has already been completed, or
+                a winner was deleted before being paid.
+
+        Returns:
+            User: The first place winner, if any tickets were bought.
+        """
+        if splits is None:
+            splits = [1] * winners
+        elif len(splits) != winners:
+            raise ValueError("There must be one split for each winner")
+
+        await self._insert_first()
+
+        async def complete(
+            session: Optional[AsyncIOMotorClientSession],
+        ) -> None:
+            await self._close(session)
+
+            self.draw_seed = secrets.token_hex(32)
+            winner_ids, users = await self._draw_users(
+                winners, replace, session
+            )
+            self.winners = [users[user_id] for user_id in winner_ids]
+            self.winner = self.winners[0] if self.winners else None
+
+            payouts = list(
+                zip(
+                    winner_ids,
+                    split_prize(self.prize, splits[: len(winner_ids)]),
+                )
+            )
+
+            failed = await User.bulk_change_balances(
+                payouts, "Lottery prize", session
+            )
+            await self.save(session=session)
+
+            if failed:
+                raise ValueError("Winner not found")
+
+            for user_id, payout in payouts:
+                users[user_id].balance += payout
+
+        await run_in_transaction(Lottery, complete)
 
         return self.winner
 
+    async def _draw_users(
+        self,
+        winners: int,
+        replace: bool,
+        session: Optional[AsyncIOMotorClientSession],
+    ) -> tuple[list[PydanticObjectId], dict[PydanticObjectId, User]]:
+        """Draw the winning users' IDs, in place order, and load them.
+
+        Tickets held by users who have since been deleted are removed
+        and the draw is replayed without them, so it can still be
+        audited with replay_draw.
+        """
+        while True:
+            winner_ids = [
+                PydanticObjectId(user_id)
+                for user_id in self.replay_draw(winners, replace)
+            ]
+            users = {
+                user.id: user
+                async for user in User.find(
+                    In(User.id, winner_ids), session=session
+                )
+            }
+
+            if len(users) == len(set(winner_ids)):
+                return winner_ids, users
+
+            for user_id in set(winner_ids) - users.keys():
+                self.ticket_count -= self.tickets.pop(str(user_id))
+
+    def replay_draw(
+        self, winners: int = 1, replace: bool = False
+    ) -> list[str]:
+        """Draw winners using the lottery's stored seed.
+
+        Ticket holders are ordered by user ID, so the same seed and
+        tickets always give the same winners. Each draw takes O(log n)
+        time in the number of ticket holders.
+
+        Args:
+            winners (int, optional): The number of winners to draw.
+                Defaults to 1.
+            replace (bool, optional): Whether a user can win more than
+                one place. Defaults to False.
+
+        Raises:
+            ValueError: If the lottery hasn't been drawn.
+
+        Returns:
+            list[str]: The IDs of the winning users, in place order.
+        """
+        if self.draw_seed is None:
+            raise ValueError("Lottery has not been drawn")
+
+        holders = sorted(self.tickets)
+        drawn = draw(
+            [self.tickets[user_id] for user_id in holders],
+            winners,
+            replace,
+            bytes.fromhex(self.draw_seed),
+        )
+
+        return [holders[index] for index in drawn]
+
+    @instrumented
     async def get_chance(self, user: User) -> float:
         """Get the chance of the user winning the lottery.
 
@@ -106,6 +626,7 @@ class Lottery(Document):
         Returns:
             float: The chance of the user winning the lottery.
         """
-        return (
-            self.tickets.count(user) / len(self.tickets) if self.tickets else 0
-        )
+        if not self.ticket_count:
+            return 0
+
+        return self.tickets.get(str(user.id), 0) / self.ticket_count
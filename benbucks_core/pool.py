@@ -1,6 +1,34 @@
-from typing import Self
+from collections.abc import Iterable
+from typing import Any, Optional, Self
 
-from beanie import Document
+from beanie import (
+    Delete,
+    Document,
+    Insert,
+    PydanticObjectId,
+    Replace,
+    SaveChanges,
+    Update,
+    after_event,
+)
+from motor.motor_asyncio import AsyncIOMotorClientSession
+from pymongo import IndexModel, ReturnDocument
+from pymongo.results import InsertManyResult
+
+from ._balance import bulk_inc_balances, inc_balance
+from ._cache import CacheInfo, TTLCache
+from ._utils import Money
+from .instrumentation import instrumented
+from .transaction import OPENING_BALANCE, Transaction
+
+_code_cache: Optional[TTLCache] = None
+_code_ids: dict[str, PydanticObjectId] = {}
+_id_codes: dict[PydanticObjectId, str] = {}
+
+
+def _remember_id(code: str, pool_id: PydanticObjectId) -> None:
+    _code_ids[code] = pool_id
+    _id_codes[pool_id] = code
 
 
 class Pool(Document):
@@ -9,40 +37,247 @@ class Pool(Document):
     Attributes:
         code (str): The short code for the pool.
         name (str, optional): The name of the pool. Defaults to "Pool".
-        balance (float, optional): The balance of the pool.
+        balance (int, optional): The balance of the pool, in cents.
             Defaults to 0.
     """
 
     code: str
     name: str = "Pool"
-    balance: float = 0
+    balance: Money = 0
+
+    class Settings:
+        indexes = [IndexModel("code", unique=True)]
+
+    @after_event(Insert)
+    async def _record_opening_balance(self) -> None:
+        """Record the pool's starting balance in the ledger."""
+        await Transaction.record_changes(
+            [(self.id, self.balance)], OPENING_BALANCE
+        )
+
+    @classmethod
+    async def insert_many(
+        cls,
+        documents: Iterable["Pool"],
+        session: Optional[AsyncIOMotorClientSession] = None,
+        **kwargs: Any,
+    ) -> InsertManyResult:
+        """Insert many pools, recording their starting balances in the
+        ledger."""
+        documents = list(documents)
+        result = await super().insert_many(documents, session, **kwargs)
+        await Transaction.record_changes(
+            zip(
+                result.inserted_ids,
+                (document.balance for document in documents),
+            ),
+            OPENING_BALANCE,
+            session,
+        )
+
+        return result
 
-    async def change_balance(self, amount: float) -> float:
+    @instrumented
+    async def change_balance(
+        self,
+        amount: int,
+        session: Optional[AsyncIOMotorClientSession] = None,
+        reason: Optional[str] = None,
+    ) -> int:
         """Change the pool's balance by a given amount.
 
+        The change is applied atomically on the server, so concurrent
+        changes to the same pool are never lost, and is recorded as a
+        transaction.
+
         Args:
-            amount (float): The amount to change the balance by.
+            amount (int): The amount to change the balance by, in
+                cents.
+            session (AsyncIOMotorClientSession, optional): The session
+                to run the update in. Defaults to None.
+            reason (str, optional): Why the balance is changing.
+                Defaults to None.
 
         Raises:
+            TypeError: If the amount isn't an integer number of cents.
             ValueError: If the balance would be made negative.
 
         Returns:
-            float: The new balance.
+            int: The new balance, in cents.
         """
-        if self.balance + amount < 0:
-            raise ValueError("Balance cannot be negative")
+        try:
+            balance = await inc_balance(self, amount, session)
+        finally:
+            self._invalidate_cache()
 
-        self.balance = round(self.balance + amount, 2)
-        await self.save()
+        await Transaction.record_changes([(self.id, amount)], reason, session)
 
-        return self.balance
+        return balance
 
     @classmethod
+    @instrumented
+    async def bulk_change_balances(
+        cls,
+        changes: Iterable[tuple[PydanticObjectId, int]],
+        reason: Optional[str] = None,
+        session: Optional[AsyncIOMotorClientSession] = None,
+    ) -> list[PydanticObjectId]:
+        """Change many pools' balances with a single database write.
+
+        Changes for the same pool are combined. Each combined change is
+        applied atomically, and only if it wouldn't make that pool's
+        balance negative. Applied changes are recorded as transactions.
+        Inside a batch, the changes are queued, so none are returned as
+        failed, and rejected IDs are added to the batch's rejected_ids
+        when it's written.
+
+        Args:
+            changes (Iterable[tuple[PydanticObjectId, int]]): Pairs of
+                pool IDs and the amounts to change their balances by,
+                in cents.
+            reason (str, optional): Why the balances are changing.
+                Defaults to None.
+            session (AsyncIOMotorClientSession, optional): The session
+                to run the updates in. Defaults to None.
+
+        Raises:
+            TypeError: If an amount isn't an integer number of cents.
+
+        Returns:
+            list[PydanticObjectId]: The IDs of pools whose balances
+                weren't changed, because they don't exist or because
+                the change would have made their balance negative.
+        """
+        changes = list(changes)
+
+        try:
+            failed = await bulk_inc_balances(cls, changes, session)
+        finally:
+            cls._invalidate_ids(pool_id for pool_id, _ in changes)
+
+        rejected = set(failed)
+        await Transaction.record_changes(
+            [change for change in changes if change[0] not in rejected],
+            reason,
+            session,
+        )
+
+        return failed
+
+    @classmethod
+    @instrumented
+    async def ids_by_code(
+        cls, codes: Iterable[str]
+    ) -> dict[str, PydanticObjectId]:
+        """Get the IDs of pools by their codes, creating any that don't
+        exist.
+
+        Codes and IDs never change, so they're remembered and known
+        codes don't need a database query.
+
+        Args:
+            codes (Iterable[str]): The codes of the pools.
+
+        Returns:
+            dict[str, PydanticObjectId]: The ID of each pool, keyed by
+                code.
+        """
+        codes = list(codes)
+        missing = [code for code in codes if code not in _code_ids]
+
+        if missing:
+            cursor = cls.get_motor_collection().find(
+                {"code": {"$in": missing}}, projection={"code": True}
+            )
+
+            async for pool in cursor:
+                _remember_id(pool["code"], pool["_id"])
+
+            for code in missing:
+                if code not in _code_ids:
+                    pool = await cls._get_by_code(code, True)
+                    _remember_id(code, pool.id)
+
+        return {code: _code_ids[code] for code in codes}
+
+    @after_event(Insert, Replace, SaveChanges, Update, Delete)
+    def _invalidate_cache(self) -> None:
+        """Remove the pool from the get_by_code cache after a write."""
+        if _code_cache is not None:
+            _code_cache.invalidate(self.code)
+
+    @staticmethod
+    def _invalidate_ids(pool_ids: Iterable[PydanticObjectId]) -> None:
+        """Remove pools from the get_by_code cache by ID, clearing it if
+        any of their codes aren't known."""
+        if _code_cache is None:
+            return
+
+        codes = [_id_codes.get(pool_id) for pool_id in pool_ids]
+
+        if None in codes:
+            _code_cache.clear()
+        else:
+            for code in codes:
+                _code_cache.invalidate(code)
+
+    @after_event(Delete)
+    def _forget_id(self) -> None:
+        """Forget the deleted pool's ID."""
+        _id_codes.pop(_code_ids.pop(self.code, None), None)
+
+    @staticmethod
+    def clear_cache() -> None:
+        """Forget every cached pool and pool ID."""
+        _code_ids.clear()
+        _id_codes.clear()
+
+        if _code_cache is not None:
+            _code_cache.clear()
+
+    @staticmethod
+    def enable_cache(maxsize: int = 1024, ttl: float = 60) -> None:
+        """Cache pools looked up with get_by_code.
+
+        Writes made through this library invalidate the cached pool.
+        Writes made elsewhere are seen once the cached pool expires.
+
+        Args:
+            maxsize (int, optional): The maximum number of pools to
+                cache. Defaults to 1024.
+            ttl (float, optional): How many seconds to cache each pool
+                for. Defaults to 60.
+        """
+        global _code_cache
+        _code_cache = TTLCache(maxsize, ttl)
+
+    @staticmethod
+    def disable_cache() -> None:
+        """Stop caching pools looked up with get_by_code."""
+        global _code_cache
+        _code_cache = None
+
+    @staticmethod
+    def cache_info() -> Optional[CacheInfo]:
+        """Get statistics for the get_by_code cache.
+
+        Returns:
+            CacheInfo: The cache's hits, misses, maximum size and
+                current size, or None if caching is disabled.
+        """
+        return _code_cache.info() if _code_cache is not None else None
+
+    @classmethod
+    @instrumented
     async def get_by_code(
         cls, code: str, create_if_needed: bool = True
     ) -> Self:
         """Get a pool by its code.
 
+        Creating a missing pool is a single atomic upsert, so concurrent
+        calls for the same code all get the same pool. If caching is
+        enabled, a copy of the cached pool is returned when possible.
+
         Args:
             code (str): The code of the pool.
             create_if_needed (bool, optional): Whether to create the
@@ -55,13 +290,40 @@ class Pool(Document):
         Returns:
             Pool: The pool with the given code.
         """
-        pool = await cls.find_one(cls.code == code)
+        cache = _code_cache
 
-        if not pool:
-            if create_if_needed:
-                pool = cls(code=code)
-                await pool.save()
-            else:
-                raise ValueError("Pool not found")
+        if cache is not None:
+            pool = cache.get(code)
+
+            if pool is not None:
+                return pool.copy()
+
+            version = cache.version
+
+        pool = await cls._get_by_code(code, create_if_needed)
+
+        if cache is not None:
+            cache.set(code, pool.copy(), version)
 
         return pool
+
+    @classmethod
+    async def _get_by_code(cls, code: str, create_if_needed: bool) -> Self:
+        """Get a pool by its code from the database."""
+        if not create_if_needed:
+            pool = await cls.find_one(cls.code == code)
+
+            if not pool:
+                raise ValueError("Pool not found")
+
+            return pool
+
+        defaults = cls(code=code).dict(by_alias=True, exclude={"id", "code"})
+        document = await cls.get_motor_collection().find_one_and_update(
+            {"code": code},
+            {"$setOnInsert": defaults},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+        return cls.parse_obj(document)
@@ -0,0 +1,286 @@
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+from beanie import Document, PydanticObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateMany, UpdateOne
+
+from ._utils import Money
+from .pool import Pool
+from .transaction import MAX_BUFFERED, MAX_DELAY, OPENING_BALANCE, Transaction
+from .user import User
+
+# Buffered transactions are stamped when recorded but inserted up to
+# MAX_DELAY later, plus however long the insert takes
+SETTLE_TIME = timedelta(seconds=2 * MAX_DELAY)
+
+
+class BalanceMismatch(NamedTuple):
+    """An account whose stored balance doesn't match the ledger."""
+
+    account: PydanticObjectId
+    stored: int
+    rebuilt: int
+
+
+class BalanceSnapshot(Document):
+    """An account's balance at a point in time, computed from the
+    ledger.
+
+    Attributes:
+        account (PydanticObjectId): The ID of the user or pool.
+        balance (int): The sum of the account's transactions before the
+            timestamp, in cents.
+        timestamp (datetime): When the snapshot was taken.
+    """
+
+    account: PydanticObjectId
+    balance: Money
+    timestamp: datetime
+
+    class Settings:
+        indexes = [
+            IndexModel(
+                [("account", ASCENDING), ("timestamp", DESCENDING)],
+                unique=True,
+            ),
+            IndexModel([("timestamp", DESCENDING)]),
+        ]
+
+    @classmethod
+    async def latest(
+        cls, account_id: PydanticObjectId, when: datetime
+    ) -> Optional["BalanceSnapshot"]:
+        """Get an account's most recent snapshot at or before a time.
+
+        Args:
+            account_id (PydanticObjectId): The ID of the user or pool.
+            when (datetime): The time to look back from.
+
+        Returns:
+            BalanceSnapshot: The snapshot, if there is one.
+        """
+        return (
+            await cls.find(cls.account == account_id, cls.timestamp <= when)
+            .sort(-cls.timestamp)
+            .first_or_none()
+        )
+
+    @classmethod
+    async def balance_at(
+        cls, account_id: PydanticObjectId, when: datetime
+    ) -> int:
+        """Get an account's balance at a point in time.
+
+        Only the transactions since the account's nearest snapshot are
+        summed. Transactions buffered in this process are inserted
+        first.
+
+        Args:
+            account_id (PydanticObjectId): The ID of the user or pool.
+            when (datetime): The time to get the balance at. Only
+                transactions before this time are counted.
+
+        Returns:
+            int: The balance, in cents.
+        """
+        await Transaction.flush()
+        snapshot = await cls.latest(account_id, when)
+
+        if snapshot is None:
+            return await Transaction.net_change(account_id, end=when)
+
+        return snapshot.balance + await Transaction.net_change(
+            account_id, snapshot.timestamp, when
+        )
+
+    @classmethod
+    async def take(cls, when: Optional[datetime] = None) -> int:
+        """Snapshot the balance of every account that changed since the
+        last snapshots were taken.
+
+        The ledger is replayed from the most recent snapshot time before
+        ``when``, starting from each changed account's previous
+        snapshot. Run this periodically to keep point-in-time queries
+        fast.
+
+        Transactions can be inserted a while after they're stamped,
+        such as from another process's buffer, and would be missed by a
+        snapshot taken after their timestamp. So snapshots are never
+        taken later than SETTLE_TIME ago, leaving transactions still on
+        their way to be counted by the next snapshot.
+
+        Args:
+            when (datetime, optional): The time to take the snapshots
+                at. Defaults to, and is at most, SETTLE_TIME ago.
+
+        Returns:
+            int: The number of snapshots taken.
+        """
+        await Transaction.flush()
+        settled = datetime.now(timezone.utc) - SETTLE_TIME
+
+        # Naive times are UTC, like the ones read from MongoDB
+        if when is not None and when.tzinfo is None:
+            settled = settled.replace(tzinfo=None)
+
+        if when is None or when > settled:
+            when = settled
+
+        previous = (
+            await cls.find(cls.timestamp < when)
+            .sort(-cls.timestamp)
+            .first_or_none()
+        )
+        start = previous.timestamp if previous else None
+
+        changes = await Transaction.replay(start, when)
+
+        if not changes:
+            return 0
+
+        balances = changes.copy()
+
+        if start is not None:
+            pipeline = [
+                {
+                    "$match": {
+                        "account": {"$in": list(changes)},
+                        "timestamp": {"$lte": start},
+                    }
+                },
+                {"$sort": {"timestamp": DESCENDING}},
+                {
+                    "$group": {
+                        "_id": "$account",
+                        "balance": {"$first": "$balance"},
+                    }
+                },
+            ]
+
+            async for base in cls.get_motor_collection().aggregate(pipeline):
+                balances[base["_id"]] += base["balance"]
+
+        await cls.get_motor_collection().bulk_write(
+            [
+                UpdateOne(
+                    {"account": account_id, "timestamp": when},
+                    {"$set": {"balance": balance}},
+                    upsert=True,
+                )
+                for account_id, balance in balances.items()
+            ],
+            ordered=False,
+        )
+
+        return len(balances)
+
+    @staticmethod
+    async def verify_balances() -> list[BalanceMismatch]:
+        """Check every stored balance against the full ledger.
+
+        The ledger is replayed in one streaming pass, then users and
+        pools are streamed with only their balances. Starting balances
+        are recorded when accounts are inserted, but accounts from
+        before the ledger show up as mismatches until
+        record_opening_balances is run.
+
+        Returns:
+            list[BalanceMismatch]: The accounts whose stored balances
+                differ from the ledger.
+        """
+        await Transaction.flush()
+        rebuilt = await Transaction.replay()
+        mismatches = []
+
+        for model in (User, Pool):
+            cursor = model.get_motor_collection().find(
+                {}, projection={"balance": True}
+            )
+
+            async for account in cursor:
+                expected = rebuilt.pop(account["_id"], 0)
+
+                if account["balance"] != expected:
+                    mismatches.append(
+                        BalanceMismatch(
+                            account["_id"], account["balance"], expected
+                        )
+                    )
+
+        mismatches.extend(
+            BalanceMismatch(account_id, 0, balance)
+            for account_id, balance in rebuilt.items()
+            if balance
+        )
+
+        return mismatches
+
+    @staticmethod
+    async def record_opening_balances() -> int:
+        """Record the balances accounts had before the ledger.
+
+        Each account whose stored balance differs from the ledger gets
+        a transaction for the difference, stamped with the time its ID
+        was generated, and its later snapshots are corrected. Run this
+        once after upgrading, while no balances are changing. Any
+        difference is recorded, so check verify_balances first if
+        balances may have been changed elsewhere since the ledger was
+        added.
+
+        Returns:
+            int: The number of opening balances recorded.
+        """
+        await Transaction.flush()
+        rebuilt = await Transaction.replay()
+        opening: list[Transaction] = []
+        corrections: list[UpdateMany] = []
+        recorded = 0
+
+        for model in (User, Pool):
+            cursor = model.get_motor_collection().find(
+                {}, projection={"balance": True}
+            )
+
+            async for account in cursor:
+                account_id = account["_id"]
+                difference = account["balance"] - rebuilt.get(account_id, 0)
+
+                if not difference:
+                    continue
+
+                created = account_id.generation_time
+                opening.append(
+                    Transaction(
+                        source=None if difference > 0 else account_id,
+                        destination=account_id if difference > 0 else None,
+                        amount=abs(difference),
+                        reason=OPENING_BALANCE,
+                        timestamp=created,
+                    )
+                )
+                corrections.append(
+                    UpdateMany(
+                        {"account": account_id, "timestamp": {"$gt": created}},
+                        {"$inc": {"balance": difference}},
+                    )
+                )
+
+                if len(opening) >= MAX_BUFFERED:
+                    await _write_opening_balances(opening, corrections)
+                    recorded += len(opening)
+                    opening, corrections = [], []
+
+        if opening:
+            await _write_opening_balances(opening, corrections)
+            recorded += len(opening)
+
+        return recorded
+
+
+async def _write_opening_balances(
+    opening: list[Transaction], corrections: list[UpdateMany]
+) -> None:
+    await Transaction.insert_many(opening)
+    await BalanceSnapshot.get_motor_collection().bulk_write(
+        corrections, ordered=False
+    )
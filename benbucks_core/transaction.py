@@ -0,0 +1,349 @@
+import asyncio
+from collections.abc import Iterable
+from datetime import datetime, timezone
+from typing import Optional
+
+from beanie import Document, PydanticObjectId
+from beanie.odm.queries.find import FindMany
+from motor.motor_asyncio import AsyncIOMotorClientSession
+from pydantic import Field
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from ._batch import current_batch
+from ._utils import Money
+
+MAX_BUFFERED = 1000
+MAX_DELAY = 1.0
+OPENING_BALANCE = "Opening balance"
+
+_buffer: list["Transaction"] = []
+_flush_task: Optional[asyncio.Task] = None
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _time_range(
+    start: Optional[datetime], end: Optional[datetime]
+) -> dict[str, datetime]:
+    time_range = {}
+
+    if start is not None:
+        time_range["$gte"] = start
+    if end is not None:
+        time_range["$lt"] = end
+
+    return time_range
+
+
+def _account_filter(
+    account_id: PydanticObjectId,
+    start: Optional[datetime],
+    end: Optional[datetime],
+) -> dict:
+    sides = [{"source": account_id}, {"destination": account_id}]
+
+    if start is not None or end is not None:
+        for side in sides:
+            side["timestamp"] = _time_range(start, end)
+
+    return {"$or": sides}
+
+
+class Transaction(Document):
+    """A movement of currency into, out of, or between accounts.
+
+    Accounts are users and pools, identified by their IDs.
+
+    Attributes:
+        source (PydanticObjectId, optional): The account the currency
+            came from, or None if it was created. Defaults to None.
+        destination (PydanticObjectId, optional): The account the
+            currency went to, or None if it was removed. Defaults to
+            None.
+        amount (int): The amount moved, in cents.
+        reason (str, optional): Why the currency was moved. Defaults to
+            None.
+        timestamp (datetime, optional): When the currency was moved.
+            Defaults to now.
+    """
+
+    source: Optional[PydanticObjectId] = None
+    destination: Optional[PydanticObjectId] = None
+    amount: Money
+    reason: Optional[str] = None
+    timestamp: datetime = Field(default_factory=_now)
+
+    class Settings:
+        indexes = [
+            IndexModel([("source", ASCENDING), ("timestamp", DESCENDING)]),
+            IndexModel(
+                [("destination", ASCENDING), ("timestamp", DESCENDING)]
+            ),
+        ]
+
+    @classmethod
+    async def record(
+        cls,
+        source: Optional[PydanticObjectId],
+        destination: Optional[PydanticObjectId],
+        amount: int,
+        reason: Optional[str] = None,
+        session: Optional[AsyncIOMotorClientSession] = None,
+    ) -> None:
+        """Record a movement of currency.
+
+        With a session, the transaction is inserted right away as part
+        of it. Inside a batch, it's inserted when the batch is written,
+        if the balance changes it records are. Otherwise it's buffered
+        and inserted in a batch once MAX_BUFFERED transactions are
+        waiting or MAX_DELAY seconds have passed, whichever comes first.
+        Buffered transactions are also inserted when asyncio.run shuts
+        the event loop down. Other event loops must await flush before
+        they stop.
+
+        Args:
+            source (PydanticObjectId, optional): The account the
+                currency came from, or None if it was created.
+            destination (PydanticObjectId, optional): The account the
+                currency went to, or None if it was removed.
+            amount (int): The amount moved, in cents.
+            reason (str, optional): Why the currency was moved.
+                Defaults to None.
+            session (AsyncIOMotorClientSession, optional): The session
+                to insert the transaction in. Defaults to None.
+        """
+        transaction = cls(
+            source=source,
+            destination=destination,
+            amount=amount,
+            reason=reason,
+        )
+
+        if session is not None:
+            await transaction.insert(session=session)
+        elif (pending := current_batch()) is not None:
+            pending.record([transaction])
+        else:
+            await cls._buffer([transaction])
+
+    @classmethod
+    async def record_changes(
+        cls,
+        changes: Iterable[tuple[PydanticObjectId, int]],
+        reason: Optional[str] = None,
+        session: Optional[AsyncIOMotorClientSession] = None,
+    ) -> None:
+        """Record balance changes that created or removed currency.
+
+        Transactions are inserted or buffered like in record.
+
+        Args:
+            changes (Iterable[tuple[PydanticObjectId, int]]): Pairs of
+                account IDs and the amounts their balances changed by,
+                in cents.
+            reason (str, optional): Why the balances changed. Defaults
+                to None.
+            session (AsyncIOMotorClientSession, optional): The session
+                to insert the transactions in. Defaults to None.
+        """
+        transactions = [
+            cls(
+                source=None if amount > 0 else account_id,
+                destination=account_id if amount > 0 else None,
+                amount=abs(amount),
+                reason=reason,
+            )
+            for account_id, amount in changes
+            if amount
+        ]
+
+        if session is not None:
+            if transactions:
+                await cls.insert_many(transactions, session=session)
+        elif (pending := current_batch()) is not None:
+            pending.record(transactions)
+        else:
+            await cls._buffer(transactions)
+
+    @classmethod
+    async def _buffer(cls, transactions: list["Transaction"]) -> None:
+        """Buffer transactions and schedule or run a flush."""
+        global _flush_task
+
+        _buffer.extend(transactions)
+
+        if len(_buffer) >= MAX_BUFFERED:
+            await cls.flush()
+        elif _buffer and (
+            _flush_task is None
+            or _flush_task.get_loop() is not asyncio.get_running_loop()
+        ):
+            _flush_task = asyncio.create_task(cls._flush_later())
+
+    @classmethod
+    async def _flush_later(cls) -> None:
+        """Flush the buffer after MAX_DELAY seconds, or straight away if
+        the wait is cancelled by anything but a flush, like asyncio.run
+        cancelling its remaining tasks as the event loop shuts down."""
+        try:
+            await asyncio.sleep(MAX_DELAY)
+        except asyncio.CancelledError:
+            if _flush_task is asyncio.current_task():
+                await cls.flush()
+
+            raise
+
+        await cls.flush()
+
+    @classmethod
+    async def flush(cls) -> None:
+        """Insert all buffered transactions."""
+        global _flush_task
+
+        if _flush_task is not None:
+            if not (
+                _flush_task is asyncio.current_task()
+                or _flush_task.get_loop().is_closed()
+            ):
+                _flush_task.cancel()
+
+            _flush_task = None
+
+        if not _buffer:
+            return
+
+        transactions = _buffer.copy()
+        _buffer.clear()
+
+        try:
+            await cls.insert_many(transactions)
+        except BaseException:
+            _buffer[:0] = transactions
+            raise
+
+    @classmethod
+    def statement(
+        cls,
+        account_id: PydanticObjectId,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> FindMany["Transaction"]:
+        """Find the transactions into or out of an account.
+
+        Each side of the query uses one of the compound indexes on the
+        account and timestamp.
+
+        Args:
+            account_id (PydanticObjectId): The ID of the user or pool.
+            start (datetime, optional): The earliest time to include.
+                Defaults to None.
+            end (datetime, optional): The time to stop before. Defaults
+                to None.
+
+        Returns:
+            FindMany: The transactions, newest first.
+        """
+        return cls.find(_account_filter(account_id, start, end)).sort(
+            [("timestamp", DESCENDING), ("_id", DESCENDING)]
+        )
+
+    @classmethod
+    async def net_change(
+        cls,
+        account_id: PydanticObjectId,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> int:
+        """Get how much an account's balance changed over a time range.
+
+        The sum is computed on the server.
+
+        Args:
+            account_id (PydanticObjectId): The ID of the user or pool.
+            start (datetime, optional): The earliest time to include.
+                Defaults to None.
+            end (datetime, optional): The time to stop before. Defaults
+                to None.
+
+        Returns:
+            int: The net change, in cents.
+        """
+        pipeline = [
+            {"$match": _account_filter(account_id, start, end)},
+            {
+                "$group": {
+                    "_id": None,
+                    "credits": {
+                        "$sum": {
+                            "$cond": [
+                                {"$eq": ["$destination", account_id]},
+                                "$amount",
+                                0,
+                            ]
+                        }
+                    },
+                    "debits": {
+                        "$sum": {
+                            "$cond": [
+                                {"$eq": ["$source", account_id]},
+                                "$amount",
+                                0,
+                            ]
+                        }
+                    },
+                }
+            },
+        ]
+
+        async for result in cls.get_motor_collection().aggregate(pipeline):
+            return result["credits"] - result["debits"]
+
+        return 0
+
+    @classmethod
+    async def replay(
+        cls,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        balances: Optional[dict[PydanticObjectId, int]] = None,
+    ) -> dict[PydanticObjectId, int]:
+        """Replay the ledger to rebuild every account's balance.
+
+        Transactions are streamed from a single cursor, so memory use
+        depends on the number of accounts, not transactions.
+
+        Args:
+            start (datetime, optional): The earliest time to include.
+                Defaults to None.
+            end (datetime, optional): The time to stop before. Defaults
+                to None.
+            balances (dict[PydanticObjectId, int], optional): The
+                balances at the start time. Defaults to None, meaning
+                every balance starts at 0.
+
+        Returns:
+            dict[PydanticObjectId, int]: The balance of each account,
+                in cents.
+        """
+        balances = dict(balances or {})
+        cursor = cls.get_motor_collection().find(
+            {"timestamp": _time_range(start, end)} if start or end else {},
+            projection={
+                "_id": False,
+                "source": True,
+                "destination": True,
+                "amount": True,
+            },
+        )
+
+        async for transaction in cursor:
+            amount = transaction["amount"]
+
+            if (source := transaction.get("source")) is not None:
+                balances[source] = balances.get(source, 0) - amount
+            if (destination := transaction.get("destination")) is not None:
+                balances[destination] = balances.get(destination, 0) + amount
+
+        return balances
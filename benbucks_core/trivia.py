@@ -1,6 +1,119 @@
-from beanie import Document
+import asyncio
+import csv
+import json
+import re
+from collections import deque
+from collections.abc import Iterator
+from itertools import islice
+from typing import Any, Literal, NamedTuple, Optional, Self, TextIO
 
-PRIZE_MULTIPLIERS = (1, 0.7, 0.5)
+from beanie import Document, Insert, PydanticObjectId, Replace, before_event
+from pydantic import PrivateAttr, validator
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from ._utils import Money
+from .instrumentation import instrumented
+from .user import User
+
+PRIZE_PERCENTAGES = (100, 70, 50)
+RECENT_QUESTIONS = 100
+CHUNK_SIZE = 1000
+EXPORTED_FIELDS = ("question", "answer", "first_prize", "aliases")
+ALIAS_SEPARATOR = "|"
+DUPLICATE_KEY = 11000
+CHARACTERS_PER_TYPO = 5
+MAX_TYPOS = 2
+MATCH_CACHE_SIZE = 1024
+# Words that make an answer's meaning depend on its word order
+ORDERED_WORDS = frozenset(
+    {
+        "after",
+        "before",
+        "by",
+        "from",
+        "into",
+        "minus",
+        "no",
+        "not",
+        "of",
+        "than",
+        "to",
+        "versus",
+        "vs",
+    }
+)
+
+_SEPARATORS = re.compile(r"[\W_]+")
+_DIGIT = re.compile(r"\d")
+_recent: deque[PydanticObjectId] = deque(maxlen=RECENT_QUESTIONS)
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a question or answer for comparison, ignoring case,
+    punctuation and spacing.
+
+    Args:
+        text (str): The question or answer.
+
+    Returns:
+        str: The normalized text.
+    """
+    return _SEPARATORS.sub(" ", text.casefold()).strip()
+
+
+def _sort_words(text: str) -> str:
+    return " ".join(sorted(set(text.split())))
+
+
+def _numbers(text: str) -> tuple[str, ...]:
+    return tuple(word for word in text.split() if _DIGIT.search(word))
+
+
+def _any_order(text: str) -> bool:
+    """Check whether an answer means the same with its words in any
+    order, which isn't true of numbers or words like "not"."""
+    return not _DIGIT.search(text) and ORDERED_WORDS.isdisjoint(text.split())
+
+
+def _within_distance(first: str, second: str, limit: int) -> bool:
+    """Check whether the edit distance between two strings is at most a
+    limit, stopping as soon as it's exceeded."""
+    if abs(len(first) - len(second)) > limit:
+        return False
+
+    if limit == 0:
+        return first == second
+
+    previous = list(range(len(second) + 1))
+
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+
+        for j, second_char in enumerate(second, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (first_char != second_char),
+                )
+            )
+
+        if min(current) > limit:
+            return False
+
+        previous = current
+
+    return previous[-1] <= limit
+
+
+class _AnswerIndex(NamedTuple):
+    """The precomputed forms of a question's accepted answers."""
+
+    key: tuple[str, tuple[str, ...]]
+    answers: frozenset[str]
+    sorted_words: frozenset[str]
+    typos: tuple[tuple[str, int, tuple[str, ...]], ...]
 
 
 class TriviaQuestion(Document):
@@ -9,17 +122,449 @@ class TriviaQuestion(Document):
     Attributes:
         question (str): The question.
         answer (str): The correct answer.
-        first_prize (float): The prize for the first place winner.
+        aliases (list[str], optional): Other accepted answers. Defaults
+            to an empty list.
+        first_prize (int): The prize for the first place winner, in
+            cents.
+        normalized_question (str): The normalized question, which must
+            be unique. Always derived from the question.
     """
 
     question: str
     answer: str
-    first_prize: float
+    aliases: list[str] = []
+    first_prize: Money
+    normalized_question: Optional[str] = None
+
+    _answer_index: Optional[_AnswerIndex] = PrivateAttr(None)
+    _match_cache: dict[str, bool] = PrivateAttr(default_factory=dict)
+
+    class Settings:
+        indexes = [
+            IndexModel(
+                [("normalized_question", ASCENDING)], unique=True, sparse=True
+            )
+        ]
+
+    @validator("normalized_question", always=True)
+    def _normalize_question(
+        cls, value: Optional[str], values: dict[str, Any]
+    ) -> Optional[str]:
+        """Derive the normalized question from the question."""
+        if "question" not in values:
+            return value
+
+        return normalize_text(values["question"])
+
+    @before_event(Insert, Replace)
+    def _update_normalized_question(self) -> None:
+        """Keep the normalized question up to date with the question."""
+        self.normalized_question = normalize_text(self.question)
+
+    @classmethod
+    async def migrate_normalized_questions(cls) -> int:
+        """Fill in the normalized question of questions stored before it
+        existed, so the unique index catches them when importing.
+
+        Questions that duplicate an already normalized question are left
+        as they are.
+
+        Returns:
+            int: The number of questions migrated.
+        """
+        migrated = 0
+        collection = cls.get_motor_collection()
+
+        async for question in collection.find(
+            {"normalized_question": None}, projection={"question": True}
+        ):
+            try:
+                await collection.update_one(
+                    {"_id": question["_id"]},
+                    {
+                        "$set": {
+                            "normalized_question": normalize_text(
+                                question["question"]
+                            )
+                        }
+                    },
+                )
+            except DuplicateKeyError:
+                continue
+
+            migrated += 1
+
+        return migrated
 
     @property
     def prizes(self) -> tuple[int, int, int]:
         """The prizes for the first, second, and third place winners."""
         return tuple(
-            round(self.first_prize * multiplier, 2)
-            for multiplier in PRIZE_MULTIPLIERS
+            self.first_prize * percentage // 100
+            for percentage in PRIZE_PERCENTAGES
         )
+
+    def matches(self, answer: str) -> bool:
+        """Check whether an answer is correct.
+
+        An answer is correct if, ignoring case, punctuation and spacing,
+        it equals the answer or an alias, has the same words in any
+        order, or is within one typo per CHARACTERS_PER_TYPO characters,
+        up to MAX_TYPOS. Numbers must match exactly, and answers with
+        numbers or ORDERED_WORDS must keep their word order. The
+        accepted forms are computed once and results are cached, so
+        checking repeated answers is cheap.
+
+        Args:
+            answer (str): The submitted answer.
+
+        Returns:
+            bool: Whether the answer is correct.
+        """
+        index = self._get_answer_index()
+        normalized = normalize_text(answer)
+
+        try:
+            return self._match_cache[normalized]
+        except KeyError:
+            pass
+
+        correct = (
+            normalized in index.answers
+            or _sort_words(normalized) in index.sorted_words
+            or any(
+                _numbers(normalized) == numbers
+                and _within_distance(normalized, accepted, typos)
+                for accepted, typos, numbers in index.typos
+            )
+        )
+
+        if len(self._match_cache) >= MATCH_CACHE_SIZE:
+            self._match_cache.clear()
+
+        self._match_cache[normalized] = correct
+        return correct
+
+    def _get_answer_index(self) -> _AnswerIndex:
+        """Get the accepted answer forms, recomputing them if the answer
+        or aliases have changed."""
+        key = (self.answer, tuple(self.aliases))
+
+        if self._answer_index is None or self._answer_index.key != key:
+            answers = frozenset(
+                normalize_text(answer) for answer in (self.answer, *key[1])
+            )
+            self._answer_index = _AnswerIndex(
+                key,
+                answers,
+                frozenset(
+                    _sort_words(answer)
+                    for answer in answers
+                    if _any_order(answer)
+                ),
+                tuple(
+                    (
+                        answer,
+                        min(len(answer) // CHARACTERS_PER_TYPO, MAX_TYPOS),
+                        _numbers(answer),
+                    )
+                    for answer in answers
+                ),
+            )
+            self._match_cache.clear()
+
+        return self._answer_index
+
+    @classmethod
+    @instrumented
+    async def random(
+        cls, n: int = 1, exclude_recent: bool = True
+    ) -> list[Self]:
+        """Get random questions without loading the whole collection.
+
+        The questions are picked with $sample, which reads only the
+        sampled documents when it's the first stage, so recent questions
+        are filtered out after sampling. The last RECENT_QUESTIONS
+        questions picked are remembered.
+
+        Args:
+            n (int, optional): The number of questions. Defaults to 1.
+            exclude_recent (bool, optional): Whether to avoid recently
+                picked questions, unless there aren't enough others.
+                Defaults to True.
+
+        Returns:
+            list[TriviaQuestion]: The questions, which may be fewer than
+                n if there aren't enough questions.
+        """
+        questions = await cls._sample(
+            n, list(_recent) if exclude_recent else []
+        )
+
+        if len(questions) < n and exclude_recent and _recent:
+            questions += await cls._sample(
+                n - len(questions), [question.id for question in questions]
+            )
+
+        _recent.extend(question.id for question in questions)
+
+        return questions
+
+    @classmethod
+    @instrumented
+    async def import_questions(
+        cls,
+        file: TextIO,
+        file_format: Literal["jsonl", "csv"] = "jsonl",
+        chunk_size: int = CHUNK_SIZE,
+    ) -> int:
+        """Import questions from a JSONL or CSV file.
+
+        The file is read and inserted in chunks, so memory use doesn't
+        depend on its size. Questions whose normalized text already
+        exists are skipped.
+
+        Args:
+            file (TextIO): The file to read, with question, answer,
+                first_prize and optional aliases fields. CSV files need
+                a header row and separate aliases with ALIAS_SEPARATOR.
+            file_format (str, optional): Either "jsonl" or "csv".
+                Defaults to "jsonl".
+            chunk_size (int, optional): The number of questions to
+                insert at once. Defaults to CHUNK_SIZE.
+
+        Raises:
+            ValueError: If the format is unknown or a question is
+                invalid.
+
+        Returns:
+            int: The number of questions imported.
+        """
+        rows = _read_rows(file, file_format)
+        collection = cls.get_motor_collection()
+        imported = 0
+
+        while chunk := list(islice(rows, chunk_size)):
+            documents = [
+                cls.parse_obj(row).dict(by_alias=True, exclude={"id"})
+                for row in chunk
+            ]
+
+            try:
+                result = await collection.insert_many(documents, ordered=False)
+            except BulkWriteError as error:
+                if any(
+                    write_error["code"] != DUPLICATE_KEY
+                    for write_error in error.details["writeErrors"]
+                ):
+                    raise
+
+                imported += error.details["nInserted"]
+            else:
+                imported += len(result.inserted_ids)
+
+        return imported
+
+    @classmethod
+    @instrumented
+    async def export_questions(
+        cls, file: TextIO, file_format: Literal["jsonl", "csv"] = "jsonl"
+    ) -> int:
+        """Export every question to a JSONL or CSV file.
+
+        Questions are streamed from the database, so memory use doesn't
+        depend on the number of questions.
+
+        Args:
+            file (TextIO): The file to write.
+            file_format (str, optional): Either "jsonl" or "csv".
+                Defaults to "jsonl".
+
+        Raises:
+            ValueError: If the format is unknown.
+
+        Returns:
+            int: The number of questions exported.
+        """
+        if file_format == "csv":
+            writer = csv.DictWriter(file, EXPORTED_FIELDS)
+            writer.writeheader()
+
+            def write(row: dict[str, Any]) -> None:
+                aliases = ALIAS_SEPARATOR.join(row["aliases"])
+                writer.writerow({**row, "aliases": aliases})
+
+        elif file_format == "jsonl":
+
+            def write(row: dict[str, Any]) -> None:
+                file.write(json.dumps(row) + "\n")
+
+        else:
+            raise ValueError("Unknown format")
+
+        exported = 0
+        cursor = cls.get_motor_collection().find(
+            {},
+            projection={field: True for field in EXPORTED_FIELDS},
+            sort=[("_id", ASCENDING)],
+        )
+
+        async for question in cursor:
+            question.setdefault("aliases", [])
+            write({field: question[field] for field in EXPORTED_FIELDS})
+            exported += 1
+
+        return exported
+
+    @classmethod
+    async def _sample(
+        cls, n: int, exclude: list[PydanticObjectId]
+    ) -> list[Self]:
+        """Sample questions, skipping the excluded IDs."""
+        pipeline = [
+            {"$sample": {"size": n + len(exclude)}},
+            {"$match": {"_id": {"$nin": exclude}}},
+            {"$limit": n},
+        ]
+
+        return [
+            cls.parse_obj(question)
+            async for question in cls.get_motor_collection().aggregate(
+                pipeline
+            )
+        ]
+
+
+def _read_rows(
+    file: TextIO, file_format: Literal["jsonl", "csv"]
+) -> Iterator[dict[str, Any]]:
+    """Lazily read questions from a JSONL or CSV file."""
+    if file_format == "jsonl":
+        return (json.loads(line) for line in file if line.strip())
+
+    if file_format == "csv":
+        return (
+            {
+                **row,
+                "first_prize": int(row["first_prize"]),
+                "aliases": (
+                    row["aliases"].split(ALIAS_SEPARATOR)
+                    if row.get("aliases")
+                    else []
+                ),
+            }
+            for row in csv.DictReader(file)
+        )
+
+    raise ValueError("Unknown format")
+
+
+class TriviaRound:
+    """A round of trivia, awarding prizes to the first users to answer a
+    question correctly.
+
+    Answers are graded as they're submitted, without awaiting, so any
+    number of tasks can submit answers and the event loop decides their
+    order without locks.
+
+    Attributes:
+        question (TriviaQuestion): The question being asked.
+        winners (list[User]): The users who answered correctly first, in
+            place order.
+        awarded (bool): Whether the prizes have been awarded.
+        unpaid (list[User]): The winners whose prizes couldn't be paid
+            when awarded, because they've been deleted.
+    """
+
+    def __init__(self, question: TriviaQuestion):
+        self.question = question
+        self.winners: list[User] = []
+        self.awarded = False
+        self.unpaid: list[User] = []
+
+        self._prizes = question.prizes
+        self._winner_ids: set[PydanticObjectId] = set()
+        self._finished = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        """Whether every prize has a winner or has been awarded."""
+        return self._finished.is_set()
+
+    def submit(self, user: User, answer: str) -> Optional[int]:
+        """Submit and grade an answer.
+
+        Args:
+            user (User): The user answering.
+            answer (str): The answer.
+
+        Returns:
+            int: The place the user won, starting at 1, if the answer
+                was correct and a prize was left for them.
+        """
+        if self.finished or user.id in self._winner_ids:
+            return None
+
+        if not self.question.matches(answer):
+            return None
+
+        self.winners.append(user)
+        self._winner_ids.add(user.id)
+
+        if len(self.winners) == len(self._prizes):
+            self._finished.set()
+
+        return len(self.winners)
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every prize has a winner.
+
+        Args:
+            timeout (float, optional): The number of seconds to wait.
+                Defaults to waiting forever.
+
+        Returns:
+            bool: Whether every prize has a winner.
+        """
+        try:
+            await asyncio.wait_for(self._finished.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        return self.finished
+
+    @instrumented
+    async def award(self) -> list[tuple[User, int]]:
+        """End the round and pay the winners their prizes in a single
+        bulk update.
+
+        Winners whose prizes couldn't be paid are left out and listed
+        in unpaid instead.
+
+        Raises:
+            ValueError: If the prizes have already been awarded.
+
+        Returns:
+            list[tuple[User, int]]: Each paid winner and their prize, in
+                cents, in place order.
+        """
+        if self.awarded:
+            raise ValueError("Prizes have already been awarded")
+
+        self.awarded = True
+        self._finished.set()
+
+        payouts = list(zip(self.winners, self._prizes))
+
+        failed = set(
+            await User.bulk_change_balances(
+                [(user.id, prize) for user, prize in payouts], "Trivia prize"
+            )
+        )
+        self.unpaid = [user for user, _ in payouts if user.id in failed]
+        payouts = [payout for payout in payouts if payout[0].id not in failed]
+
+        for user, prize in payouts:
+            user.balance += prize
+
+        return payouts
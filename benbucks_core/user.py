@@ -1,8 +1,33 @@
-from typing import Optional
+from collections.abc import AsyncIterator, Iterable
+from typing import Any, Optional
 
-from beanie import Document
+from beanie import Document, Insert, PydanticObjectId, after_event
+from motor.motor_asyncio import AsyncIOMotorClientSession
+from pydantic import BaseModel, Field
+from pymongo import DESCENDING, IndexModel
+from pymongo.results import InsertManyResult
 
+from ._balance import bulk_inc_balances, inc_balance
+from ._batch import save_fields
+from ._session import run_in_transaction
+from ._utils import Money, check_cents
+from .instrumentation import instrumented
 from .pool import Pool
+from .transaction import OPENING_BALANCE, Transaction
+
+
+class LeaderboardEntry(BaseModel):
+    """A user's place on the leaderboard.
+
+    Attributes:
+        id (PydanticObjectId): The user's ID.
+        name (str): The user's name.
+        balance (int): The user's balance, in cents.
+    """
+
+    id: PydanticObjectId = Field(alias="_id")
+    name: str
+    balance: int
 
 
 class User(Document):
@@ -10,44 +35,139 @@ class User(Document):
 
     Attributes:
         name (str): The user's name.
-        balance (float, optional): The user's balance. Defaults to
-            0.
+        balance (int, optional): The user's balance, in cents.
+            Defaults to 0.
         pin (str, optional): The user's PIN. Defaults to None.
     """
 
     name: str
-    balance: float = 0
+    balance: Money = 0
     pin: Optional[str] = None
 
+    class Settings:
+        indexes = [
+            "name",
+            IndexModel([("balance", DESCENDING), ("_id", DESCENDING)]),
+        ]
+
+    @instrumented
     async def change_name(self, name: str) -> None:
         """Change the user's name.
 
         Args:
             name (str): The new name for the user.
         """
-        self.name = name
-        await self.save()
+        await save_fields(self, name=name)
+
+    @after_event(Insert)
+    async def _record_opening_balance(self) -> None:
+        """Record the user's starting balance in the ledger."""
+        await Transaction.record_changes(
+            [(self.id, self.balance)], OPENING_BALANCE
+        )
 
-    async def change_balance(self, amount: float) -> float:
+    @classmethod
+    async def insert_many(
+        cls,
+        documents: Iterable["User"],
+        session: Optional[AsyncIOMotorClientSession] = None,
+        **kwargs: Any,
+    ) -> InsertManyResult:
+        """Insert many users, recording their starting balances in the
+        ledger."""
+        documents = list(documents)
+        result = await super().insert_many(documents, session, **kwargs)
+        await Transaction.record_changes(
+            zip(
+                result.inserted_ids,
+                (document.balance for document in documents),
+            ),
+            OPENING_BALANCE,
+            session,
+        )
+
+        return result
+
+    @instrumented
+    async def change_balance(
+        self,
+        amount: int,
+        session: Optional[AsyncIOMotorClientSession] = None,
+        reason: Optional[str] = None,
+    ) -> int:
         """Change the user's balance by a given amount.
 
+        The change is applied atomically on the server, so concurrent
+        changes to the same user are never lost, and is recorded as a
+        transaction.
+
         Args:
-            amount (float): The amount to change the balance by.
+            amount (int): The amount to change the balance by, in
+                cents.
+            session (AsyncIOMotorClientSession, optional): The session
+                to run the update in. Defaults to None.
+            reason (str, optional): Why the balance is changing.
+                Defaults to None.
 
         Raises:
+            TypeError: If the amount isn't an integer number of cents.
             ValueError: If the balance would be made negative.
 
         Returns:
-            float: The new balance.
+            int: The new balance, in cents.
+        """
+        balance = await inc_balance(self, amount, session)
+        await Transaction.record_changes([(self.id, amount)], reason, session)
+
+        return balance
+
+    @classmethod
+    @instrumented
+    async def bulk_change_balances(
+        cls,
+        changes: Iterable[tuple[PydanticObjectId, int]],
+        reason: Optional[str] = None,
+        session: Optional[AsyncIOMotorClientSession] = None,
+    ) -> list[PydanticObjectId]:
+        """Change many users' balances with a single database write.
+
+        Changes for the same user are combined. Each combined change is
+        applied atomically, and only if it wouldn't make that user's
+        balance negative. Applied changes are recorded as transactions.
+        Inside a batch, the changes are queued, so none are returned as
+        failed, and rejected IDs are added to the batch's rejected_ids
+        when it's written.
+
+        Args:
+            changes (Iterable[tuple[PydanticObjectId, int]]): Pairs of
+                user IDs and the amounts to change their balances by,
+                in cents.
+            reason (str, optional): Why the balances are changing.
+                Defaults to None.
+            session (AsyncIOMotorClientSession, optional): The session
+                to run the updates in. Defaults to None.
+
+        Raises:
+            TypeError: If an amount isn't an integer number of cents.
+
+        Returns:
+            list[PydanticObjectId]: The IDs of users whose balances
+                weren't changed, because they don't exist or because
+                the change would have made their balance negative.
         """
-        if self.balance + amount < 0:
-            raise ValueError("Balance cannot be negative")
+        changes = list(changes)
+        failed = await bulk_inc_balances(cls, changes, session)
 
-        self.balance = round(self.balance + amount, 2)
-        await self.save()
+        rejected = set(failed)
+        await Transaction.record_changes(
+            [change for change in changes if change[0] not in rejected],
+            reason,
+            session,
+        )
 
-        return self.balance
+        return failed
 
+    @instrumented
     async def set_pin(self, pin: str, override: bool = False) -> None:
         """Set the user's pin.
 
@@ -62,27 +182,95 @@ class User(Document):
         if self.pin and not override:
             raise ValueError("Pin already set")
 
-        self.pin = pin
-        await self.save()
+        await save_fields(self, pin=pin)
 
-    async def contribute_to_pool(self, pool: Pool, amount: float) -> None:
+    @instrumented
+    async def contribute_to_pool(self, pool: Pool, amount: int) -> None:
         """Contribute to a pool.
 
+        The user and pool balances are changed in a single transaction,
+        so the user is never debited without the pool being credited,
+        and the transaction is retried if it conflicts with another.
+
         Args:
             pool (Pool): The pool to contribute to.
-            amount (float): The amount to contribute.
+            amount (int): The amount to contribute, in cents.
 
         Raises:
+            TypeError: If the amount isn't an integer number of cents.
             ValueError: If the user does not have enough money.
         """
+        check_cents(amount)
+
         if amount < 0:
             raise ValueError("Cannot contribute negative amount")
 
         if self.balance < amount:
             raise ValueError("Not enough money")
 
-        await self.change_balance(-amount)
-        await pool.change_balance(amount)
+        # Inserted first, as an aborted transaction would leave them
+        # with IDs but not stored
+        for document in (self, pool):
+            if document.id is None:
+                await document.insert()
+
+        async def contribute(
+            session: Optional[AsyncIOMotorClientSession],
+        ) -> None:
+            try:
+                await inc_balance(self, -amount, session)
+                await inc_balance(pool, amount, session)
+            finally:
+                pool._invalidate_cache()
+
+            await Transaction.record(
+                self.id, pool.id, amount, "Pool contribution", session
+            )
+
+        await run_in_transaction(User, contribute)
+
+    @classmethod
+    async def leaderboard(
+        cls, limit: int = 10, after: Optional[LeaderboardEntry] = None
+    ) -> AsyncIterator[list[LeaderboardEntry]]:
+        """Stream users from the highest balance to the lowest.
+
+        Each page is fetched with keyset pagination on the balance
+        index, projecting only names and balances, so memory use
+        doesn't grow with the number of users.
+
+        Args:
+            limit (int, optional): The number of users in each page.
+                Defaults to 10.
+            after (LeaderboardEntry, optional): The last entry already
+                seen, to continue from. Defaults to None.
+
+        Yields:
+            list[LeaderboardEntry]: The next page of users.
+        """
+        while True:
+            query = {}
+
+            if after is not None:
+                query = {
+                    "$or": [
+                        {"balance": {"$lt": after.balance}},
+                        {"balance": after.balance, "_id": {"$lt": after.id}},
+                    ]
+                }
+
+            page = (
+                await cls.find(query)
+                .sort([("balance", DESCENDING), ("_id", DESCENDING)])
+                .limit(limit)
+                .project(LeaderboardEntry)
+                .to_list()
+            )
+
+            if page:
+                yield page
+
+            if len(page) < limit:
+                return
 
-        await self.save()
-        await pool.save()
+            after = page[-1]
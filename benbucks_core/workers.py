@@ -0,0 +1,866 @@
+import asyncio
+import hashlib
+import multiprocessing
+import queue
+from collections import defaultdict
+from collections.abc import Awaitable, Callable, Sequence
+from contextlib import suppress
+from itertools import count
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+from typing import Any, NamedTuple, Optional, Self
+
+from beanie import PydanticObjectId
+
+from ._balance import bulk_inc_balances
+from ._db import init_db
+from ._utils import check_cents
+from .lottery import Lottery
+from .pool import Pool
+from .transaction import Transaction
+from .user import User
+
+MAX_DELAY = 0.05
+MAX_BATCH = 1000
+
+# How often, in seconds, a ProcessRouter checks for stopped processes
+POLL_INTERVAL = 0.1
+
+_REMOTE_METHODS = {"change_balance", "_quote_tickets", "_add_tickets"}
+
+
+def shard_of(key: object, shards: int) -> int:
+    """Get the shard that owns an account or lottery.
+
+    Unlike hash(), the result is the same in every process.
+
+    Args:
+        key (object): The ID of the account or lottery.
+        shards (int): The number of shards.
+
+    Returns:
+        int: The index of the owning shard.
+    """
+    digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+class _BalanceChange(NamedTuple):
+    document_cls: type[User] | type[Pool]
+    document_id: PydanticObjectId
+    amount: int
+    reason: Optional[str]
+    future: asyncio.Future
+
+
+class _Purchase(NamedTuple):
+    lottery_id: PydanticObjectId
+    user_id: PydanticObjectId
+    quantity: int
+    future: asyncio.Future
+
+
+class ShardWorker:
+    """Applies the updates for one shard of accounts and lotteries.
+
+    Updates are queued in memory and written together every max_delay
+    seconds, or as soon as max_batch are waiting. Balance changes are
+    checked in arrival order against the stored balances, read once per
+    flush, so each caller gets the result of their own change, then
+    written with one bulk write per model. Ticket purchases debit the
+    buyer like any other balance change, then their tickets are added
+    with one write per lottery. Flushes run one at a time, so writes to
+    a hot account are combined instead of contending with each other.
+
+    To spread the load across processes, use a ProcessRouter, which
+    runs one worker for each shard in its own process and sends each
+    update to the process owning it, as given by shard_of.
+
+    Attributes:
+        shard (int): The index of the shard.
+        shards (int): The number of shards.
+        max_delay (float): The longest time, in seconds, an update waits
+            before being written.
+        max_batch (int): The number of waiting updates that triggers a
+            write straight away.
+    """
+
+    def __init__(
+        self,
+        shard: int,
+        shards: int,
+        max_delay: float = MAX_DELAY,
+        max_batch: int = MAX_BATCH,
+    ):
+        if not 0 <= shard < shards:
+            raise ValueError("Shard must be between 0 and shards - 1")
+
+        self.shard = shard
+        self.shards = shards
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+
+        self._changes: list[_BalanceChange] = []
+        self._purchases: list[_Purchase] = []
+        self._lotteries: dict[PydanticObjectId, Lottery] = {}
+        self._pending = asyncio.Event()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> Self:
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    def owns(self, key: object) -> bool:
+        """Check whether an account or lottery belongs to this shard.
+
+        Args:
+            key (object): The ID of the account or lottery.
+
+        Returns:
+            bool: Whether this shard owns it.
+        """
+        return shard_of(key, self.shards) == self.shard
+
+    def start(self) -> None:
+        """Start writing queued updates in the background."""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Write every queued update, then stop."""
+        if self._task is None:
+            return
+
+        self._stopping = True
+        self._pending.set()
+        self._full.set()
+
+        await self._task
+        self._task = None
+
+    async def change_balance(
+        self,
+        document_cls: type[User] | type[Pool],
+        document_id: PydanticObjectId,
+        amount: int,
+        reason: Optional[str] = None,
+    ) -> None:
+        """Change an account's balance, returning once it's written.
+
+        Args:
+            document_cls (type[User] | type[Pool]): The account's model.
+            document_id (PydanticObjectId): The account's ID.
+            amount (int): The amount to change the balance by, in cents.
+            reason (str, optional): Why the balance is changing.
+                Defaults to None.
+
+        Raises:
+            TypeError: If the amount isn't an integer number of cents.
+            ValueError: If the account belongs to another shard, doesn't
+                exist, or the balance would be made negative.
+            RuntimeError: If the worker isn't running.
+        """
+        check_cents(amount)
+        future = self._queue(document_id)
+        self._changes.append(
+            _BalanceChange(document_cls, document_id, amount, reason, future)
+        )
+        self._notify()
+
+        await future
+
+    async def buy_tickets(
+        self,
+        lottery_id: PydanticObjectId,
+        user_id: PydanticObjectId,
+        quantity: int = 1,
+    ) -> None:
+        """Buy lottery tickets for a user, returning once they're
+        bought.
+
+        The buyer is debited like any other balance change, then the
+        tickets are added, and the buyer is refunded if the lottery was
+        completed in between. Both the lottery and the buyer must belong
+        to this shard, so use a router for buyers in other shards.
+
+        Args:
+            lottery_id (PydanticObjectId): The lottery's ID.
+            user_id (PydanticObjectId): The buyer's ID.
+            quantity (int, optional): The number of tickets to buy.
+                Defaults to 1.
+
+        Raises:
+            TypeError: If the quantity isn't an integer.
+            ValueError: If the quantity isn't positive, the lottery or
+                buyer belongs to another shard, the lottery doesn't
+                exist or has been completed, or the user doesn't have
+                enough money.
+            RuntimeError: If the worker isn't running.
+        """
+        await _buy_tickets(self, self, lottery_id, user_id, quantity)
+
+    async def _quote_tickets(
+        self, lottery_id: PydanticObjectId, quantity: int
+    ) -> int:
+        """Get the cost of tickets for a lottery owned by this shard.
+
+        Raises:
+            TypeError: If the quantity isn't an integer.
+            ValueError: If the quantity isn't positive, the lottery
+                belongs to another shard, doesn't exist or has been
+                completed.
+            RuntimeError: If the worker isn't running.
+        """
+        if isinstance(quantity, bool) or not isinstance(quantity, int):
+            raise TypeError("Quantity must be an integer")
+
+        if quantity < 1:
+            raise ValueError("Quantity must be positive")
+
+        self._check(lottery_id)
+        lottery = await self._get_lottery(lottery_id)
+
+        if lottery.completed:
+            raise ValueError("Lottery is already completed")
+
+        return lottery.ticket_price * quantity
+
+    async def _add_tickets(
+        self,
+        lottery_id: PydanticObjectId,
+        user_id: PydanticObjectId,
+        quantity: int,
+    ) -> None:
+        """Add tickets the buyer has already paid for, returning once
+        they're written.
+
+        Raises:
+            ValueError: If the lottery belongs to another shard, doesn't
+                exist or has been completed, or a pool was deleted.
+            RuntimeError: If the worker isn't running.
+        """
+        future = self._queue(lottery_id)
+        self._purchases.append(
+            _Purchase(lottery_id, user_id, quantity, future)
+        )
+        self._notify()
+
+        await future
+
+    async def _flush(self) -> None:
+        """Write every queued update."""
+        changes, self._changes = self._changes, []
+        purchases, self._purchases = self._purchases, []
+        self._pending.clear()
+        self._full.clear()
+
+        await self._flush_changes(changes)
+        await self._flush_purchases(purchases)
+
+    def _check(self, key: object) -> None:
+        if self._task is None or self._stopping:
+            raise RuntimeError("Worker isn't running")
+
+        if not self.owns(key):
+            raise ValueError("Key belongs to another shard")
+
+    def _queue(self, key: object) -> asyncio.Future:
+        self._check(key)
+
+        return asyncio.get_running_loop().create_future()
+
+    def _notify(self) -> None:
+        self._pending.set()
+
+        if len(self._changes) + len(self._purchases) >= self.max_batch:
+            self._full.set()
+
+    async def _run(self) -> None:
+        while True:
+            await self._pending.wait()
+
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+
+            await self._flush()
+
+            if self._stopping and not (self._changes or self._purchases):
+                return
+
+    async def _flush_changes(self, changes: list[_BalanceChange]) -> None:
+        groups: defaultdict[
+            type[User] | type[Pool], list[_BalanceChange]
+        ] = defaultdict(list)
+
+        for change in changes:
+            groups[change.document_cls].append(change)
+
+        for document_cls, group in groups.items():
+            try:
+                await _apply_changes(document_cls, group)
+            except Exception as error:
+                for change in group:
+                    _resolve(change.future, error)
+
+    async def _flush_purchases(self, purchases: list[_Purchase]) -> None:
+        groups: defaultdict[PydanticObjectId, list[_Purchase]] = defaultdict(
+            list
+        )
+
+        for purchase in purchases:
+            groups[purchase.lottery_id].append(purchase)
+
+        for lottery_id, group in groups.items():
+            try:
+                lottery = await self._get_lottery(lottery_id)
+                await lottery.add_paid_tickets(
+                    (purchase.user_id, purchase.quantity) for purchase in group
+                )
+            except Exception as error:
+                self._lotteries.pop(lottery_id, None)
+
+                for purchase in group:
+                    _resolve(purchase.future, error)
+            else:
+                for purchase in group:
+                    _resolve(purchase.future, None)
+
+    async def _get_lottery(self, lottery_id: PydanticObjectId) -> Lottery:
+        """Get a lottery, which stays up to date in memory because this
+        worker is the only one buying its tickets."""
+        if lottery_id not in self._lotteries:
+            lottery = await Lottery.get(lottery_id)
+
+            if lottery is None:
+                raise ValueError("Lottery not found")
+
+            self._lotteries[lottery_id] = lottery
+
+        return self._lotteries[lottery_id]
+
+
+class Router:
+    """Sends updates to the workers that own them, such as to run every
+    shard in a single process.
+
+    Attributes:
+        workers (Sequence[ShardWorker]): The worker for each shard, in
+            shard order.
+    """
+
+    def __init__(self, workers: Sequence[ShardWorker]):
+        if [worker.shard for worker in workers] != list(range(len(workers))):
+            raise ValueError("There must be one worker for each shard")
+
+        if any(worker.shards != len(workers) for worker in workers):
+            raise ValueError("There must be one worker for each shard")
+
+        self.workers = workers
+
+    @classmethod
+    def create(cls, shards: int, **options) -> Self:
+        """Create a router with a new worker for each shard.
+
+        Args:
+            shards (int): The number of shards.
+            **options: Options for each ShardWorker.
+
+        Returns:
+            Router: The router.
+        """
+        return cls(
+            [ShardWorker(shard, shards, **options) for shard in range(shards)]
+        )
+
+    async def __aenter__(self) -> Self:
+        for worker in self.workers:
+            worker.start()
+
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+
+    def worker_for(self, key: object) -> ShardWorker:
+        """Get the worker that owns an account or lottery.
+
+        Args:
+            key (object): The ID of the account or lottery.
+
+        Returns:
+            ShardWorker: The owning worker.
+        """
+        return self.workers[shard_of(key, len(self.workers))]
+
+    async def change_balance(
+        self,
+        document_cls: type[User] | type[Pool],
+        document_id: PydanticObjectId,
+        amount: int,
+        reason: Optional[str] = None,
+    ) -> None:
+        """Change an account's balance through its owning worker.
+
+        See ShardWorker.change_balance.
+        """
+        await self.worker_for(document_id).change_balance(
+            document_cls, document_id, amount, reason
+        )
+
+    async def buy_tickets(
+        self,
+        lottery_id: PydanticObjectId,
+        user_id: PydanticObjectId,
+        quantity: int = 1,
+    ) -> None:
+        """Buy lottery tickets, debiting the buyer through their owning
+        worker and adding the tickets through the lottery's.
+
+        See ShardWorker.buy_tickets.
+        """
+        await _buy_tickets(
+            self.worker_for(lottery_id),
+            self.worker_for(user_id),
+            lottery_id,
+            user_id,
+            quantity,
+        )
+
+
+class ProcessRouter:
+    """Runs the worker for each shard in its own process and sends
+    updates to the process that owns them.
+
+    Each process connects by awaiting init, then runs a ShardWorker, so
+    every update to an account or lottery is made by one process while
+    different shards are written in parallel. Ticket purchases are
+    priced and added by the lottery's process and debited by the
+    buyer's, which refunds them if the lottery was completed in
+    between.
+
+    Processes are started with spawn, so init, options, arguments and
+    results must be picklable, and init must be importable, like a
+    module-level function or a functools.partial of one.
+
+    Attributes:
+        shards (int): The number of shards.
+        init (Callable[[], Awaitable[object]]): Connects each process to
+            the database.
+        options (dict[str, Any]): Options for each ShardWorker.
+    """
+
+    def __init__(
+        self,
+        shards: int,
+        init: Callable[[], Awaitable[object]] = init_db,
+        **options: Any,
+    ):
+        if shards < 1:
+            raise ValueError("There must be at least one shard")
+
+        self.shards = shards
+        self.init = init
+        self.options = options
+
+        self._processes: list[BaseProcess] = []
+        self._requests: list[Queue] = []
+        self._responses: Optional[Queue] = None
+        self._pending: dict[int, tuple[int, asyncio.Future]] = {}
+        self._request_ids = count(shards)
+        self._reader: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def __aenter__(self) -> Self:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    async def start(self) -> None:
+        """Start a process for each shard, returning once they're all
+        ready.
+
+        Raises:
+            RuntimeError: If the router is already running.
+            Exception: Whatever init raised in a process.
+        """
+        if self._processes:
+            raise RuntimeError("Router is already running")
+
+        context = multiprocessing.get_context("spawn")
+        self._responses = context.Queue()
+        self._requests = [context.Queue() for _ in range(self.shards)]
+        self._processes = [
+            context.Process(
+                target=_serve,
+                args=(
+                    shard,
+                    self.shards,
+                    self.init,
+                    self.options,
+                    self._requests[shard],
+                    self._responses,
+                ),
+                daemon=True,
+            )
+            for shard in range(self.shards)
+        ]
+        loop = asyncio.get_running_loop()
+        ready = []
+
+        # Each process answers the request with its shard's ID once
+        # it's ready, so requests are numbered after them
+        self._request_ids = count(self.shards)
+
+        for shard, process in enumerate(self._processes):
+            future = loop.create_future()
+            self._pending[shard] = (shard, future)
+            ready.append(future)
+            process.start()
+
+        self._closing = False
+        self._reader = asyncio.create_task(self._read())
+
+        results = await asyncio.gather(*ready, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, BaseException):
+                await self.stop()
+                raise result
+
+    async def stop(self) -> None:
+        """Write every queued update, then stop every process.
+
+        Wait for purchases in progress first, as a buyer debited by one
+        process can't be given their tickets once the other has stopped.
+        """
+        if not self._processes:
+            return
+
+        for requests in self._requests:
+            requests.put(None)
+
+        loop = asyncio.get_running_loop()
+
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join)
+
+        self._closing = True
+        await self._reader
+
+        self._processes = []
+        self._requests = []
+        self._responses = None
+        self._reader = None
+
+    def worker_for(self, key: object) -> "_RemoteWorker":
+        """Get a proxy for the process that owns an account or lottery.
+
+        Args:
+            key (object): The ID of the account or lottery.
+
+        Returns:
+            _RemoteWorker: A proxy for the owning worker.
+        """
+        return _RemoteWorker(self, shard_of(key, self.shards))
+
+    async def change_balance(
+        self,
+        document_cls: type[User] | type[Pool],
+        document_id: PydanticObjectId,
+        amount: int,
+        reason: Optional[str] = None,
+    ) -> None:
+        """Change an account's balance through its owning process.
+
+        See ShardWorker.change_balance.
+        """
+        await self.worker_for(document_id).change_balance(
+            document_cls, document_id, amount, reason
+        )
+
+    async def buy_tickets(
+        self,
+        lottery_id: PydanticObjectId,
+        user_id: PydanticObjectId,
+        quantity: int = 1,
+    ) -> None:
+        """Buy lottery tickets, debiting the buyer through their owning
+        process and adding the tickets through the lottery's.
+
+        See ShardWorker.buy_tickets.
+        """
+        await _buy_tickets(
+            self.worker_for(lottery_id),
+            self.worker_for(user_id),
+            lottery_id,
+            user_id,
+            quantity,
+        )
+
+    async def _call(self, shard: int, method: str, *args: Any) -> Any:
+        """Call a method of a shard's worker and wait for the result."""
+        if not self._processes or self._closing:
+            raise RuntimeError("Router isn't running")
+
+        if not self._processes[shard].is_alive():
+            raise RuntimeError("Shard process has stopped")
+
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (shard, future)
+        self._requests[shard].put((request_id, method, args))
+
+        return await future
+
+    def _get_response(self) -> Optional[tuple[int, Any, Optional[Exception]]]:
+        try:
+            return self._responses.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            return None
+
+    async def _read(self) -> None:
+        """Resolve requests as their responses arrive, failing those
+        sent to processes that have stopped."""
+        loop = asyncio.get_running_loop()
+
+        while True:
+            response = await loop.run_in_executor(None, self._get_response)
+
+            if response is not None:
+                request_id, result, error = response
+
+                if request_id in self._pending:
+                    _, future = self._pending.pop(request_id)
+
+                    if not future.done():
+                        if error is None:
+                            future.set_result(result)
+                        else:
+                            future.set_exception(error)
+
+                continue
+
+            stopped = {
+                shard
+                for shard, process in enumerate(self._processes)
+                if not process.is_alive()
+            }
+
+            for request_id, (shard, future) in list(self._pending.items()):
+                if shard in stopped:
+                    del self._pending[request_id]
+                    _resolve(future, RuntimeError("Shard process has stopped"))
+
+            if self._closing:
+                return
+
+
+class _RemoteWorker:
+    """Calls the worker running in a ProcessRouter's process."""
+
+    def __init__(self, router: ProcessRouter, shard: int):
+        self.router = router
+        self.shard = shard
+
+    async def change_balance(
+        self,
+        document_cls: type[User] | type[Pool],
+        document_id: PydanticObjectId,
+        amount: int,
+        reason: Optional[str] = None,
+    ) -> None:
+        await self.router._call(
+            self.shard,
+            "change_balance",
+            document_cls,
+            document_id,
+            amount,
+            reason,
+        )
+
+    async def _quote_tickets(
+        self, lottery_id: PydanticObjectId, quantity: int
+    ) -> int:
+        return await self.router._call(
+            self.shard, "_quote_tickets", lottery_id, quantity
+        )
+
+    async def _add_tickets(
+        self,
+        lottery_id: PydanticObjectId,
+        user_id: PydanticObjectId,
+        quantity: int,
+    ) -> None:
+        await self.router._call(
+            self.shard, "_add_tickets", lottery_id, user_id, quantity
+        )
+
+
+async def _buy_tickets(
+    lottery_worker: ShardWorker | _RemoteWorker,
+    buyer_worker: ShardWorker | _RemoteWorker,
+    lottery_id: PydanticObjectId,
+    user_id: PydanticObjectId,
+    quantity: int,
+) -> None:
+    """Buy tickets through the lottery's worker, debiting the buyer
+    through theirs first and refunding them if no tickets were added."""
+    cost = await lottery_worker._quote_tickets(lottery_id, quantity)
+
+    await buyer_worker.change_balance(User, user_id, -cost, "Lottery ticket")
+
+    try:
+        await lottery_worker._add_tickets(lottery_id, user_id, quantity)
+    except ValueError:
+        await buyer_worker.change_balance(User, user_id, cost, "Ticket refund")
+        raise
+
+
+def _serve(
+    shard: int,
+    shards: int,
+    init: Callable[[], Awaitable[object]],
+    options: dict[str, Any],
+    requests: Queue,
+    responses: Queue,
+) -> None:
+    """Run a shard's worker in a ProcessRouter's process."""
+    asyncio.run(
+        _serve_requests(shard, shards, init, options, requests, responses)
+    )
+
+
+async def _serve_requests(
+    shard: int,
+    shards: int,
+    init: Callable[[], Awaitable[object]],
+    options: dict[str, Any],
+    requests: Queue,
+    responses: Queue,
+) -> None:
+    try:
+        await init()
+        worker = ShardWorker(shard, shards, **options)
+    except Exception as error:
+        responses.put((shard, None, error))
+        return
+
+    loop = asyncio.get_running_loop()
+    tasks: set[asyncio.Task] = set()
+
+    async with worker:
+        responses.put((shard, None, None))
+
+        while request := await loop.run_in_executor(None, requests.get):
+            request_id, method, args = request
+            task = asyncio.create_task(
+                _answer(worker, request_id, method, args, responses)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        await asyncio.gather(*tasks)
+
+    await Transaction.flush()
+
+
+async def _answer(
+    worker: ShardWorker,
+    request_id: int,
+    method: str,
+    args: tuple,
+    responses: Queue,
+) -> None:
+    if method not in _REMOTE_METHODS:
+        responses.put(
+            (request_id, None, ValueError(f"Unknown method {method!r}"))
+        )
+        return
+
+    try:
+        result = await getattr(worker, method)(*args)
+    except Exception as error:
+        responses.put((request_id, None, error))
+    else:
+        responses.put((request_id, result, None))
+
+
+async def _apply_changes(
+    document_cls: type[User] | type[Pool], changes: list[_BalanceChange]
+) -> None:
+    """Apply balance changes to one model in arrival order.
+
+    Each change is checked against a running total starting from the
+    stored balance, so a rejected change doesn't fail anyone else's.
+    The accepted changes to each account are combined into one
+    conditional $inc, which only fails if the balance was lowered
+    outside the worker since it was read.
+    """
+    collection = document_cls.get_motor_collection()
+    balances = {
+        document["_id"]: document["balance"]
+        async for document in collection.find(
+            {"_id": {"$in": list({change.document_id for change in changes})}},
+            projection={"balance": True},
+        )
+    }
+    accepted = []
+
+    for change in changes:
+        balance = balances.get(change.document_id)
+
+        if balance is None:
+            _resolve(change.future, ValueError("Account not found"))
+        elif balance + change.amount < 0:
+            _resolve(change.future, ValueError("Balance cannot be negative"))
+        else:
+            balances[change.document_id] = balance + change.amount
+            accepted.append(change)
+
+    try:
+        failed = set(
+            await bulk_inc_balances(
+                document_cls,
+                [(change.document_id, change.amount) for change in accepted],
+            )
+        )
+    finally:
+        if invalidate := getattr(document_cls, "_invalidate_ids", None):
+            invalidate(balances)
+
+    reasons: defaultdict[
+        Optional[str], list[tuple[PydanticObjectId, int]]
+    ] = defaultdict(list)
+
+    for change in accepted:
+        if change.document_id not in failed:
+            reasons[change.reason].append((change.document_id, change.amount))
+
+    for reason, applied in reasons.items():
+        await Transaction.record_changes(applied, reason)
+
+    for change in accepted:
+        _resolve(
+            change.future,
+            ValueError("Balance cannot be negative")
+            if change.document_id in failed
+            else None,
+        )
+
+
+def _resolve(future: asyncio.Future, error: Optional[BaseException]) -> None:
+    if future.done():
+        return
+
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
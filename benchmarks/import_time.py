@@ -0,0 +1,66 @@
+"""Benchmark how long importing benbucks_core takes.
+
+Each import runs in a fresh interpreter, and the fastest of several runs
+is reported to reduce noise. The run fails if the import takes longer
+than the budget or loads a heavy dependency.
+
+Usage:
+    python -m benchmarks.import_time [--runs N] [--max-ms MS]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ("beanie", "bson", "motor", "pydantic", "pymongo")
+MAX_MS = 50.0
+
+SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import benbucks_core
+benbucks_core.format_money(0)
+elapsed = time.perf_counter() - start
+heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+print(json.dumps({{"ms": elapsed * 1000, "heavy": heavy}}))
+"""
+
+
+def measure() -> dict[str, float | list[str]]:
+    """Import benbucks_core in a fresh interpreter."""
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+
+    return json.loads(output)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, default=MAX_MS)
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.runs)]
+    fastest = min(result["ms"] for result in results)
+    heavy = sorted({name for result in results for name in result["heavy"]})
+
+    print(f"import benbucks_core: {fastest:.2f} ms")
+
+    if heavy:
+        print("Heavy modules imported:", ", ".join(heavy))
+        return 1
+
+    if fastest > args.max_ms:
+        print(f"Slower than the {args.max_ms} ms budget")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
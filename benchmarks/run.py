@@ -0,0 +1,395 @@
+"""Benchmark model operations against MongoDB or the in-memory database.
+
+Each benchmark reports operations per second, p50 and p99 latency, and
+the average number of database round trips per operation. Round trips
+are deterministic, so they're compared with the stored baseline on
+every run. Throughput depends on the machine, so it's only compared
+when a tolerance is given.
+
+By default the benchmarks run against the in-memory database, which is
+mongomock. It scans whole collections, so its throughput and latency
+mostly measure mongomock and get worse as collections grow. Only the
+round trips are meaningful there. Pass --uri to measure throughput and
+latency against a real server, such as a local mongod. Each benchmark
+drops and recreates the benchmark database on it. Baselines are kept
+separately for each engine.
+
+Usage:
+    python -m benchmarks.run [--uri URI] [--scale N] [--concurrency N]
+        [--only NAME ...] [--tolerance FRACTION] [--update-baseline]
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import random
+import statistics
+import sys
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from benbucks_core import (
+    Lottery,
+    Pool,
+    Transaction,
+    TriviaQuestion,
+    User,
+    close_db,
+    get_client,
+    init_db,
+    init_memory_db,
+)
+
+BASELINE_PATHS = {
+    "memory": Path(__file__).with_name("baseline.json"),
+    "mongodb": Path(__file__).with_name("baseline_mongodb.json"),
+}
+DATABASE = "benchmark"
+SEED = 0
+ROUND_TRIP_METHODS = (
+    "aggregate",
+    "bulk_write",
+    "count_documents",
+    "delete_many",
+    "delete_one",
+    "find",
+    "find_one",
+    "find_one_and_update",
+    "insert_many",
+    "insert_one",
+    "replace_one",
+    "update_many",
+    "update_one",
+)
+
+_round_trips: ContextVar[list[int] | None] = ContextVar(
+    "round_trips", default=None
+)
+
+
+class Result(NamedTuple):
+    """The measurements from a benchmark."""
+
+    operations: int
+    ops_per_sec: float
+    p50_ms: float
+    p99_ms: float
+    round_trips: float
+
+
+class Timer:
+    """Times operations and counts their round trips."""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.round_trips = 0
+        self.first_start = float("inf")
+        self.last_end = 0.0
+
+    @asynccontextmanager
+    async def __call__(self) -> AsyncIterator[None]:
+        counter = [0]
+        token = _round_trips.set(counter)
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.latencies.append(end - start)
+            self.first_start = min(self.first_start, start)
+            self.last_end = max(self.last_end, end)
+            self.round_trips += counter[0]
+            _round_trips.reset(token)
+
+    def result(self) -> Result:
+        """Summarize the timed operations, excluding time spent outside
+        them before the first and after the last."""
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+
+        return Result(
+            count,
+            round(count / (self.last_end - self.first_start), 1),
+            round(statistics.median(latencies) * 1000, 3),
+            round(latencies[min(count - 1, count * 99 // 100)] * 1000, 3),
+            round(self.round_trips / count, 2),
+        )
+
+
+def count_round_trips() -> None:
+    """Wrap every model's collection methods to count calls made while
+    an operation is being timed."""
+    for model in (Lottery, Pool, Transaction, TriviaQuestion, User):
+        collection = model.get_motor_collection()
+
+        for name in ROUND_TRIP_METHODS:
+            setattr(collection, name, _counted(getattr(collection, name)))
+
+
+def _counted(method: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if (counter := _round_trips.get()) is not None:
+            counter[0] += 1
+
+        return method(*args, **kwargs)
+
+    return wrapper
+
+
+async def make_users(count: int, balance: int = 10**9) -> list[User]:
+    users = [User(name=f"user{i}", balance=balance) for i in range(count)]
+    await User.insert_many(users)
+
+    return [user async for user in User.find_all()]
+
+
+async def make_lottery(users: list[User]) -> Lottery:
+    lottery = Lottery(
+        name="benchmark",
+        prize=0,
+        ticket_price=100,
+        prize_increase=50,
+        pool_increases=[("jackpot", 20), ("charity", 10)],
+    )
+
+    for user in users:
+        await lottery.buy_ticket(user)
+
+    return lottery
+
+
+async def bench_change_balance(
+    timer: Timer, rng: random.Random, scale: int, concurrency: int
+) -> None:
+    users = await make_users(scale)
+
+    async def worker() -> None:
+        for _ in range(scale):
+            user = rng.choice(users)
+
+            async with timer():
+                await user.change_balance(rng.randint(-100, 100))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def bench_contribute_to_pool(
+    timer: Timer, rng: random.Random, scale: int, concurrency: int
+) -> None:
+    users = await make_users(scale)
+    pool = await Pool.get_by_code("benchmark")
+
+    async def worker() -> None:
+        for _ in range(scale):
+            async with timer():
+                await rng.choice(users).contribute_to_pool(pool, 10)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def bench_buy_ticket(
+    timer: Timer, rng: random.Random, scale: int, concurrency: int
+) -> None:
+    users = await make_users(scale)
+    lottery = await make_lottery([])
+
+    async def worker() -> None:
+        for _ in range(scale):
+            async with timer():
+                await lottery.buy_ticket(rng.choice(users))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def bench_complete(
+    timer: Timer, rng: random.Random, scale: int, concurrency: int
+) -> None:
+    users = await make_users(scale)
+
+    for _ in range(max(1, scale // 100)):
+        lottery = await make_lottery(users)
+
+        async with timer():
+            await lottery.complete(winners=3, splits=(50, 30, 20))
+
+
+async def bench_get_chance(
+    timer: Timer, rng: random.Random, scale: int, concurrency: int
+) -> None:
+    users = await make_users(scale)
+    lottery = await make_lottery(users)
+
+    for _ in range(scale):
+        async with timer():
+            await lottery.get_chance(rng.choice(users))
+
+
+async def bench_get_by_code(
+    timer: Timer, rng: random.Random, scale: int, concurrency: int
+) -> None:
+    codes = [f"pool{i}" for i in range(max(1, scale // 10))]
+
+    for code in codes:
+        await Pool.get_by_code(code)
+
+    for _ in range(scale):
+        async with timer():
+            await Pool.get_by_code(rng.choice(codes))
+
+
+async def bench_get_by_code_cached(
+    timer: Timer, rng: random.Random, scale: int, concurrency: int
+) -> None:
+    Pool.enable_cache()
+
+    try:
+        await bench_get_by_code(timer, rng, scale, concurrency)
+    finally:
+        Pool.disable_cache()
+
+
+BENCHMARKS: dict[
+    str, Callable[[Timer, random.Random, int, int], Awaitable[None]]
+] = {
+    "change_balance": bench_change_balance,
+    "contribute_to_pool": bench_contribute_to_pool,
+    "buy_ticket": bench_buy_ticket,
+    "complete": bench_complete,
+    "get_chance": bench_get_chance,
+    "get_by_code": bench_get_by_code,
+    "get_by_code_cached": bench_get_by_code_cached,
+}
+
+
+async def run(
+    name: str, scale: int, concurrency: int, uri: str | None = None
+) -> Result:
+    """Run a benchmark against a fresh database, on the server at the
+    URI if given, or in memory otherwise."""
+    if uri is None:
+        await init_memory_db(DATABASE)
+    else:
+        client = get_client(uri)
+        await client.drop_database(DATABASE)
+        await init_db(client, DATABASE)
+
+    try:
+        count_round_trips()
+
+        timer = Timer()
+        await BENCHMARKS[name](timer, random.Random(SEED), scale, concurrency)
+        await Transaction.flush()
+    finally:
+        if uri is not None:
+            await client.drop_database(DATABASE)
+
+        close_db()
+
+    return timer.result()
+
+
+def compare(
+    results: dict[str, Result],
+    baseline: dict[str, Any],
+    tolerance: float | None,
+) -> list[str]:
+    """Get a description of each regression from the baseline."""
+    regressions = []
+
+    for name, result in results.items():
+        if (expected := baseline["results"].get(name)) is None:
+            continue
+
+        if result.round_trips > expected["round_trips"]:
+            regressions.append(
+                f"{name}: {result.round_trips} round trips per operation, "
+                f"baseline {expected['round_trips']}"
+            )
+
+        minimum = expected["ops_per_sec"] * (1 - (tolerance or 0))
+
+        if tolerance is not None and result.ops_per_sec < minimum:
+            regressions.append(
+                f"{name}: {result.ops_per_sec} ops/sec, "
+                f"baseline {expected['ops_per_sec']}"
+            )
+
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--uri", help="the MongoDB server to run against, instead of memory"
+    )
+    parser.add_argument("--scale", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="fail if ops/sec drops by more than this fraction",
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = {}
+    print(
+        f"{'benchmark':<20} {'ops':>7} {'ops/sec':>10} "
+        f"{'p50 ms':>8} {'p99 ms':>8} {'trips/op':>9}"
+    )
+
+    for name in args.only or BENCHMARKS:
+        result = asyncio.run(run(name, args.scale, args.concurrency, args.uri))
+        results[name] = result
+        print(
+            f"{name:<20} {result.operations:>7} {result.ops_per_sec:>10} "
+            f"{result.p50_ms:>8} {result.p99_ms:>8} {result.round_trips:>9}"
+        )
+
+    parameters = {"scale": args.scale, "concurrency": args.concurrency}
+    baseline_path = BASELINE_PATHS["memory" if args.uri is None else "mongodb"]
+
+    if args.update_baseline:
+        baseline = {"parameters": parameters, "results": {}}
+
+        if baseline_path.exists():
+            baseline = json.loads(baseline_path.read_text())
+
+        if baseline["parameters"] != parameters:
+            baseline = {"parameters": parameters, "results": {}}
+
+        baseline["results"].update(
+            {name: result._asdict() for name, result in results.items()}
+        )
+        baseline_path.write_text(
+            json.dumps(baseline, indent=4) + "\n", newline="\r\n"
+        )
+        return 0
+
+    if not baseline_path.exists():
+        print("\nNot compared, there's no baseline for this engine")
+        return 0
+
+    baseline = json.loads(baseline_path.read_text())
+
+    if baseline["parameters"] != parameters:
+        print("\nNot compared, the baseline used", baseline["parameters"])
+        return 0
+
+    if regressions := compare(results, baseline, args.tolerance):
+        print("\nRegressions:", *regressions, sep="\n  ")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+import asyncio
+
+import pytest
+
+from benbucks_core import Lottery, Pool, Transaction, User, batch
+from benbucks_core._session import run_in_transaction
+from benbucks_core.transaction import OPENING_BALANCE
+
+
+async def stored_balance(document):
+    stored = (
+        await type(document)
+        .get_motor_collection()
+        .find_one({"_id": document.id})
+    )
+    return stored["balance"]
+
+
+@pytest.fixture
+def bulk_writes(mongo_mock_client, monkeypatch):
+    calls = []
+
+    for model in (Pool, User):
+        collection = model.get_motor_collection()
+
+        async def counting_bulk_write(
+            requests,
+            *args,
+            model=model,
+            bulk_write=collection.bulk_write,
+            **kwargs
+        ):
+            calls.append((model.__name__, len(requests)))
+            return await bulk_write(requests, *args, **kwargs)
+
+        monkeypatch.setattr(collection, "bulk_write", counting_bulk_write)
+
+    return calls
+
+
+async def test_batch_coalesces_writes(bulk_writes):
+    """Test that batched changes are combined into one bulk write per
+    collection."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+    pool = await Pool.get_by_code("test")
+
+    async with batch():
+        for _ in range(5):
+            await user.change_balance(-100)
+            await pool.change_balance(100)
+
+        await user.change_balance(-50)
+        await user.change_name("renamed")
+        await user.set_pin("1234")
+
+        assert user.balance == 450
+        assert pool.balance == 500
+        assert await stored_balance(user) == 1000
+        assert await stored_balance(pool) == 0
+
+    assert sorted(bulk_writes) == [("Pool", 1), ("User", 1)]
+
+    stored = await User.get(user.id)
+    assert stored.balance == 450
+    assert stored.name == "renamed"
+    assert stored.pin == "1234"
+    assert (await Pool.get_by_code("test")).balance == 500
+
+
+async def test_batch_checks_balances(mongo_mock_client):
+    """Test that balances are checked when changed in a batch."""
+    user = User(name="test", balance=100)
+    await user.insert()
+
+    async with batch():
+        with pytest.raises(ValueError):
+            await user.change_balance(-200)
+
+        await user.change_balance(-100)
+
+    assert await stored_balance(user) == 0
+
+
+async def test_batch_rejected(mongo_mock_client):
+    """Test that updates rejected when written raise an error without
+    stopping the rest."""
+    first = User(name="first", balance=100)
+    second = User(name="second", balance=100)
+    await User.insert_many([first, second])
+    first = await User.find_one(User.name == "first")
+    second = await User.find_one(User.name == "second")
+
+    with pytest.raises(ValueError):
+        async with batch():
+            await first.change_balance(-100)
+            await second.change_balance(50)
+            await User.get_motor_collection().update_one(
+                {"_id": first.id}, {"$set": {"balance": 0}}
+            )
+
+    assert await stored_balance(first) == 0
+    assert await stored_balance(second) == 150
+
+
+async def test_batch_rejected_ledger(mongo_mock_client):
+    """Test that rejected changes aren't recorded in the ledger and are
+    undone in memory."""
+    user = User(name="test", balance=200)
+    other = User(name="other")
+    await User.insert_many([user, other])
+    user = await User.find_one(User.name == "test")
+    other = await User.find_one(User.name == "other")
+    await User.get_motor_collection().update_one(
+        {"_id": user.id}, {"$set": {"balance": 0}}
+    )
+
+    with pytest.raises(ValueError):
+        async with batch() as pending:
+            await user.change_balance(-150)
+            await other.change_balance(100)
+            assert await User.bulk_change_balances([(user.id, 10)]) == []
+
+            await Transaction.flush()
+            assert (
+                await Transaction.find(
+                    Transaction.reason != OPENING_BALANCE
+                ).count()
+                == 0
+            )
+
+    assert pending.rejected_ids == {user.id}
+    assert user.balance == 200
+    assert other.balance == 100
+    assert await stored_balance(user) == 0
+
+    # Only the opening balance, as the stored balance was reset behind
+    # the ledger's back
+    await Transaction.flush()
+    assert await Transaction.net_change(user.id) == 200
+    assert await Transaction.net_change(other.id) == 100
+
+
+async def test_batch_max_delay(mongo_mock_client):
+    """Test that batched changes are written in the background after
+    the maximum delay."""
+    user = User(name="test", balance=100)
+    await user.insert()
+
+    async with batch(max_delay=0.01):
+        await user.change_balance(50)
+        await asyncio.sleep(0.05)
+
+        assert await stored_balance(user) == 150
+
+        await user.change_balance(25)
+
+    assert await stored_balance(user) == 175
+
+
+async def test_batch_nested(mongo_mock_client):
+    """Test that nested batches share the outermost batch."""
+    user = User(name="test", balance=100)
+    await user.insert()
+
+    async with batch() as outer:
+        async with batch() as inner:
+            assert inner is outer
+            await user.change_balance(50)
+
+        assert await stored_balance(user) == 100
+
+    assert await stored_balance(user) == 150
+
+
+async def test_batch_no_transaction(mongo_mock_client):
+    """Test that writes in a batch don't use transactions."""
+
+    async def callback(session):
+        assert session is None
+
+    async with batch():
+        await run_in_transaction(User, callback)
+
+
+async def test_batch_lottery(bulk_writes):
+    """Test that lottery purchases and payouts in a batch write the
+    pending updates first, then run straight away."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+
+    lottery = Lottery(
+        name="test",
+        prize=0,
+        ticket_price=100,
+        prize_increase=100,
+        pool_increases=[("test", 10)],
+    )
+
+    async with batch():
+        await user.change_balance(500)
+        assert await stored_balance(user) == 1000
+
+        for _ in range(3):
+            await lottery.buy_ticket(user)
+
+        assert await stored_balance(user) == 1200
+        assert (await Pool.get_by_code("test")).balance == 30
+
+        await lottery.complete()
+        assert await stored_balance(user) == 1500
+
+    assert bulk_writes[0] == ("User", 1)
+
+
+async def test_batch_transfer_rejected(mongo_mock_client):
+    """Test that a transfer in a batch isn't queued, so a rejected
+    debit never leaves its credit applied."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+    pool = await Pool.get_by_code("test")
+    await User.get_motor_collection().update_one(
+        {"_id": user.id}, {"$set": {"balance": 0}}
+    )
+
+    async with batch():
+        with pytest.raises(ValueError):
+            await user.contribute_to_pool(pool, 800)
+
+    assert (await Pool.get_by_code("test")).balance == 0
+
+    await Transaction.flush()
+    assert not await Transaction.find_one(
+        Transaction.reason == "Pool contribution"
+    )
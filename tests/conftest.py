@@ -1,10 +1,17 @@
 import pytest
-from mongomock_motor import AsyncMongoMockClient
 
-from benbucks_core import init_db
+from benbucks_core import Transaction, close_db, init_memory_db
 
 
 @pytest.fixture
 async def mongo_mock_client():
-    client = AsyncMongoMockClient()
-    await init_db(client, "test")
+    client = await init_memory_db("test")
+    yield client
+    await Transaction.flush()
+
+
+@pytest.fixture(autouse=True)
+def unbound():
+    """Let each test initialize its own database."""
+    yield
+    close_db()
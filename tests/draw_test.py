@@ -0,0 +1,71 @@
+from collections import Counter
+
+import pytest
+
+from benbucks_core._draw import FenwickTree, SeededRandom, draw, split_prize
+
+
+def test_fenwick_tree_find():
+    """Test that tickets are found on the right items."""
+    tree = FenwickTree([3, 0, 1, 5])
+
+    assert tree.total == 9
+    items = [tree.find(ticket) for ticket in range(9)]
+    assert items == [0, 0, 0, 2, 3, 3, 3, 3, 3]
+
+
+def test_fenwick_tree_add():
+    """Test that weights can be changed."""
+    tree = FenwickTree([3, 0, 1, 5])
+    tree.add(0, -3)
+    tree.add(1, 2)
+
+    assert tree.total == 8
+    assert [tree.find(ticket) for ticket in range(3)] == [1, 1, 2]
+
+
+def test_seeded_random_repeatable():
+    """Test that the same seed gives the same numbers."""
+    first = SeededRandom(b"seed")
+    second = SeededRandom(b"seed")
+
+    numbers = [first.randbelow(1000) for _ in range(100)]
+
+    assert numbers == [second.randbelow(1000) for _ in range(100)]
+    assert all(0 <= number < 1000 for number in numbers)
+    assert len(set(numbers)) > 50
+
+
+def test_draw_weighted():
+    """Test that items are drawn in proportion to their weights."""
+    counts = Counter(
+        draw([1, 0, 3], 1, False, seed.to_bytes(2, "big"))[0]
+        for seed in range(4000)
+    )
+
+    assert counts[1] == 0
+    assert counts[2] / counts[0] == pytest.approx(3, rel=0.15)
+
+
+def test_draw_without_replacement():
+    """Test that items are drawn at most once without replacement."""
+    assert sorted(draw([5, 1, 2], 5, False, b"seed")) == [0, 1, 2]
+
+
+def test_draw_with_replacement():
+    """Test that items can be drawn repeatedly with replacement."""
+    assert draw([1], 3, True, b"seed") == [0, 0, 0]
+
+
+@pytest.mark.parametrize(
+    "prize,shares,expected",
+    [
+        (10000, [1], [10000]),
+        (10000, [50, 30, 20], [5000, 3000, 2000]),
+        (1000, [1, 1, 1], [334, 333, 333]),
+        (0, [1, 1], [0, 0]),
+    ],
+)
+def test_split_prize(prize, shares, expected):
+    """Test that prizes are split into whole cents."""
+    assert split_prize(prize, shares) == expected
@@ -0,0 +1,221 @@
+import subprocess
+import sys
+
+import pytest
+from bson import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+import benbucks_core
+from benbucks_core import (
+    Lottery,
+    Pool,
+    Transaction,
+    User,
+    _db,
+    close_db,
+    get_client,
+    init_db,
+    init_memory_db,
+    merge_duplicate_pools,
+    migrate_money,
+)
+
+
+def test_import_is_lazy():
+    """Test that importing the package doesn't import its heavy
+    dependencies."""
+    script = (
+        "import sys, benbucks_core\n"
+        "benbucks_core.format_money(0)\n"
+        "print(sorted(sys.modules))"
+    )
+    modules = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+
+    for name in ("beanie", "motor", "pydantic", "pymongo"):
+        assert f"'{name}'" not in modules
+
+
+def test_lazy_attributes():
+    """Test that lazily imported names can be accessed and listed."""
+    assert benbucks_core.User is User
+    assert set(benbucks_core.__all__) <= set(dir(benbucks_core))
+
+    with pytest.raises(AttributeError):
+        benbucks_core.Missing
+
+
+async def test_init_db_idempotent(monkeypatch):
+    """Test that initializing the same database again does nothing."""
+    calls = []
+    init_beanie = _db.init_beanie
+
+    async def counted_init_beanie(**kwargs):
+        calls.append(kwargs["database"].name)
+        await init_beanie(**kwargs)
+
+    monkeypatch.setattr(_db, "init_beanie", counted_init_beanie)
+    client = AsyncMongoMockClient()
+
+    assert await init_db(client, "first") is client
+    await init_db(client, "first", warm_up_connections=3)
+
+    assert calls == ["first"]
+    assert User.get_motor_collection().database.name == "first"
+
+
+async def test_init_db_other_database():
+    """Test that another database can't be initialized until the bound
+    one is closed."""
+    client = AsyncMongoMockClient()
+    await init_db(client, "first")
+
+    with pytest.raises(RuntimeError, match="close_db"):
+        await init_db(client, "second")
+
+    with pytest.raises(RuntimeError, match="close_db"):
+        await init_db(AsyncMongoMockClient(), "first")
+
+    assert User.get_motor_collection().database.name == "first"
+
+    close_db()
+    await init_db(client, "second")
+    assert User.get_motor_collection().database.name == "second"
+
+
+async def test_init_db_shared_client(monkeypatch):
+    """Test that the shared client is used by default."""
+    client = AsyncMongoMockClient()
+    monkeypatch.setitem(_db._clients, _db.DEFAULT_URI, client)
+
+    assert await init_db() is client
+    assert User.get_motor_collection().database.client is client
+
+
+async def test_get_client():
+    """Test that clients are shared and tuned."""
+    try:
+        client = get_client("mongodb://localhost:1")
+        assert get_client("mongodb://localhost:1") is client
+        assert client.options.pool_options.max_pool_size == 100
+        assert client.write_concern.document == {"w": "majority"}
+
+        other = get_client("mongodb://localhost:2", maxPoolSize=50)
+        assert other.options.pool_options.max_pool_size == 50
+    finally:
+        close_db()
+
+    assert get_client("mongodb://localhost:1") is not client
+    close_db()
+
+
+async def test_init_memory_db():
+    """Test that an in-memory database can be used like MongoDB."""
+    client = await init_memory_db("simulation")
+
+    user = User(name="test", balance=1000)
+    await user.insert()
+    pool = await Pool.get_by_code("test")
+    await user.contribute_to_pool(pool, 400)
+
+    assert User.get_motor_collection().database.name == "simulation"
+    assert (await User.get(user.id)).balance == 600
+    assert (await Pool.get_by_code("test")).balance == 400
+    assert await client["simulation"]["User"].count_documents({}) == 1
+
+    await Transaction.flush()
+
+
+async def test_init_memory_db_not_installed(monkeypatch):
+    """Test that a helpful error is raised without mongomock-motor."""
+    monkeypatch.setitem(sys.modules, "mongomock_motor", None)
+
+    with pytest.raises(ImportError, match="benbucks-core\\[memory\\]"):
+        await init_memory_db()
+
+
+async def test_migrate_money(mongo_mock_client):
+    """Test that documents storing amounts as floats are migrated to
+    cents."""
+    database = mongo_mock_client["test"]
+    await database["User"].insert_one({"name": "test", "balance": 12.34})
+    await database["Pool"].insert_one(
+        {"code": "abc", "name": "Pool", "balance": 0.1}
+    )
+    await database["Lottery"].insert_one(
+        {"name": "test", "prize": 100.0, "ticket_price": 2.5}
+    )
+    await User(name="new", balance=500).insert()
+
+    assert await migrate_money(database) == 3
+    assert await migrate_money(database) == 0
+
+    user = await User.find_one(User.name == "test")
+    assert user.balance == 1234
+
+    pool = await Pool.find_one(Pool.code == "abc")
+    assert pool.balance == 10
+
+    lottery = await Lottery.find_one(Lottery.name == "test")
+    assert lottery.prize == 10000
+    assert lottery.ticket_price == 250
+
+    raw = await database["User"].find_one({"name": "test"})
+    assert raw["balance"] == 1234
+    assert isinstance(raw["balance"], int)
+
+
+async def test_init_db_float_money():
+    """Test that a database storing amounts as floats isn't initialized
+    until they're migrated."""
+    client = AsyncMongoMockClient()
+    database = client["legacy"]
+    await database["User"].insert_one({"name": "test", "balance": 12.34})
+
+    with pytest.raises(RuntimeError, match="migrate_money"):
+        await init_db(client, "legacy")
+
+    assert await migrate_money(database) == 1
+    await init_db(client, "legacy")
+
+    user = await User.find_one(User.name == "test")
+    await user.change_balance(100)
+    assert (await User.get(user.id)).balance == 1334
+
+
+async def test_init_db_duplicate_pools():
+    """Test that pools sharing a code aren't merged at startup, and
+    that they can be merged explicitly."""
+    client = AsyncMongoMockClient()
+    database = client["legacy"]
+    first, second, other = ObjectId(), ObjectId(), ObjectId()
+
+    await database["Pool"].insert_many(
+        [
+            {"_id": first, "code": "a", "name": "Pool", "balance": 500},
+            {"_id": second, "code": "a", "name": "Pool", "balance": 250},
+            {"_id": other, "code": "b", "name": "Pool", "balance": 100},
+        ]
+    )
+    await database["Transaction"].insert_one(
+        {"source": None, "destination": second, "amount": 250}
+    )
+
+    with pytest.raises(RuntimeError, match="merge_duplicate_pools"):
+        await init_db(client, "legacy")
+
+    assert await database["Pool"].count_documents({}) == 3
+    assert await merge_duplicate_pools(database) == 1
+    await init_db(client, "legacy")
+
+    pools = await Pool.find_all().sort("code").to_list()
+    assert [(pool.id, pool.balance) for pool in pools] == [
+        (first, 750),
+        (other, 100),
+    ]
+    assert (await Transaction.find_one()).destination == first
+    assert await merge_duplicate_pools(database) == 0
@@ -0,0 +1,107 @@
+import logging
+
+import pytest
+
+from benbucks_core import Lottery, Pool, User, instrumentation
+
+
+@pytest.fixture
+def operations(mongo_mock_client):
+    operations = []
+    instrumentation.configure(operations.append)
+    yield operations
+    instrumentation.configure()
+
+
+@pytest.fixture
+def count_commands(mongo_mock_client, monkeypatch):
+    """Report a command to the listener for each balance update, since
+    mongomock doesn't send commands."""
+    collection = User.get_motor_collection()
+    find_one_and_update = collection.find_one_and_update
+
+    async def counted(*args, **kwargs):
+        instrumentation.command_listener.started(None)
+        return await find_one_and_update(*args, **kwargs)
+
+    monkeypatch.setattr(collection, "find_one_and_update", counted)
+
+
+async def test_instrumentation_disabled(mongo_mock_client, monkeypatch):
+    """Test that nothing is measured when instrumentation is
+    disabled."""
+    monkeypatch.setattr(instrumentation, "_report", None)
+
+    user = User(name="test", balance=100)
+    await user.change_balance(50)
+
+    assert user.balance == 150
+
+
+async def test_instrumentation_operations(operations, count_commands):
+    """Test that nested operations are each reported."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+    lottery = Lottery(name="test", prize=0, ticket_price=100)
+
+    await lottery.buy_ticket(user)
+
+    assert [operation.name for operation in operations] == [
+        "User.change_balance",
+        "Lottery.buy_tickets",
+        "Lottery.buy_ticket",
+    ]
+    assert [operation.db_calls for operation in operations] == [1, 1, 1]
+    assert all(operation.document_size > 0 for operation in operations)
+    assert not any(operation.failed for operation in operations)
+    assert not any(operation.slow for operation in operations)
+
+
+async def test_instrumentation_class_method(operations):
+    """Test that class methods have no document size."""
+    await Pool.get_by_code("test")
+
+    [operation] = operations
+    assert operation.name == "Pool.get_by_code"
+    assert operation.document_size == 0
+
+
+async def test_instrumentation_failed(operations):
+    """Test that operations raising exceptions are reported as
+    failed."""
+    user = User(name="test", balance=100)
+
+    with pytest.raises(ValueError):
+        await user.change_balance(-200)
+
+    [operation] = operations
+    assert operation.failed is True
+
+
+async def test_instrumentation_slow(mongo_mock_client, caplog):
+    """Test that slow operations are logged."""
+    instrumentation.configure(slow_threshold=0)
+
+    try:
+        with caplog.at_level(logging.WARNING):
+            await User(name="test").change_name("renamed")
+    finally:
+        instrumentation.configure()
+
+    assert "Slow operation User.change_name" in caplog.text
+
+
+async def test_instrumentation_hook_error(mongo_mock_client, caplog):
+    """Test that errors in the hook are logged instead of raised."""
+
+    def hook(operation):
+        raise RuntimeError
+
+    instrumentation.configure(hook)
+
+    try:
+        await User(name="test").change_name("renamed")
+    finally:
+        instrumentation.configure()
+
+    assert "Instrumentation hook failed for User.change_name" in caplog.text
@@ -1,150 +1,253 @@
+import asyncio
+import secrets
+
 import pytest
 
-from benbucks_core import Lottery, Pool, User
+from benbucks_core import Lottery, Pool, Transaction, User
 
 
 async def test_lottery_init(mongo_mock_client):
     """Test that a lottery can be created."""
-    lottery = Lottery(name="test", prize=100.0, ticket_price=10.0)
+    lottery = Lottery(name="test", prize=10000, ticket_price=1000)
 
     assert lottery.name == "test"
-    assert lottery.prize == 100.0
-    assert lottery.ticket_price == 10.0
-    assert lottery.prize_increase == 0.0
+    assert lottery.prize == 10000
+    assert lottery.ticket_price == 1000
+    assert lottery.prize_increase == 0
     assert lottery.pool_increases == []
-    assert lottery.tickets == []
+    assert lottery.tickets == {}
+    assert lottery.ticket_count == 0
     assert lottery.winner is None
     assert lottery.completed is False
 
 
 async def test_lottery_change_prize(mongo_mock_client):
     """Test that a lottery's prize can be changed."""
-    lottery = Lottery(name="test", prize=100.0, ticket_price=10.0)
-    assert lottery.prize == 100.0
+    lottery = Lottery(name="test", prize=10000, ticket_price=1000)
+    assert lottery.prize == 10000
 
-    await lottery.change_prize(10.0)
-    await lottery.change_prize(-5.0)
-    await lottery.change_prize(2.0)
+    await lottery.change_prize(1000)
+    await lottery.change_prize(-500)
+    await lottery.change_prize(200)
 
-    assert lottery.prize == 107.0
+    assert lottery.prize == 10700
 
 
 async def test_lottery_change_prize_negative(mongo_mock_client):
     """Test that a lottery's prize cannot be made negative."""
-    lottery = Lottery(name="test", prize=100.0, ticket_price=10.0)
-    assert lottery.prize == 100.0
+    lottery = Lottery(name="test", prize=10000, ticket_price=1000)
+    assert lottery.prize == 10000
+
+    await lottery.change_prize(-100)
+    assert lottery.prize == 9900
+
+    with pytest.raises(ValueError):
+        await lottery.change_prize(-10000)
+
+    assert lottery.prize == 9900
+
+
+async def test_lottery_change_prize_float(mongo_mock_client):
+    """Test that prize changes in whole units are rejected."""
+    lottery = Lottery(name="test", prize=10000, ticket_price=1000)
+    await lottery.insert()
+
+    with pytest.raises(TypeError):
+        await lottery.change_prize(1.5)
+
+    assert (await Lottery.get(lottery.id)).prize == 10000
+
+
+async def test_lottery_change_prize_stale_copy(mongo_mock_client):
+    """Test that changing the prize through a stale copy keeps tickets
+    bought since."""
+    user = User(name="test", balance=1000)
+    lottery = Lottery(
+        name="test", prize=10000, ticket_price=100, prize_increase=50
+    )
+    await lottery.insert()
+    copy = await Lottery.get(lottery.id)
+
+    await lottery.buy_tickets(user, 5)
+    assert await copy.change_prize(100) == 10350
+
+    stored = await Lottery.get(lottery.id)
+    assert stored.tickets == {str(user.id): 5}
+    assert stored.ticket_count == 5
+    assert stored.prize == 10350
+
+    with pytest.raises(ValueError):
+        await copy.change_prize(-20000)
 
-    await lottery.change_prize(-1.0)
-    assert lottery.prize == 99.0
+    assert (await Lottery.get(lottery.id)).prize == 10350
+
+
+async def test_lottery_change_prize_completed(mongo_mock_client):
+    """Test that a completed lottery's prize cannot be changed."""
+    lottery = Lottery(name="test", prize=10000, ticket_price=100)
+    await lottery.insert()
+    copy = await Lottery.get(lottery.id)
+    await lottery.complete()
+
+    with pytest.raises(ValueError):
+        await lottery.change_prize(100)
 
     with pytest.raises(ValueError):
-        await lottery.change_prize(-100.0)
+        await copy.change_prize(100)
 
-    assert lottery.prize == 99.0
+    assert (await Lottery.get(lottery.id)).prize == 10000
 
 
 async def test_lottery_buy_ticket(mongo_mock_client):
     """Test that a lottery ticket can be bought."""
-    user = User(name="test", balance=15.0)
+    user = User(name="test", balance=1500)
     pool1 = Pool(code="test1")
     pool2 = Pool(code="test2")
 
     lottery = Lottery(
         name="test",
-        prize=100.0,
-        ticket_price=10.0,
-        prize_increase=5.0,
-        pool_increases=[(pool1, 7.0), (pool2, 3.0)],
+        prize=10000,
+        ticket_price=1000,
+        prize_increase=500,
+        pool_increases=[(pool1, 700), (pool2, 300)],
     )
 
-    assert lottery.prize == 100.0
-    assert lottery.ticket_price == 10.0
-    assert lottery.prize_increase == 5.0
-    assert lottery.pool_increases == [(pool1, 7.0), (pool2, 3.0)]
-    assert lottery.tickets == []
+    assert lottery.prize == 10000
+    assert lottery.ticket_price == 1000
+    assert lottery.prize_increase == 500
+    assert lottery.pool_increases == [("test1", 700), ("test2", 300)]
+    assert lottery.tickets == {}
 
     await lottery.buy_ticket(user)
 
-    assert lottery.prize == 105.0
-    assert lottery.ticket_price == 10.0
-    assert lottery.prize_increase == 5.0
-    assert lottery.pool_increases == [(pool1, 7.0), (pool2, 3.0)]
-    assert lottery.tickets == [user]
+    assert lottery.prize == 10500
+    assert lottery.ticket_price == 1000
+    assert lottery.prize_increase == 500
+    assert lottery.pool_increases == [("test1", 700), ("test2", 300)]
+    assert lottery.tickets == {str(user.id): 1}
+    assert lottery.ticket_count == 1
 
-    assert user.balance == 5.0
-    assert pool1.balance == 7.0
-    assert pool2.balance == 3.0
+    assert user.balance == 500
+    assert (await Pool.get_by_code("test1")).balance == 700
+    assert (await Pool.get_by_code("test2")).balance == 300
+
+
+async def test_lottery_pool_increases_existing_pools(mongo_mock_client):
+    """Test that pool increases are applied to the stored pools and
+    recorded in the ledger."""
+    user = User(name="test", balance=5000)
+    pool = await Pool.get_by_code("test")
+    await pool.change_balance(100)
+
+    lottery = Lottery(
+        name="test",
+        prize=0,
+        ticket_price=1000,
+        pool_increases=[(pool, 200)],
+    )
+
+    await lottery.buy_tickets(user, 2)
+    await lottery.buy_ticket(user)
+
+    assert (await Pool.get_by_code("test")).balance == 700
+
+    await Transaction.flush()
+    assert await Transaction.net_change(pool.id) == 700
+    assert await Pool.find_all().count() == 1
+
+
+async def test_lottery_pool_increases_legacy(mongo_mock_client):
+    """Test that embedded pools are converted to codes."""
+    collection = Lottery.get_motor_collection()
+    await collection.insert_one(
+        {
+            "name": "test",
+            "prize": 0,
+            "ticket_price": 100,
+            "pool_increases": [[{"code": "test", "balance": 500}, 30]],
+        }
+    )
+
+    lottery = await Lottery.find_one()
+    assert lottery.pool_increases == [("test", 30)]
+
+    assert await Lottery.migrate_pool_increases() == 1
+    assert await Lottery.migrate_pool_increases() == 0
+
+    stored = await collection.find_one()
+    assert stored["pool_increases"] == [["test", 30]]
 
 
 async def test_lottery_buy_ticket_not_enough_money(mongo_mock_client):
     """Test that a lottery ticket cannot be bought if the user doesn't
     have enough money."""
-    user = User(name="test", balance=5.0)
-    lottery = Lottery(name="test", prize=100.0, ticket_price=10.0)
+    user = User(name="test", balance=500)
+    lottery = Lottery(name="test", prize=10000, ticket_price=1000)
 
-    assert lottery.prize == 100.0
-    assert lottery.ticket_price == 10.0
-    assert lottery.prize_increase == 0.0
+    assert lottery.prize == 10000
+    assert lottery.ticket_price == 1000
+    assert lottery.prize_increase == 0
     assert lottery.pool_increases == []
-    assert lottery.tickets == []
+    assert lottery.tickets == {}
 
     with pytest.raises(ValueError):
         await lottery.buy_ticket(user)
 
-    assert lottery.prize == 100.0
-    assert lottery.ticket_price == 10.0
-    assert lottery.prize_increase == 0.0
+    assert lottery.prize == 10000
+    assert lottery.ticket_price == 1000
+    assert lottery.prize_increase == 0
     assert lottery.pool_increases == []
-    assert lottery.tickets == []
+    assert lottery.tickets == {}
+    assert lottery.ticket_count == 0
 
-    assert user.balance == 5.0
+    assert user.balance == 500
 
 
 async def test_lottery_complete_one_user(mongo_mock_client):
     """Test that a lottery can be completed with one ticket."""
     user = User(name="test")
+    await user.insert()
+
     lottery = Lottery(
-        name="test", prize=100.0, ticket_price=10.0, tickets=[user]
+        name="test", prize=10000, ticket_price=1000, tickets={str(user.id): 1}
     )
 
     await lottery.complete()
 
-    assert lottery.winner == user
+    assert lottery.winner.id == user.id
     assert lottery.completed is True
 
-    assert user.balance == 100.0
+    assert lottery.winner.balance == 10000
 
 
 async def test_lottery_complete_multiple_users(mongo_mock_client):
     """Test that a lottery can be completed with multiple tickets."""
-    user1 = User(name="test1")
-    user2 = User(name="test2")
-    user3 = User(name="test3")
+    users = [User(name="test1"), User(name="test2"), User(name="test3")]
+    for user in users:
+        await user.insert()
 
     lottery = Lottery(
         name="test",
-        prize=100.0,
-        ticket_price=10.0,
-        tickets=[user1, user2, user3],
+        prize=10000,
+        ticket_price=1000,
+        tickets={str(user.id): 1 for user in users},
     )
 
     await lottery.complete()
 
-    assert lottery.winner in [user1, user2, user3]
+    assert lottery.winner.id in [user.id for user in users]
     assert lottery.completed is True
 
-    assert lottery.winner.balance == 100.0
-
-    non_winners = [user1, user2, user3]
-    non_winners.remove(lottery.winner)
+    assert lottery.winner.balance == 10000
 
-    for user in non_winners:
-        assert user.balance == 0.0
+    for user in users:
+        if user.id != lottery.winner.id:
+            assert (await User.get(user.id)).balance == 0
 
 
 async def test_lottery_complete_no_users(mongo_mock_client):
     """Test that a lottery can be completed with no tickets."""
-    lottery = Lottery(name="test", prize=100.0, ticket_price=10.0)
+    lottery = Lottery(name="test", prize=10000, ticket_price=1000)
 
     await lottery.complete()
 
@@ -155,34 +258,402 @@ async def test_lottery_complete_no_users(mongo_mock_client):
 async def test_lottery_get_chance_one_user(mongo_mock_client):
     """Test that the chance of winning is correct with one ticket."""
     user = User(name="test")
+    await user.insert()
+
     lottery = Lottery(
-        name="test", prize=100.0, ticket_price=10.0, tickets=[user]
+        name="test", prize=10000, ticket_price=1000, tickets={str(user.id): 1}
     )
 
-    assert await lottery.get_chance(user) == 1.0
+    assert await lottery.get_chance(user) == 1
 
 
 async def test_lottery_get_chance_multiple_users(mongo_mock_client):
-    """Test that the chance of winning is correct with three tickets."""
+    """Test that the chance of winning is correct with four tickets."""
     user1 = User(name="test1")
     user2 = User(name="test2")
-    user3 = User(name="test3")
+    await user1.insert()
+    await user2.insert()
 
     lottery = Lottery(
         name="test",
-        prize=100.0,
-        ticket_price=10.0,
-        tickets=[user1, user2, user3],
+        prize=10000,
+        ticket_price=1000,
+        tickets={str(user1.id): 3, str(user2.id): 1},
     )
 
-    assert await lottery.get_chance(user1) == 1 / 3
-    assert await lottery.get_chance(user2) == 1 / 3
-    assert await lottery.get_chance(user3) == 1 / 3
+    assert lottery.ticket_count == 4
+    assert await lottery.get_chance(user1) == 3 / 4
+    assert await lottery.get_chance(user2) == 1 / 4
 
 
 async def test_lottery_get_chance_no_users(mongo_mock_client):
     """Test that the chance of winning is correct with no tickets."""
     user = User(name="test")
-    lottery = Lottery(name="test", prize=100.0, ticket_price=10.0)
+    lottery = Lottery(name="test", prize=10000, ticket_price=1000)
+
+    assert await lottery.get_chance(user) == 0
+
+
+async def test_lottery_legacy_tickets(mongo_mock_client):
+    """Test that lotteries storing embedded users as tickets are
+    migrated to ticket counts."""
+    user1 = User(name="test1")
+    user2 = User(name="test2")
+    await user1.insert()
+    await user2.insert()
+
+    legacy_users = [
+        {"_id": user1.id, "name": "test1", "balance": 0.0},
+        {"_id": user1.id, "name": "test1", "balance": 0.0},
+        {"_id": user2.id, "name": "test2", "balance": 0.0},
+    ]
+    await Lottery.get_motor_collection().insert_one(
+        {
+            "name": "test",
+            "prize": 100.0,
+            "ticket_price": 10.0,
+            "tickets": legacy_users,
+        }
+    )
+
+    assert await Lottery.migrate_tickets() == 1
+    assert await Lottery.migrate_tickets() == 0
+
+    lottery = await Lottery.find_one(Lottery.name == "test")
+    assert lottery.tickets == {str(user1.id): 2, str(user2.id): 1}
+    assert lottery.ticket_count == 3
+
+
+async def test_lottery_completed_index(mongo_mock_client):
+    """Test that lotteries are indexed by whether they're completed."""
+    indexes = await Lottery.get_motor_collection().index_information()
+
+    assert [("completed", 1)] in [
+        list(index["key"]) for index in indexes.values()
+    ]
+
+
+async def test_lottery_complete_multiple_winners(mongo_mock_client):
+    """Test that a lottery can be completed with several winners and
+    tiered prize splits."""
+    users = [User(name=f"test{number}") for number in range(4)]
+    for user in users:
+        await user.insert()
+
+    lottery = Lottery(
+        name="test",
+        prize=10000,
+        ticket_price=1000,
+        tickets={
+            str(user.id): number + 1 for number, user in enumerate(users)
+        },
+    )
+
+    winner = await lottery.complete(winners=3, splits=(50, 30, 20))
+
+    assert winner == lottery.winners[0]
+    assert len({user.id for user in lottery.winners}) == 3
+    assert [user.balance for user in lottery.winners] == [5000, 3000, 2000]
+
+    for user in users:
+        stored = await User.get(user.id)
+        expected = {u.id: u.balance for u in lottery.winners}.get(user.id, 0)
+        assert stored.balance == expected
+
+
+async def test_lottery_complete_fewer_holders(mongo_mock_client):
+    """Test that the prize is split between the places drawn when
+    there are fewer ticket holders than winners."""
+    user = User(name="test")
+    await user.insert()
+
+    lottery = Lottery(
+        name="test", prize=10000, ticket_price=1000, tickets={str(user.id): 2}
+    )
+
+    await lottery.complete(winners=3, splits=(50, 30, 20))
+
+    assert [winner.id for winner in lottery.winners] == [user.id]
+    assert (await User.get(user.id)).balance == 10000
+
+
+async def test_lottery_complete_with_replacement(mongo_mock_client):
+    """Test that a user can win several places with replacement."""
+    user = User(name="test")
+    await user.insert()
+
+    lottery = Lottery(
+        name="test", prize=10000, ticket_price=1000, tickets={str(user.id): 1}
+    )
+
+    await lottery.complete(winners=2, replace=True, splits=(3, 1))
+
+    assert [winner.id for winner in lottery.winners] == [user.id, user.id]
+    assert lottery.winner.balance == 10000
+    assert (await User.get(user.id)).balance == 10000
+
+
+async def test_lottery_complete_splits_mismatch(mongo_mock_client):
+    """Test that splits must match the number of winners."""
+    lottery = Lottery(name="test", prize=10000, ticket_price=1000)
+
+    with pytest.raises(ValueError):
+        await lottery.complete(winners=2, splits=(1,))
+
+    assert lottery.completed is False
+
+
+async def test_lottery_replay_draw(mongo_mock_client):
+    """Test that a draw can be replayed from its stored seed."""
+    users = [User(name=f"test{number}") for number in range(10)]
+    for user in users:
+        await user.insert()
+
+    lottery = Lottery(
+        name="test",
+        prize=10000,
+        ticket_price=1000,
+        tickets={str(user.id): 5 for user in users},
+    )
+
+    with pytest.raises(ValueError):
+        lottery.replay_draw()
+
+    await lottery.complete(winners=3)
+    stored = await Lottery.get(lottery.id)
+
+    assert stored.draw_seed == lottery.draw_seed
+    assert stored.replay_draw(3) == [str(user.id) for user in stored.winners]
+
+
+async def test_lottery_buy_ticket_stale_copies(mongo_mock_client):
+    """Test that concurrent ticket purchases through stale copies of a
+    lottery are not lost."""
+    lottery = Lottery(
+        name="test", prize=10000, ticket_price=100, prize_increase=50
+    )
+    await lottery.insert()
+
+    users = [User(name=f"test{number}", balance=100) for number in range(20)]
+    for user in users:
+        await user.insert()
+
+    copies = [await Lottery.get(lottery.id) for _ in users]
+    await asyncio.gather(
+        *(copy.buy_ticket(user) for copy, user in zip(copies, users))
+    )
+
+    stored = await Lottery.get(lottery.id)
+
+    assert stored.ticket_count == 20
+    assert stored.tickets == {str(user.id): 1 for user in users}
+    assert stored.prize == 11000
+
+
+async def test_lottery_buy_ticket_completed(mongo_mock_client):
+    """Test that tickets cannot be bought once a lottery is completed,
+    even through a stale copy."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+
+    lottery = Lottery(name="test", prize=10000, ticket_price=100)
+    await lottery.insert()
+    copy = await Lottery.get(lottery.id)
+
+    await lottery.complete()
+
+    with pytest.raises(ValueError):
+        await lottery.buy_ticket(user)
+
+    with pytest.raises(ValueError):
+        await copy.buy_ticket(user)
+
+    assert (await Lottery.get(lottery.id)).ticket_count == 0
+
+
+async def test_lottery_complete_twice(mongo_mock_client):
+    """Test that a lottery cannot be completed twice, even through a
+    stale copy."""
+    user = User(name="test", balance=100)
+    lottery = Lottery(name="test", prize=10000, ticket_price=100)
+    await lottery.buy_ticket(user)
+
+    copy = await Lottery.get(lottery.id)
+    await lottery.complete()
+
+    with pytest.raises(ValueError):
+        await copy.complete()
+
+    assert (await User.get(user.id)).balance == 10000
+
+
+async def test_lottery_complete_deleted_holder(mongo_mock_client, monkeypatch):
+    """Test that tickets held by deleted users can't win."""
+    # This seed draws the deleted user, who holds the first tickets
+    monkeypatch.setattr(secrets, "token_hex", lambda nbytes: "00" * nbytes)
+
+    deleted = User(name="deleted", balance=10000)
+    kept = User(name="kept", balance=100)
+    lottery = Lottery(name="test", prize=1000, ticket_price=100)
+    await lottery.buy_tickets(deleted, 100)
+    await lottery.buy_ticket(kept)
+    await deleted.delete()
+
+    assert (await lottery.complete()).id == kept.id
+    assert lottery.tickets == {str(kept.id): 1}
+    assert lottery.ticket_count == 1
+    assert lottery.replay_draw() == [str(kept.id)]
+
+    stored = await Lottery.get(lottery.id)
+    assert stored.completed
+    assert stored.tickets == {str(kept.id): 1}
+    assert (await User.get(kept.id)).balance == 1000
+
+
+async def test_lottery_complete_only_deleted_holders(mongo_mock_client):
+    """Test that a lottery whose holders were all deleted has no
+    winner."""
+    user = User(name="test", balance=100)
+    lottery = Lottery(name="test", prize=1000, ticket_price=100)
+    await lottery.buy_ticket(user)
+    await user.delete()
+
+    assert await lottery.complete() is None
+    assert lottery.winners == []
+
+
+async def test_lottery_complete_sees_new_tickets(mongo_mock_client):
+    """Test that completing a lottery draws from tickets bought through
+    other copies."""
+    user = User(name="test", balance=100)
+    lottery = Lottery(name="test", prize=10000, ticket_price=100)
+    await lottery.insert()
+
+    copy = await Lottery.get(lottery.id)
+    await copy.buy_ticket(user)
+
+    winner = await lottery.complete()
+
+    assert winner.id == user.id
+    assert lottery.ticket_count == 1
+
+
+async def test_lottery_buy_tickets(mongo_mock_client):
+    """Test that several lottery tickets can be bought at once."""
+    user = User(name="test", balance=10000)
+    pool = Pool(code="test")
+
+    lottery = Lottery(
+        name="test",
+        prize=10000,
+        ticket_price=100,
+        prize_increase=50,
+        pool_increases=[(pool, 20)],
+    )
+
+    await lottery.buy_tickets(user, 50)
+    await lottery.buy_tickets(user, 25)
+
+    assert lottery.tickets == {str(user.id): 75}
+    assert lottery.ticket_count == 75
+    assert lottery.prize == 13750
+
+    assert user.balance == 2500
+    assert (await Pool.get_by_code("test")).balance == 1500
+
+    stored = await Lottery.get(lottery.id)
+    assert stored.tickets == {str(user.id): 75}
+    assert stored.prize == 13750
+
+
+@pytest.mark.parametrize("quantity", [0, -1])
+async def test_lottery_buy_tickets_invalid_quantity(
+    mongo_mock_client, quantity
+):
+    """Test that a non-positive number of tickets cannot be bought."""
+    user = User(name="test", balance=10000)
+    lottery = Lottery(name="test", prize=10000, ticket_price=100)
+
+    with pytest.raises(ValueError):
+        await lottery.buy_tickets(user, quantity)
+
+    assert user.balance == 10000
+    assert lottery.ticket_count == 0
+
+
+async def test_lottery_buy_tickets_not_enough_money(mongo_mock_client):
+    """Test that tickets cannot be bought if the user can't afford all
+    of them."""
+    user = User(name="test", balance=950)
+    lottery = Lottery(name="test", prize=10000, ticket_price=100)
+
+    with pytest.raises(ValueError):
+        await lottery.buy_tickets(user, 10)
+
+    assert user.balance == 950
+    assert lottery.ticket_count == 0
+
+
+async def test_lottery_bulk_buy_tickets(mongo_mock_client):
+    """Test that tickets can be bought for several users at once."""
+    rich = User(name="rich", balance=10000)
+    poor = User(name="poor", balance=150)
+    await User.insert_many([rich, poor])
+    rich, poor = [user async for user in User.find_all()]
+
+    lottery = Lottery(
+        name="test",
+        prize=10000,
+        ticket_price=100,
+        prize_increase=50,
+        pool_increases=[("test", 20)],
+    )
+
+    failed = await lottery.bulk_buy_tickets(
+        [(rich.id, 5), (poor.id, 2), (rich.id, 5)]
+    )
+
+    assert failed == [poor.id]
+    assert lottery.tickets == {str(rich.id): 10}
+    assert lottery.ticket_count == 10
+    assert lottery.prize == 10500
+
+    assert (await User.get(rich.id)).balance == 9000
+    assert (await User.get(poor.id)).balance == 150
+    assert (await Pool.get_by_code("test")).balance == 200
+
+
+async def test_lottery_buy_tickets_completed_elsewhere(mongo_mock_client):
+    """Test that buyers are refunded when a stale copy of the lottery
+    was completed elsewhere."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+    lottery = Lottery(name="test", prize=10000, ticket_price=100)
+    await lottery.insert()
+    copy = await Lottery.get(lottery.id)
+    bulk_copy = await Lottery.get(lottery.id)
+    await lottery.complete()
+
+    with pytest.raises(ValueError):
+        await copy.buy_ticket(user)
+
+    with pytest.raises(ValueError):
+        await bulk_copy.bulk_buy_tickets([(user.id, 2)])
+
+    assert copy.completed
+    assert bulk_copy.completed
+    assert user.balance == 1000
+    assert (await User.get(user.id)).balance == 1000
+    assert (await Lottery.get(lottery.id)).ticket_count == 0
+
+
+async def test_lottery_bulk_buy_tickets_invalid_quantity(mongo_mock_client):
+    """Test that every quantity in a bulk purchase must be positive."""
+    user = User(name="test", balance=10000)
+    await user.insert()
+    lottery = Lottery(name="test", prize=10000, ticket_price=100)
+
+    with pytest.raises(ValueError):
+        await lottery.bulk_buy_tickets([(user.id, 1), (user.id, 0)])
 
-    assert await lottery.get_chance(user) == 0.0
+    assert (await User.get(user.id)).balance == 10000
@@ -1,4 +1,7 @@
+import asyncio
+
 import pytest
+from pymongo.errors import DuplicateKeyError
 
 from benbucks_core import Pool
 
@@ -8,33 +11,48 @@ def test_pool_init(mongo_mock_client):
     pool = Pool(code="abc")
     assert pool.code == "abc"
     assert pool.name == "Pool"
-    assert pool.balance == 0.0
+    assert pool.balance == 0
 
 
 async def test_pool_change_balance(mongo_mock_client):
     """Test that a pool's balance can be changed."""
     pool = Pool(code="abc", name="Pool")
-    assert pool.balance == 0.0
+    assert pool.balance == 0
 
-    await pool.change_balance(10.0)
-    await pool.change_balance(-5.0)
-    await pool.change_balance(2.0)
+    await pool.change_balance(1000)
+    await pool.change_balance(-500)
+    await pool.change_balance(200)
 
-    assert pool.balance == 7.0
+    assert pool.balance == 700
 
 
 async def test_pool_change_balance_negative(mongo_mock_client):
     """Test that a pool's balance cannot be made negative."""
-    pool = Pool(code="abc", name="Pool", balance=5.0)
-    assert pool.balance == 5.0
+    pool = Pool(code="abc", name="Pool", balance=500)
+    assert pool.balance == 500
 
-    await pool.change_balance(-1.0)
-    assert pool.balance == 4.0
+    await pool.change_balance(-100)
+    assert pool.balance == 400
 
     with pytest.raises(ValueError):
-        await pool.change_balance(-5.0)
+        await pool.change_balance(-500)
+
+    assert pool.balance == 400
+
+
+async def test_pool_change_balance_stale_copy(mongo_mock_client):
+    """Test that balance changes through stale copies of a pool are
+    not lost."""
+    pool = Pool(code="abc", balance=1000)
+    await pool.insert()
+
+    copy = await Pool.get(pool.id)
 
-    assert pool.balance == 4.0
+    await pool.change_balance(500)
+    await copy.change_balance(-300)
+
+    assert copy.balance == 1200
+    assert (await Pool.get(pool.id)).balance == 1200
 
 
 async def test_pool_get_by_code(mongo_mock_client):
@@ -52,7 +70,7 @@ async def test_pool_get_by_code_create(mongo_mock_client):
     pool = await Pool.get_by_code("abc")
     assert pool.code == "abc"
     assert pool.name == "Pool"
-    assert pool.balance == 0.0
+    assert pool.balance == 0
 
     pool2 = await Pool.get_by_code("abc")
     assert pool2 == pool
@@ -63,3 +81,94 @@ async def test_pool_get_by_code_error(mongo_mock_client):
     and it does not exist."""
     with pytest.raises(ValueError):
         await Pool.get_by_code("abc", create_if_needed=False)
+
+
+async def test_pool_bulk_change_balances(mongo_mock_client):
+    """Test that many pools' balances can be changed at once, with
+    rejected changes reported."""
+    pool1 = Pool(code="abc", balance=1000)
+    pool2 = Pool(code="def", balance=500)
+    await pool1.insert()
+    await pool2.insert()
+
+    failed = await Pool.bulk_change_balances(
+        [(pool1.id, -1000), (pool2.id, -700)]
+    )
+
+    assert failed == [pool2.id]
+    assert (await Pool.get(pool1.id)).balance == 0
+    assert (await Pool.get(pool2.id)).balance == 500
+
+
+async def test_pool_code_unique(mongo_mock_client):
+    """Test that two pools cannot share a code."""
+    await Pool(code="abc").insert()
+
+    with pytest.raises(DuplicateKeyError):
+        await Pool(code="abc").insert()
+
+
+async def test_pool_get_by_code_concurrent(mongo_mock_client):
+    """Test that concurrent lookups of a missing pool create only one
+    pool."""
+    pools = await asyncio.gather(*(Pool.get_by_code("abc") for _ in range(5)))
+
+    assert len({pool.id for pool in pools}) == 1
+    assert await Pool.find(Pool.code == "abc").count() == 1
+
+
+@pytest.fixture
+def pool_cache():
+    Pool.enable_cache(maxsize=2)
+    yield
+    Pool.disable_cache()
+
+
+async def test_pool_cache_disabled(mongo_mock_client):
+    """Test that pools aren't cached by default."""
+    assert Pool.cache_info() is None
+
+
+async def test_pool_cache_hit(mongo_mock_client, pool_cache):
+    """Test that repeated lookups of a pool are served from the
+    cache."""
+    pool = await Pool.get_by_code("abc")
+    pool2 = await Pool.get_by_code("abc")
+
+    assert pool2 == pool
+    assert pool2 is not pool
+    assert Pool.cache_info() == (1, 1, 2, 1)
+
+
+async def test_pool_cache_invalidated(mongo_mock_client, pool_cache):
+    """Test that writes to a pool invalidate its cached copy."""
+    pool = await Pool.get_by_code("abc")
+
+    await pool.change_balance(500)
+    assert (await Pool.get_by_code("abc")).balance == 500
+
+    pool.name = "Renamed"
+    await pool.save()
+    assert (await Pool.get_by_code("abc")).name == "Renamed"
+
+    await Pool.bulk_change_balances([(pool.id, 200)])
+    assert (await Pool.get_by_code("abc")).balance == 700
+
+    assert Pool.cache_info().hits == 0
+
+
+async def test_pool_cache_eviction(mongo_mock_client, pool_cache):
+    """Test that the least recently used pool is evicted when the
+    cache is full."""
+    await Pool.get_by_code("abc")
+    await Pool.get_by_code("def")
+    await Pool.get_by_code("abc")
+    await Pool.get_by_code("ghi")
+
+    assert Pool.cache_info().currsize == 2
+
+    await Pool.get_by_code("abc")
+    assert Pool.cache_info().hits == 2
+
+    await Pool.get_by_code("def")
+    assert Pool.cache_info().hits == 2
@@ -0,0 +1,155 @@
+import pytest
+
+from benbucks_core import Pool, _session
+from benbucks_core._session import run_in_transaction
+
+
+class FakeSession:
+    def __init__(self, conflicts=0):
+        self.events = []
+        self.conflicts = conflicts
+
+    async def __aenter__(self):
+        self.events.append("start session")
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.events.append("end session")
+
+    async def with_transaction(self, callback):
+        """Run the callback like Motor, retrying after conflicts."""
+        while True:
+            self.events.append("start transaction")
+
+            try:
+                result = await callback(self)
+            except Exception:
+                self.events.append("abort")
+                raise
+
+            if self.conflicts:
+                self.conflicts -= 1
+                self.events.append("conflict")
+                continue
+
+            self.events.append("commit")
+            return result
+
+
+@pytest.fixture
+def fake_hello(mongo_mock_client, monkeypatch):
+    """Answer hello commands like a server, as mongomock doesn't
+    implement them."""
+    calls = []
+    response = {"setName": "rs0"}
+
+    async def command(database, name):
+        calls.append(name)
+        return response
+
+    database = Pool.get_motor_collection().database
+    monkeypatch.setattr(type(database), "command", command)
+    monkeypatch.setattr(_session, "_transaction_support", {})
+
+    return response, calls
+
+
+@pytest.fixture
+def fake_session(fake_hello, monkeypatch):
+    session = FakeSession()
+
+    async def start_session():
+        return session
+
+    client = Pool.get_motor_collection().database.client
+    monkeypatch.setattr(client, "start_session", start_session, raising=False)
+
+    return session
+
+
+async def test_transaction_commit(fake_session):
+    """Test that a transaction is committed when its callback
+    succeeds."""
+
+    async def callback(session):
+        assert session is fake_session
+        return "result"
+
+    assert await run_in_transaction(Pool, callback) == "result"
+    assert fake_session.events == [
+        "start session",
+        "start transaction",
+        "commit",
+        "end session",
+    ]
+
+
+async def test_transaction_abort(fake_session):
+    """Test that a transaction is aborted when its callback raises."""
+
+    async def callback(session):
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await run_in_transaction(Pool, callback)
+
+    assert fake_session.events == [
+        "start session",
+        "start transaction",
+        "abort",
+        "end session",
+    ]
+
+
+async def test_transaction_retry(fake_session):
+    """Test that a conflicting transaction runs its callback again."""
+    fake_session.conflicts = 2
+    calls = []
+
+    async def callback(session):
+        calls.append(session)
+
+    await run_in_transaction(Pool, callback)
+
+    assert calls == [fake_session] * 3
+    assert fake_session.events[-2:] == ["commit", "end session"]
+
+
+async def test_transaction_unsupported(mongo_mock_client):
+    """Test that clients without session support run without a
+    transaction."""
+
+    async def callback(session):
+        assert session is None
+
+    await run_in_transaction(Pool, callback)
+
+
+async def test_transaction_standalone(fake_session, fake_hello):
+    """Test that standalone servers run without a transaction."""
+    response, calls = fake_hello
+    response.clear()
+    sessions = []
+
+    async def callback(session):
+        sessions.append(session)
+
+    await run_in_transaction(Pool, callback)
+    await run_in_transaction(Pool, callback)
+
+    assert sessions == [None, None]
+    assert calls == ["hello"]
+    assert fake_session.events == []
+
+
+async def test_transaction_sharded(fake_session, fake_hello):
+    """Test that sharded clusters run transactions."""
+    response, _ = fake_hello
+    response.clear()
+    response["msg"] = "isdbgrid"
+
+    async def callback(session):
+        assert session is fake_session
+
+    await run_in_transaction(Pool, callback)
+    assert "commit" in fake_session.events
@@ -0,0 +1,172 @@
+from datetime import datetime, timedelta, timezone
+
+from beanie import PydanticObjectId
+from bson import ObjectId
+
+from benbucks_core import BalanceSnapshot, Pool, Transaction, User
+from benbucks_core.transaction import MAX_DELAY
+
+START = datetime(2023, 1, 1)
+
+
+async def add_transactions(*transactions: tuple) -> None:
+    """Insert transactions given as (day, source, destination, amount)
+    tuples."""
+    await Transaction.insert_many(
+        [
+            Transaction(
+                source=source,
+                destination=destination,
+                amount=amount,
+                timestamp=START + timedelta(days=day),
+            )
+            for day, source, destination, amount in transactions
+        ]
+    )
+
+
+async def test_snapshot_balance_at_without_snapshots(mongo_mock_client):
+    """Test that balances can be computed from the ledger alone."""
+    alice, bob = PydanticObjectId(), PydanticObjectId()
+    await add_transactions(
+        (0, None, alice, 1000),
+        (1, alice, bob, 300),
+        (2, bob, None, 100),
+    )
+
+    assert await BalanceSnapshot.balance_at(alice, START) == 0
+    assert (
+        await BalanceSnapshot.balance_at(alice, START + timedelta(1)) == 1000
+    )
+    assert await BalanceSnapshot.balance_at(alice, START + timedelta(2)) == 700
+    assert await BalanceSnapshot.balance_at(bob, START + timedelta(2)) == 300
+    assert await BalanceSnapshot.balance_at(bob, START + timedelta(3)) == 200
+
+
+async def test_snapshot_take(mongo_mock_client):
+    """Test that snapshots only cover accounts changed since the last
+    snapshots, building on each account's previous snapshot."""
+    alice, bob = PydanticObjectId(), PydanticObjectId()
+    await add_transactions(
+        (0, None, alice, 1000),
+        (1, alice, bob, 300),
+        (3, None, alice, 50),
+    )
+
+    assert await BalanceSnapshot.take(START + timedelta(2)) == 2
+    assert await BalanceSnapshot.take(START + timedelta(4)) == 1
+
+    latest = await BalanceSnapshot.latest(alice, START + timedelta(5))
+    assert latest.balance == 750
+    assert latest.timestamp == START + timedelta(4)
+
+    latest = await BalanceSnapshot.latest(bob, START + timedelta(5))
+    assert latest.balance == 300
+    assert latest.timestamp == START + timedelta(2)
+
+    assert await BalanceSnapshot.take(START + timedelta(5)) == 0
+
+
+async def test_snapshot_balance_at_with_snapshots(mongo_mock_client):
+    """Test that balances after a snapshot are computed from it."""
+    alice = PydanticObjectId()
+    await add_transactions((0, None, alice, 1000), (2, alice, None, 400))
+    await BalanceSnapshot.take(START + timedelta(1))
+
+    await Transaction.find(
+        Transaction.timestamp < START + timedelta(1)
+    ).delete()
+
+    assert (
+        await BalanceSnapshot.balance_at(alice, START + timedelta(1)) == 1000
+    )
+    assert await BalanceSnapshot.balance_at(alice, START + timedelta(3)) == 600
+
+
+async def test_snapshot_take_buffered(mongo_mock_client):
+    """Test that buffered transactions are inserted before snapshots
+    are taken."""
+    alice = PydanticObjectId()
+    await Transaction._buffer(
+        [Transaction(destination=alice, amount=700, timestamp=START)]
+    )
+
+    assert await BalanceSnapshot.take(START + timedelta(1)) == 1
+
+    latest = await BalanceSnapshot.latest(alice, START + timedelta(1))
+    assert latest.balance == 700
+
+
+async def test_snapshot_take_settles(mongo_mock_client):
+    """Test that transactions inserted late are counted after a
+    snapshot is taken."""
+    user = User(name="test")
+    await user.change_balance(501)
+
+    assert await BalanceSnapshot.take() == 0
+
+    # Stamped before the snapshot, but still in another process's buffer
+    await Transaction(
+        destination=user.id,
+        amount=100,
+        timestamp=datetime.now(timezone.utc) - timedelta(seconds=MAX_DELAY),
+    ).insert()
+    await BalanceSnapshot.take()
+
+    # Stored times are rounded to milliseconds, so look a little later
+    later = datetime.now(timezone.utc) + timedelta(seconds=1)
+    assert await BalanceSnapshot.balance_at(user.id, later) == 601
+
+
+async def test_snapshot_verify_balances(mongo_mock_client):
+    """Test that stored balances are checked against the ledger."""
+    user = User(name="test")
+    pool = Pool(code="test")
+    await user.change_balance(1500)
+    await user.contribute_to_pool(pool, 1000)
+
+    assert await BalanceSnapshot.verify_balances() == []
+
+    user.balance = 9999
+    await user.save()
+    await Transaction(destination=PydanticObjectId(), amount=5).insert()
+
+    mismatches = await BalanceSnapshot.verify_balances()
+
+    assert mismatches[0] == (user.id, 9999, 500)
+    assert mismatches[1].stored == 0
+    assert mismatches[1].rebuilt == 5
+
+
+async def test_snapshot_starting_balances(mongo_mock_client):
+    """Test that accounts inserted with a starting balance match the
+    ledger."""
+    await User(name="test", balance=1000).insert()
+    await User.insert_many([User(name="bulk", balance=250), User(name="no")])
+    await Pool.insert_many([Pool(code="test", balance=75)])
+
+    assert await BalanceSnapshot.verify_balances() == []
+
+
+async def test_snapshot_record_opening_balances(mongo_mock_client):
+    """Test that balances from before the ledger are recorded when the
+    account was created, with later snapshots corrected."""
+    user_id = PydanticObjectId(ObjectId.from_datetime(START))
+    await User.get_motor_collection().insert_one(
+        {"_id": user_id, "name": "legacy", "balance": 700}
+    )
+    await add_transactions((1, user_id, None, 300))
+    await BalanceSnapshot.take(START + timedelta(2))
+
+    assert await BalanceSnapshot.verify_balances() == [(user_id, 700, -300)]
+
+    assert await BalanceSnapshot.record_opening_balances() == 1
+    assert await BalanceSnapshot.record_opening_balances() == 0
+    assert await BalanceSnapshot.verify_balances() == []
+
+    snapshot = await BalanceSnapshot.latest(user_id, START + timedelta(2))
+    assert snapshot.balance == 700
+    assert await BalanceSnapshot.balance_at(user_id, START) == 0
+    assert (
+        await BalanceSnapshot.balance_at(user_id, START + timedelta(1)) == 1000
+    )
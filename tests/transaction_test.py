@@ -0,0 +1,142 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from benbucks_core import Pool, Transaction, User, init_memory_db
+from benbucks_core import transaction as transaction_module
+from benbucks_core.transaction import OPENING_BALANCE
+
+
+async def test_transaction_change_balance(mongo_mock_client):
+    """Test that balance changes are recorded once the buffer is
+    flushed."""
+    user = User(name="test")
+    await user.change_balance(1000, reason="Stipend")
+    await user.change_balance(-300)
+
+    assert await Transaction.count() == 0
+
+    await Transaction.flush()
+    transactions = await Transaction.statement(user.id).to_list()
+
+    assert [
+        (t.source, t.destination, t.amount, t.reason) for t in transactions
+    ] == [
+        (user.id, None, 300, None),
+        (None, user.id, 1000, "Stipend"),
+    ]
+
+
+async def test_transaction_rejected_change(mongo_mock_client):
+    """Test that rejected balance changes aren't recorded."""
+    user = User(name="test")
+
+    with pytest.raises(ValueError):
+        await user.change_balance(-100)
+
+    await Transaction.flush()
+    assert await Transaction.count() == 0
+
+
+async def test_transaction_contribute_to_pool(mongo_mock_client):
+    """Test that a pool contribution is recorded as one transfer."""
+    user = User(name="test", balance=1500)
+    pool = Pool(code="test")
+    await user.contribute_to_pool(pool, 1000)
+    await Transaction.flush()
+
+    transaction = await Transaction.find_one(
+        Transaction.reason != OPENING_BALANCE
+    )
+
+    assert transaction.source == user.id
+    assert transaction.destination == pool.id
+    assert transaction.amount == 1000
+    assert transaction.reason == "Pool contribution"
+
+
+async def test_transaction_bulk_change_balances(mongo_mock_client):
+    """Test that only applied bulk balance changes are recorded."""
+    user1 = User(name="test1", balance=500)
+    user2 = User(name="test2")
+    await user1.insert()
+    await user2.insert()
+
+    await User.bulk_change_balances(
+        [(user1.id, -200), (user2.id, -100)], reason="Fine"
+    )
+    await Transaction.flush()
+
+    transactions = await Transaction.find(
+        Transaction.reason != OPENING_BALANCE
+    ).to_list()
+
+    assert [(t.source, t.amount, t.reason) for t in transactions] == [
+        (user1.id, 200, "Fine")
+    ]
+
+
+async def test_transaction_buffer_full(mongo_mock_client, monkeypatch):
+    """Test that the buffer is flushed once it's full."""
+    monkeypatch.setattr(transaction_module, "MAX_BUFFERED", 3)
+    user = User(name="test")
+
+    await user.change_balance(100)
+    await user.change_balance(100)
+    assert await Transaction.count() == 0
+
+    await user.change_balance(100)
+    assert await Transaction.count() == 3
+
+
+async def test_transaction_buffer_delay(mongo_mock_client, monkeypatch):
+    """Test that the buffer is flushed after a delay."""
+    monkeypatch.setattr(transaction_module, "MAX_DELAY", 0.01)
+    user = User(name="test")
+
+    await user.change_balance(100)
+    assert await Transaction.count() == 0
+
+    await asyncio.sleep(0.05)
+    assert await Transaction.count() == 1
+
+
+def test_transaction_buffer_loop_shutdown():
+    """Test that the buffer is flushed when asyncio.run shuts down the
+    event loop before the delay has passed."""
+
+    async def change_balance():
+        client = await init_memory_db("shutdown")
+        await User(name="test").change_balance(500)
+        assert await Transaction.count() == 0
+
+        return client
+
+    client = asyncio.run(change_balance())
+    ledger = client["shutdown"]["Transaction"]
+
+    assert asyncio.run(ledger.count_documents({})) == 1
+
+
+async def test_transaction_statement_range(mongo_mock_client):
+    """Test that statements can be limited to a time range."""
+    account = User(name="test")
+    await account.insert()
+    other = User(name="other")
+    await other.insert()
+
+    start = datetime(2023, 1, 1)
+    for day in range(5):
+        await Transaction(
+            destination=account.id,
+            amount=day + 1,
+            timestamp=start + timedelta(days=day),
+        ).insert()
+    await Transaction(destination=other.id, amount=100).insert()
+
+    transactions = await Transaction.statement(
+        account.id, start + timedelta(days=1), start + timedelta(days=3)
+    ).to_list()
+
+    assert [t.amount for t in transactions] == [3, 2]
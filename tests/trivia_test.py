@@ -1,4 +1,12 @@
-from benbucks_core import TriviaQuestion
+import asyncio
+import io
+import json
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from benbucks_core import TriviaQuestion, TriviaRound, User
+from benbucks_core.trivia import normalize_text
 
 
 async def test_trivia_question_init(mongo_mock_client):
@@ -6,7 +14,7 @@ async def test_trivia_question_init(mongo_mock_client):
     question = TriviaQuestion(
         question="What is the answer to life, the universe, and everything?",
         answer="42",
-        first_prize=100.0,
+        first_prize=10000,
     )
 
     assert (
@@ -14,7 +22,7 @@ async def test_trivia_question_init(mongo_mock_client):
         == "What is the answer to life, the universe, and everything?"
     )
     assert question.answer == "42"
-    assert question.first_prize == 100.0
+    assert question.first_prize == 10000
 
 
 async def test_trivia_question_prizes(mongo_mock_client):
@@ -22,7 +30,346 @@ async def test_trivia_question_prizes(mongo_mock_client):
     question = TriviaQuestion(
         question="What is the answer to life, the universe, and everything?",
         answer="42",
-        first_prize=73.0,
+        first_prize=7300,
+    )
+
+    assert question.prizes == (7300, 5110, 3650)
+
+
+async def insert_questions(count):
+    questions = [
+        TriviaQuestion(question=f"Question {i}", answer="42", first_prize=100)
+        for i in range(count)
+    ]
+    await TriviaQuestion.insert_many(questions)
+
+
+async def test_trivia_question_random(mongo_mock_client):
+    """Test that random questions avoid recently picked questions."""
+    await insert_questions(10)
+
+    first = await TriviaQuestion.random(4)
+    second = await TriviaQuestion.random(4)
+
+    assert len(first) == 4
+    assert len(second) == 4
+    assert {question.id for question in first}.isdisjoint(
+        question.id for question in second
+    )
+    assert all(isinstance(question, TriviaQuestion) for question in first)
+
+
+async def test_trivia_question_random_exhausted(mongo_mock_client):
+    """Test that recent questions are reused when there aren't enough
+    others."""
+    await insert_questions(3)
+
+    first = await TriviaQuestion.random(2)
+    second = await TriviaQuestion.random(2)
+
+    assert len({question.id for question in first + second}) == 3
+    assert len(await TriviaQuestion.random(5, exclude_recent=False)) == 3
+
+
+async def test_trivia_question_random_empty(mongo_mock_client):
+    """Test that no questions are picked from an empty collection."""
+    assert await TriviaQuestion.random() == []
+
+
+async def test_trivia_question_matches(mongo_mock_client):
+    """Test that answers are matched ignoring case, punctuation, word
+    order and small typos."""
+    question = TriviaQuestion(
+        question="Who wrote The Hitchhiker's Guide to the Galaxy?",
+        answer="Douglas Adams",
+        aliases=["Adams"],
+        first_prize=1000,
+    )
+
+    assert question.matches("douglas adams!")
+    assert question.matches("Adams, Douglas")
+    assert question.matches("Duglas Adams")
+    assert question.matches("Duglas Adamz")
+    assert question.matches("ADAMS")
+    assert not question.matches("Douglas")
+    assert not question.matches("Dglas Adamz")
+    assert question.matches("Adam")
+    assert not question.matches("Adm")
+    assert not question.matches("")
+
+
+async def test_trivia_question_matches_short_answer(mongo_mock_client):
+    """Test that short answers must match exactly."""
+    question = TriviaQuestion(
+        question="What is 6 x 7?", answer="42", first_prize=100
+    )
+
+    assert question.matches(" 42. ")
+    assert not question.matches("43")
+    assert not question.matches("420")
+
+
+async def test_trivia_question_matches_numbers(mongo_mock_client):
+    """Test that numbers must match exactly, even in long answers."""
+    question = TriviaQuestion(
+        question="How many meters are in 10 kilometers?",
+        answer="10000",
+        aliases=["10000 meters"],
+        first_prize=100,
+    )
+
+    assert question.matches("10000 metres")
+    assert not question.matches("1000")
+    assert not question.matches("100000")
+    assert not question.matches("10001")
+    assert not question.matches("10001 meters")
+
+
+async def test_trivia_question_matches_word_order(mongo_mock_client):
+    """Test that answers whose meaning depends on word order must keep
+    it."""
+    question = TriviaQuestion(
+        question="Is the Earth flat?", answer="Not true", first_prize=100
+    )
+
+    assert question.matches("not true!")
+    assert not question.matches("true not")
+
+    question = TriviaQuestion(
+        question="What was the final score?", answer="3-1", first_prize=100
+    )
+
+    assert question.matches("3 1")
+    assert not question.matches("1-3")
+
+
+async def test_trivia_question_matches_changed_answer(mongo_mock_client):
+    """Test that cached matches are discarded when the answer
+    changes."""
+    question = TriviaQuestion(
+        question="What is 6 x 7?", answer="42", first_prize=100
+    )
+    assert question.matches("42")
+
+    question.answer = "forty-two"
+    question.aliases.append("42.0")
+
+    assert not question.matches("42")
+    assert question.matches("Forty Two")
+    assert question.matches("42.0")
+
+
+def make_question():
+    return TriviaQuestion(
+        question="Who wrote The Hitchhiker's Guide to the Galaxy?",
+        answer="Douglas Adams",
+        first_prize=1000,
+    )
+
+
+async def test_trivia_question_normalized(mongo_mock_client):
+    """Test that questions with the same normalized text can't both be
+    inserted."""
+    await TriviaQuestion(
+        question="What is 6 x 7?", answer="42", first_prize=100
+    ).insert()
+
+    question = TriviaQuestion(
+        question="what is 6 X 7", answer="42", first_prize=100
+    )
+    assert question.normalized_question == "what is 6 x 7"
+
+    with pytest.raises(DuplicateKeyError):
+        await question.insert()
+
+
+async def test_trivia_question_migrate_normalized(mongo_mock_client):
+    """Test that questions stored before normalization are normalized,
+    so they aren't imported again."""
+    await TriviaQuestion.get_motor_collection().insert_many(
+        [
+            {"question": "What is 6 x 7?", "answer": "42", "first_prize": 1},
+            {"question": "what is 6 X 7", "answer": "42", "first_prize": 2},
+            {"question": "Who wrote it?", "answer": "Adams", "first_prize": 3},
+        ]
+    )
+
+    assert await TriviaQuestion.migrate_normalized_questions() == 2
+    assert await TriviaQuestion.migrate_normalized_questions() == 0
+
+    file = io.StringIO(
+        json.dumps(
+            {"question": "Who wrote it", "answer": "Adams", "first_prize": 4}
+        )
+    )
+
+    assert await TriviaQuestion.import_questions(file) == 0
+    assert await TriviaQuestion.find_all().count() == 3
+
+
+async def test_trivia_question_import_jsonl(mongo_mock_client):
+    """Test that questions are imported from JSONL in chunks, skipping
+    duplicates."""
+    lines = [
+        {"question": f"Question {i % 5}?", "answer": "42", "first_prize": i}
+        for i in range(12)
+    ]
+    file = io.StringIO("\n".join(json.dumps(line) for line in lines))
+
+    assert await TriviaQuestion.import_questions(file, chunk_size=4) == 5
+    assert await TriviaQuestion.find_all().count() == 5
+
+    question = await TriviaQuestion.find_one({"question": "Question 3?"})
+    assert question.first_prize == 3
+    assert question.normalized_question == "question 3"
+
+
+async def test_trivia_question_import_csv(mongo_mock_client):
+    """Test that questions are imported from CSV."""
+    file = io.StringIO(
+        "question,answer,first_prize\n"
+        'Who wrote it?,"Adams, Douglas",500\n'
+        "What is 6 x 7?,42,100\n"
+    )
+
+    assert await TriviaQuestion.import_questions(file, "csv") == 2
+
+    question = await TriviaQuestion.find_one({"question": "Who wrote it?"})
+    assert question.answer == "Adams, Douglas"
+    assert question.aliases == []
+    assert question.first_prize == 500
+
+
+async def test_trivia_question_import_invalid(mongo_mock_client):
+    """Test that invalid files aren't imported."""
+    with pytest.raises(ValueError):
+        await TriviaQuestion.import_questions(io.StringIO(""), "xml")
+
+    with pytest.raises(ValueError):
+        await TriviaQuestion.import_questions(
+            io.StringIO('{"question": "What?"}')
+        )
+
+
+async def test_trivia_question_export(mongo_mock_client):
+    """Test that exported questions can be imported again."""
+    await insert_questions(2)
+    await TriviaQuestion(
+        question="Question 2",
+        answer="42",
+        aliases=["forty-two", "XLII"],
+        first_prize=100,
+    ).insert()
+
+    for file_format in ("jsonl", "csv"):
+        file = io.StringIO()
+        assert await TriviaQuestion.export_questions(file, file_format) == 3
+
+        await TriviaQuestion.delete_all()
+        file.seek(0)
+
+        assert await TriviaQuestion.import_questions(file, file_format) == 3
+        assert [
+            question.question async for question in TriviaQuestion.find_all()
+        ] == ["Question 0", "Question 1", "Question 2"]
+
+        question = await TriviaQuestion.find_one({"question": "Question 2"})
+        assert question.aliases == ["forty-two", "XLII"]
+
+
+def test_normalize_text():
+    """Test that answers are normalized for grading."""
+    assert normalize_text("  Douglas   ADAMS!! ") == "douglas adams"
+    assert normalize_text("douglas_adams.") == "douglas adams"
+    assert normalize_text("???") == ""
+
+
+async def test_trivia_round_winners(mongo_mock_client):
+    """Test that the first three users to answer correctly win."""
+    users = [User(name=f"test{i}") for i in range(5)]
+    for user in users:
+        await user.insert()
+
+    trivia_round = TriviaRound(make_question())
+
+    assert trivia_round.submit(users[0], "Arthur Dent") is None
+    assert trivia_round.submit(users[1], "douglas adams") == 1
+    assert trivia_round.submit(users[1], "Douglas Adams") is None
+    assert trivia_round.submit(users[0], "Douglas Adams!") == 2
+    assert trivia_round.finished is False
+    assert trivia_round.submit(users[2], " DOUGLAS  ADAMS ") == 3
+    assert trivia_round.finished is True
+    assert trivia_round.submit(users[3], "Douglas Adams") is None
+
+    assert trivia_round.winners == [users[1], users[0], users[2]]
+
+
+async def test_trivia_round_award(mongo_mock_client):
+    """Test that prizes are paid to the winners in place order."""
+    users = [User(name=f"test{i}") for i in range(3)]
+    for user in users:
+        await user.insert()
+
+    trivia_round = TriviaRound(make_question())
+    trivia_round.submit(users[2], "Douglas Adams")
+    trivia_round.submit(users[0], "Douglas Adams")
+
+    payouts = await trivia_round.award()
+
+    assert payouts == [(users[2], 1000), (users[0], 700)]
+    assert [user.balance for user in users] == [700, 0, 1000]
+    assert [(await User.get(user.id)).balance for user in users] == [
+        700,
+        0,
+        1000,
+    ]
+
+    assert trivia_round.submit(users[1], "Douglas Adams") is None
+
+    with pytest.raises(ValueError):
+        await trivia_round.award()
+
+
+async def test_trivia_round_award_deleted_winner(mongo_mock_client):
+    """Test that prizes for deleted winners are reported as unpaid."""
+    users = [User(name=f"test{i}") for i in range(2)]
+    for user in users:
+        await user.insert()
+
+    trivia_round = TriviaRound(make_question())
+    trivia_round.submit(users[0], "Douglas Adams")
+    trivia_round.submit(users[1], "Douglas Adams")
+    await users[0].delete()
+
+    assert await trivia_round.award() == [(users[1], 700)]
+    assert trivia_round.unpaid == [users[0]]
+    assert [user.balance for user in users] == [0, 700]
+
+
+async def test_trivia_round_concurrent(mongo_mock_client):
+    """Test that answers submitted from many tasks are graded in arrival
+    order."""
+    users = [User(name=f"test{i}") for i in range(100)]
+    for user in users:
+        await user.insert()
+
+    trivia_round = TriviaRound(make_question())
+
+    async def answer(user, delay):
+        await asyncio.sleep(delay)
+        return trivia_round.submit(user, "Douglas Adams")
+
+    places = await asyncio.gather(
+        *(answer(user, (100 - i) / 10000) for i, user in enumerate(users))
     )
 
-    assert question.prizes == (73.0, 51.1, 36.5)
+    assert await trivia_round.wait(1) is True
+    assert trivia_round.winners == users[:-4:-1]
+    assert sorted(place for place in places if place) == [1, 2, 3]
+
+
+async def test_trivia_round_wait_timeout(mongo_mock_client):
+    """Test that waiting for winners can time out."""
+    trivia_round = TriviaRound(make_question())
+
+    assert await trivia_round.wait(0.01) is False
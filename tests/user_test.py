@@ -1,4 +1,5 @@
 import pytest
+from beanie import PydanticObjectId
 
 from benbucks_core import Pool, User
 
@@ -8,7 +9,7 @@ async def test_user_init(mongo_mock_client):
     user = User(name="test")
 
     assert user.name == "test"
-    assert user.balance == 0.0
+    assert user.balance == 0
     assert user.pin is None
 
 
@@ -24,27 +25,83 @@ async def test_user_change_name(mongo_mock_client):
 async def test_user_change_balance(mongo_mock_client):
     """Test that a user's balance can be changed."""
     user = User(name="test")
-    assert user.balance == 0.0
+    assert user.balance == 0
 
-    await user.change_balance(10.0)
-    await user.change_balance(-5.0)
-    await user.change_balance(2.0)
+    await user.change_balance(1000)
+    await user.change_balance(-500)
+    await user.change_balance(200)
 
-    assert user.balance == 7.0
+    assert user.balance == 700
 
 
 async def test_user_change_balance_negative(mongo_mock_client):
     """Test that a user's balance cannot be made negative."""
-    user = User(name="test", balance=5.0)
-    assert user.balance == 5.0
+    user = User(name="test", balance=500)
+    assert user.balance == 500
 
-    await user.change_balance(-1.0)
-    assert user.balance == 4.0
+    await user.change_balance(-100)
+    assert user.balance == 400
 
     with pytest.raises(ValueError):
-        await user.change_balance(-5.0)
+        await user.change_balance(-500)
 
-    assert user.balance == 4.0
+    assert user.balance == 400
+
+
+async def test_user_change_balance_float(mongo_mock_client):
+    """Test that amounts in whole units are rejected instead of being
+    added to a balance in cents."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+
+    with pytest.raises(TypeError):
+        await user.change_balance(10.0)
+
+    with pytest.raises(TypeError):
+        await User.bulk_change_balances([(user.id, 10.0)])
+
+    with pytest.raises(TypeError):
+        await user.contribute_to_pool(await Pool.get_by_code("test"), 1.5)
+
+    assert (await User.get(user.id)).balance == 1000
+
+
+async def test_user_change_balance_stale_copy(mongo_mock_client):
+    """Test that balance changes through stale copies of a user are
+    not lost."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+
+    copy = await User.get(user.id)
+
+    await user.change_balance(500)
+    await copy.change_balance(-300)
+
+    assert copy.balance == 1200
+    assert (await User.get(user.id)).balance == 1200
+
+    with pytest.raises(ValueError):
+        await user.change_balance(-1300)
+
+    assert (await User.get(user.id)).balance == 1200
+
+
+async def test_user_stale_copy_keeps_balance(mongo_mock_client):
+    """Test that changing other fields through a stale copy of a user
+    doesn't overwrite their balance."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+
+    copy = await User.get(user.id)
+
+    await user.change_balance(-1000)
+    await copy.change_name("renamed")
+    await copy.set_pin("1234")
+
+    stored = await User.get(user.id)
+    assert stored.balance == 0
+    assert stored.name == "renamed"
+    assert stored.pin == "1234"
 
 
 async def test_user_set_pin_from_empty(mongo_mock_client):
@@ -80,45 +137,122 @@ async def test_user_set_pin_without_override(mongo_mock_client):
 
 async def test_user_contribute_to_pool(mongo_mock_client):
     """Test that a user can contribute to a pool."""
-    user = User(name="test", balance=15.0)
+    user = User(name="test", balance=1500)
     pool = Pool(code="test")
 
-    assert user.balance == 15.0
-    assert pool.balance == 0.0
+    assert user.balance == 1500
+    assert pool.balance == 0
 
-    await user.contribute_to_pool(pool, 10.0)
+    await user.contribute_to_pool(pool, 1000)
 
-    assert user.balance == 5.0
-    assert pool.balance == 10.0
+    assert user.balance == 500
+    assert pool.balance == 1000
 
 
 async def test_user_contribute_to_pool_not_enough_money(mongo_mock_client):
     """Test that a user cannot contribute to a pool if they do not have
     enough money."""
-    user = User(name="test", balance=5)
+    user = User(name="test", balance=500)
     pool = Pool(code="test")
 
-    assert user.balance == 5.0
-    assert pool.balance == 0.0
+    assert user.balance == 500
+    assert pool.balance == 0
 
     with pytest.raises(ValueError):
-        await user.contribute_to_pool(pool, 10.0)
+        await user.contribute_to_pool(pool, 1000)
 
-    assert user.balance == 5.0
-    assert pool.balance == 0.0
+    assert user.balance == 500
+    assert pool.balance == 0
 
 
 async def test_user_contribute_to_pool_negative_amount(mongo_mock_client):
     """Test that a user cannot contribute a negative amount to a
     pool."""
-    user = User(name="test", balance=15.0)
+    user = User(name="test", balance=1500)
     pool = Pool(code="test")
 
-    assert user.balance == 15.0
-    assert pool.balance == 0.0
+    assert user.balance == 1500
+    assert pool.balance == 0
 
     with pytest.raises(ValueError):
-        await user.contribute_to_pool(pool, -10.0)
+        await user.contribute_to_pool(pool, -1000)
+
+    assert user.balance == 1500
+    assert pool.balance == 0
+
+
+async def test_user_bulk_change_balances(mongo_mock_client):
+    """Test that many users' balances can be changed at once."""
+    user1 = User(name="test1", balance=1000)
+    user2 = User(name="test2", balance=500)
+    await user1.insert()
+    await user2.insert()
+
+    failed = await User.bulk_change_balances(
+        [(user1.id, 250), (user2.id, -500), (user1.id, 100)]
+    )
+
+    assert failed == []
+    assert (await User.get(user1.id)).balance == 1350
+    assert (await User.get(user2.id)).balance == 0
+
+
+async def test_user_bulk_change_balances_failures(mongo_mock_client):
+    """Test that rejected bulk balance changes are reported without
+    stopping the others."""
+    user1 = User(name="test1", balance=1000)
+    user2 = User(name="test2", balance=500)
+    await user1.insert()
+    await user2.insert()
+    missing_id = PydanticObjectId()
+
+    failed = await User.bulk_change_balances(
+        [(user1.id, 400), (user2.id, -600), (missing_id, 100)]
+    )
+
+    assert failed == [user2.id, missing_id]
+    assert (await User.get(user1.id)).balance == 1400
+    assert (await User.get(user2.id)).balance == 500
+
+
+async def test_user_name_index(mongo_mock_client):
+    """Test that users are indexed by name."""
+    indexes = await User.get_motor_collection().index_information()
+
+    assert [("name", 1)] in [list(index["key"]) for index in indexes.values()]
+
+
+async def test_user_leaderboard(mongo_mock_client):
+    """Test that the leaderboard streams users from richest to poorest,
+    one page at a time."""
+    balances = [500, 2000, 0, 2000, 1500]
+    for number, balance in enumerate(balances):
+        await User(name=f"test{number}", balance=balance).insert()
+
+    pages = [page async for page in User.leaderboard(limit=2)]
+
+    assert [[entry.balance for entry in page] for page in pages] == [
+        [2000, 2000],
+        [1500, 500],
+        [0],
+    ]
+    assert pages[0][0].id > pages[0][1].id
+    assert pages[1][0].name == "test4"
+
+
+async def test_user_leaderboard_after(mongo_mock_client):
+    """Test that the leaderboard can continue from an entry."""
+    for number, balance in enumerate([300, 200, 100]):
+        await User(name=f"test{number}", balance=balance).insert()
+
+    first = await anext(User.leaderboard(limit=1))
+    rest = [page async for page in User.leaderboard(2, after=first[-1])]
+
+    assert [[entry.name for entry in page] for page in rest] == [
+        ["test1", "test2"]
+    ]
+
 
-    assert user.balance == 15.0
-    assert pool.balance == 0.0
+async def test_user_leaderboard_empty(mongo_mock_client):
+    """Test that an empty leaderboard yields no pages."""
+    assert [page async for page in User.leaderboard()] == []
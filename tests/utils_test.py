@@ -1,17 +1,41 @@
 import pytest
 
-from benbucks_core._utils import CURRENCY_SYMBOL, format_money
+from benbucks_core._utils import CURRENCY_SYMBOL, Money, format_money
 
 
 @pytest.mark.parametrize(
     "test_input,expected",
     {
-        (1.0, "1.00"),
-        (1.23, "1.23"),
-        (1.2344444444, "1.23"),
-        (1.2355555555, "1.24"),
+        (0, "0.00"),
+        (100, "1.00"),
+        (123, "1.23"),
+        (5, "0.05"),
+        (123456, "1234.56"),
+        (-250, "-2.50"),
     },
 )
-def test_format_money(test_input: float, expected: str):
+def test_format_money(test_input: int, expected: str):
     """Test formatting of currency."""
     assert format_money(test_input) == CURRENCY_SYMBOL + expected
+
+
+@pytest.mark.parametrize(
+    "test_input,expected",
+    {
+        (150, 150),
+        (1.5, 150),
+        (1.2355555555, 124),
+        (0.1 + 0.2, 30),
+    },
+)
+def test_money_validate(test_input: float, expected: int):
+    """Test that amounts are validated as cents, with legacy floats in
+    whole units converted."""
+    assert Money.validate(test_input) == expected
+
+
+@pytest.mark.parametrize("test_input", ["1.00", None, True])
+def test_money_validate_invalid(test_input):
+    """Test that non-numeric amounts are rejected."""
+    with pytest.raises(TypeError):
+        Money.validate(test_input)
@@ -0,0 +1,315 @@
+import asyncio
+from functools import partial
+
+import pytest
+from beanie import PydanticObjectId
+
+from benbucks_core import (
+    Lottery,
+    Pool,
+    ProcessRouter,
+    Router,
+    ShardWorker,
+    User,
+    init_memory_db,
+)
+from benbucks_core.workers import shard_of
+
+
+@pytest.fixture
+def writes(mongo_mock_client, monkeypatch):
+    calls = []
+
+    for model in (Lottery, Pool, User):
+        collection = model.get_motor_collection()
+
+        for name in ("bulk_write", "find_one_and_update"):
+
+            async def counted(
+                *args, model=model, method=getattr(collection, name), **kwargs
+            ):
+                calls.append(model.__name__)
+                return await method(*args, **kwargs)
+
+            monkeypatch.setattr(collection, name, counted)
+
+    return calls
+
+
+def owned_by(shard, shards, candidates):
+    return next(key for key in candidates if shard_of(key, shards) == shard)
+
+
+async def init_accounts(user_id, lottery_id):
+    """Give each process its own in-memory database with the same
+    accounts, so changes show which process made them."""
+    await init_memory_db("test")
+    await User(id=user_id, name="test", balance=1000).insert()
+    await Lottery(
+        id=lottery_id, name="test", prize=0, ticket_price=400
+    ).insert()
+
+
+async def fail_init():
+    raise ValueError("Can't connect")
+
+
+def test_shard_of():
+    """Test that keys are spread across shards consistently."""
+    keys = [f"account{i}" for i in range(1000)]
+    shards = [shard_of(key, 4) for key in keys]
+
+    assert shards == [shard_of(key, 4) for key in keys]
+    assert all(200 < shards.count(shard) < 300 for shard in range(4))
+
+
+def test_shard_worker_invalid_shard():
+    """Test that a worker's shard must exist."""
+    with pytest.raises(ValueError):
+        ShardWorker(4, 4)
+
+
+async def test_shard_worker_combines_changes(writes):
+    """Test that changes to a hot account are written together."""
+    pool = await Pool.get_by_code("test")
+    worker = ShardWorker(shard_of(pool.id, 2), 2)
+    writes.clear()
+
+    async with worker:
+        await asyncio.gather(
+            *(worker.change_balance(Pool, pool.id, 10) for _ in range(100))
+        )
+
+    assert writes == ["Pool"]
+    assert (await Pool.get(pool.id)).balance == 1000
+
+
+async def test_shard_worker_rejected_change(mongo_mock_client):
+    """Test that rejected changes raise an error for their caller."""
+    user = User(name="test", balance=100)
+    await user.insert()
+    worker = ShardWorker(0, 1)
+
+    async with worker:
+        with pytest.raises(ValueError):
+            await worker.change_balance(User, user.id, -200)
+
+        await worker.change_balance(User, user.id, -100, "Test")
+
+    assert (await User.get(user.id)).balance == 0
+
+
+@pytest.mark.parametrize("reasons", [("Test", "Test"), ("Credit", "Debit")])
+async def test_shard_worker_independent_changes(mongo_mock_client, reasons):
+    """Test that a rejected change doesn't fail other queued changes."""
+    user = User(name="test", balance=0)
+    await user.insert()
+
+    async with ShardWorker(0, 1, max_delay=0.01) as worker:
+        results = await asyncio.gather(
+            worker.change_balance(User, user.id, 100, reasons[0]),
+            worker.change_balance(User, user.id, -150, reasons[1]),
+            worker.change_balance(User, user.id, -60, reasons[1]),
+            return_exceptions=True,
+        )
+
+    assert results[0] is None
+    assert isinstance(results[1], ValueError)
+    assert results[2] is None
+    assert (await User.get(user.id)).balance == 40
+
+
+async def test_shard_worker_repeat_purchases(mongo_mock_client):
+    """Test that a buyer's unaffordable purchase doesn't fail others."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+    lottery = Lottery(name="test", prize=0, ticket_price=400)
+    await lottery.insert()
+
+    async with ShardWorker(0, 1, max_delay=0.01) as worker:
+        results = await asyncio.gather(
+            worker.buy_tickets(lottery.id, user.id, 2),
+            worker.buy_tickets(lottery.id, user.id),
+            return_exceptions=True,
+        )
+
+    assert results[0] is None
+    assert isinstance(results[1], ValueError)
+    assert (await User.get(user.id)).balance == 200
+    assert (await Lottery.get(lottery.id)).ticket_count == 2
+
+
+async def test_shard_worker_buy_tickets(writes):
+    """Test that ticket purchases for a lottery are bought together."""
+    users = [User(name=f"test{i}", balance=1000) for i in range(3)]
+    await User.insert_many(users)
+    users = [user async for user in User.find_all()]
+    lottery = Lottery(name="test", prize=0, ticket_price=400)
+    await lottery.insert()
+    writes.clear()
+
+    async with ShardWorker(0, 1, max_delay=0.01) as worker:
+        results = await asyncio.gather(
+            worker.buy_tickets(lottery.id, users[0].id, 2),
+            worker.buy_tickets(lottery.id, users[1].id),
+            worker.buy_tickets(lottery.id, users[2].id, 3),
+            return_exceptions=True,
+        )
+
+    assert results[:2] == [None, None]
+    assert isinstance(results[2], ValueError)
+    assert writes == ["User", "Lottery"]
+
+    stored = await Lottery.get(lottery.id)
+    assert stored.tickets == {str(users[0].id): 2, str(users[1].id): 1}
+    assert stored.ticket_count == 3
+
+
+async def test_shard_worker_missing_lottery(mongo_mock_client):
+    """Test that tickets can't be bought for a missing lottery."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+
+    async with ShardWorker(0, 1) as worker:
+        with pytest.raises(ValueError):
+            await worker.buy_tickets(user.id, user.id)
+
+
+async def test_shard_worker_max_batch(mongo_mock_client):
+    """Test that a full batch is written without waiting."""
+    user = User(name="test")
+    await user.insert()
+
+    async with ShardWorker(0, 1, max_delay=60, max_batch=2) as worker:
+        await asyncio.wait_for(
+            asyncio.gather(
+                worker.change_balance(User, user.id, 1),
+                worker.change_balance(User, user.id, 2),
+            ),
+            1,
+        )
+
+    assert (await User.get(user.id)).balance == 3
+
+
+async def test_shard_worker_ownership(mongo_mock_client):
+    """Test that workers only accept updates for their own shard."""
+    keys = [f"account{i}" for i in range(10)]
+    worker = ShardWorker(0, 2)
+
+    with pytest.raises(RuntimeError):
+        await worker.change_balance(User, owned_by(0, 2, keys), 1)
+
+    async with worker:
+        with pytest.raises(ValueError):
+            await worker.change_balance(User, owned_by(1, 2, keys), 1)
+
+
+async def test_router(mongo_mock_client):
+    """Test that the router sends updates to the owning workers."""
+    users = [User(name=f"test{i}") for i in range(20)]
+    await User.insert_many(users)
+    users = [user async for user in User.find_all()]
+
+    async with Router.create(4) as router:
+        await asyncio.gather(
+            *(
+                router.change_balance(User, user.id, i)
+                for i, user in enumerate(users)
+            )
+        )
+
+        for user in users:
+            assert router.worker_for(user.id).owns(user.id)
+
+    assert [(await User.get(user.id)).balance for user in users] == list(
+        range(20)
+    )
+
+
+def test_router_invalid_workers():
+    """Test that a router needs one worker for each shard."""
+    with pytest.raises(ValueError):
+        Router([ShardWorker(0, 2)])
+
+    with pytest.raises(ValueError):
+        Router([ShardWorker(1, 2), ShardWorker(0, 2)])
+
+
+async def test_router_buy_tickets_other_shard(mongo_mock_client):
+    """Test that the router debits buyers through their own worker."""
+    users = [User(name=f"test{i}", balance=1000) for i in range(20)]
+    await User.insert_many(users)
+    users = [user async for user in User.find_all()]
+    lottery = Lottery(name="test", prize=0, ticket_price=400)
+    await lottery.insert()
+    user = owned_by(
+        1 - shard_of(lottery.id, 2), 2, (user.id for user in users)
+    )
+
+    async with Router.create(2) as router:
+        with pytest.raises(ValueError):
+            await router.worker_for(lottery.id).buy_tickets(lottery.id, user)
+
+        await router.buy_tickets(lottery.id, user, 2)
+
+        with pytest.raises(ValueError):
+            await router.buy_tickets(lottery.id, user)
+
+    assert (await User.get(user)).balance == 200
+    assert (await Lottery.get(lottery.id)).tickets == {str(user): 2}
+
+
+async def test_shard_worker_completed_lottery(mongo_mock_client):
+    """Test that buyers are refunded if the lottery was completed after
+    they were debited."""
+    user = User(name="test", balance=1000)
+    await user.insert()
+    lottery = Lottery(name="test", prize=0, ticket_price=400)
+    await lottery.insert()
+
+    async with ShardWorker(0, 1) as worker:
+        await worker.buy_tickets(lottery.id, user.id)
+        await (await Lottery.get(lottery.id)).complete()
+
+        with pytest.raises(ValueError):
+            await worker.buy_tickets(lottery.id, user.id)
+
+    assert (await User.get(user.id)).balance == 600
+    assert (await Lottery.get(lottery.id)).ticket_count == 1
+
+
+def test_process_router_invalid_shards():
+    """Test that a process router needs at least one shard."""
+    with pytest.raises(ValueError):
+        ProcessRouter(0)
+
+
+async def test_process_router():
+    """Test that updates are made by the process owning them."""
+    ids = [PydanticObjectId() for _ in range(20)]
+    user_id = owned_by(0, 2, ids)
+    lottery_id = owned_by(1, 2, ids)
+    init = partial(init_accounts, user_id, lottery_id)
+
+    async with ProcessRouter(2, init, max_delay=0.01) as router:
+        await router.buy_tickets(lottery_id, user_id, 2)
+
+        # Only the buyer's process was debited
+        with pytest.raises(ValueError):
+            await router.buy_tickets(lottery_id, user_id)
+
+        await router.change_balance(User, user_id, -200, "Test")
+
+        with pytest.raises(ValueError):
+            await router.change_balance(User, user_id, -1)
+
+    with pytest.raises(RuntimeError):
+        await router.change_balance(User, user_id, 1)
+
+
+async def test_process_router_failed_init():
+    """Test that an error connecting a process is raised on start."""
+    with pytest.raises(ValueError, match="connect"):
+        async with ProcessRouter(2, fail_init):
+            pass